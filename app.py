@@ -1,15 +1,18 @@
-from flask import Flask, render_template, url_for, redirect, request, flash, session, jsonify, send_file
-from flask_sqlalchemy import SQLAlchemy
+from flask import Flask, render_template, url_for, redirect, request, flash, session, jsonify, send_file, g, Response
+from storage import ProfiledSQLAlchemy, load_profile
 from preston.esi import Preston
 import sqlite3
 from datetime import datetime
 import random
 import requests
 import json
-import logging
-import sys
 import os
+import time
 from requests_oauthlib import OAuth2Session
+from notify import send_notification, UNLINK, LINK
+from webclient import EsiWebClient, make_adapter, timing_hook, timed
+from metrics import REGISTRY, CONTENT_TYPE, Counter, Histogram
+from logsetup import setup_logging
 
 # config setup
 with open('config.json') as f:
@@ -21,20 +24,11 @@ app.config['SQLALCHEMY_DATABASE_URI'] = config['SQLALCHEMY_DATABASE_URI']
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.secret_key = os.urandom(24)
 
-#logging setup
-app.logger.setLevel(config['LOGGING']['LEVEL']['ALL'])
-handler = logging.StreamHandler(sys.stdout)
-formatter = logging.Formatter(style='{', fmt='{asctime} [{levelname}] {message}', datefmt='%Y-%m-%d %H:%M:%S')
-handler.setFormatter(formatter)
-handler.setLevel(config['LOGGING']['LEVEL']['CONSOLE'])
-app.logger.addHandler(handler)
-handler = logging.FileHandler(config['LOGGING']['FILE'])
-handler.setFormatter(formatter)
-handler.setLevel(config['LOGGING']['LEVEL']['FILE'])
-app.logger.addHandler(handler)
-
-#Create sqlalchemy object
-db = SQLAlchemy(app)
+#logging setup, the console and the file are written by a background thread
+log_listener = setup_logging(app.logger, config)
+
+#Create sqlalchemy object, SQLite databases get the configured journal mode, timeouts and pool
+db = ProfiledSQLAlchemy(app, profile=load_profile(config))
 
 from models import *
 
@@ -46,13 +40,21 @@ preston = Preston(
 	client_secret=config['EVE_CLIENT_SECRET'],
 	callback_url=config['EVE_CALLBACK_URI']
 )
+#One keep-alive pool per worker process for ESI and one for the Discord API
+esi = EsiWebClient.from_config(config, app.logger)
+http_config = config.get('WEB_HTTP', {})
+HTTP_TIMEOUT = http_config.get('TIMEOUT', 10)
+discord_adapter = make_adapter(http_config.get('POOL_SIZE', 10), http_config.get('RETRIES', 2), http_config.get('BACKOFF', 0.3))
+discord_timing = timing_hook(app.logger, 'Discord')
+#Let the bot resolve links instead of waiting on ESI in the request
+LINK_QUEUE = config.get('LINK_QUEUE', {}).get('ENABLED', False)
 AVATAR_SIZE = 64
 API_BASE_URL ='https://discordapp.com/api'
 AUTHORIZATION_BASE_URL = API_BASE_URL + "/oauth2/authorize"
 TOKEN_URL = API_BASE_URL +"/oauth2/token"
 
 def make_session(token=None, state=None, scope=None):
-    return OAuth2Session(
+    discord = OAuth2Session(
         client_id=config['DISCORD_CLIENT_ID'],
         token=token,
         state=state,
@@ -63,9 +65,38 @@ def make_session(token=None, state=None, scope=None):
             'client_secret': config['DISCORD_CLIENT_SECRET'],
         },
         auto_refresh_url=TOKEN_URL)
+    #The OAuth state is per user, the connections behind it are shared
+    discord.mount('https://', discord_adapter)
+    discord.hooks['response'].append(discord_timing)
+    return discord
 
 os.environ['OAUTHLIB_INSECURE_TRANSPORT'] = 'true'
 
+ROUTE_REQUESTS = Counter('http_requests_total', 'Requests handled by the web app, by route and status', ('endpoint', 'method', 'status'))
+ROUTE_SECONDS = Histogram('http_request_seconds', 'Time the web app took to handle a request, by route', ('endpoint', 'method'))
+
+@app.before_request
+def start_request_timer():
+	g.request_start = time.perf_counter()
+
+@app.after_request
+def record_request(response):
+	if 'request_start' in g:
+		endpoint = request.endpoint or 'unknown'
+		ROUTE_SECONDS.observe(time.perf_counter() - g.request_start, (endpoint, request.method))
+		ROUTE_REQUESTS.inc((endpoint, request.method, response.status_code))
+	return response
+
+@app.route('/metrics')
+def metrics():
+	"""Exposes the metrics of this worker process in the Prometheus text format
+	Args:
+	None
+	Returns:
+		str: the metrics
+	"""
+	return Response(REGISTRY.render(), mimetype=CONTENT_TYPE)
+
 @app.route('/')
 def login():
 	"""Shows a user the EVE SSO link so they can log in.
@@ -100,9 +131,10 @@ def callback():
 	token = discord.fetch_token(
 		TOKEN_URL,
 		client_secret=config['DISCORD_CLIENT_SECRET'],
-		authorization_response=request.url)
+		authorization_response=request.url,
+		timeout=HTTP_TIMEOUT)
 	discord = make_session(token=token)
-	user = discord.get(API_BASE_URL + '/users/@me').json()
+	user = discord.get(API_BASE_URL + '/users/@me', timeout=HTTP_TIMEOUT).json()
 
 	#Setting session stuff
 	session['DiscordName'] = user['username'] + "#" + user['discriminator']
@@ -137,12 +169,14 @@ def eve_oauth_callback():
 		flash('There was an error in EVE\'s response', 'error')
 		return redirect(url_for('login'))
 	try:
-		auth = preston.authenticate(request.args['code'])
+		with timed(app.logger, 'EVE SSO', 'authenticate'):
+			auth = preston.authenticate(request.args['code'])
 	except Exception as e:
 		app.logger.error('ESI signing error: ' + str(e))
 		flash('There was an authentication error signing you in.', 'error')
 		return redirect(url_for('login'))
-	character_info = auth.whoami()
+	with timed(app.logger, 'EVE SSO', 'whoami'):
+		character_info = auth.whoami()
 	character = DiscordUser.query.filter(DiscordUser.character_id == character_info['CharacterID']).first()
 	#If character already exists with a discord id, inform user he is already authenticated
 	if character is not None:
@@ -174,6 +208,8 @@ def remove_auth():
 
 		db.session.delete(u)
 		db.session.commit()
+		#Wake the bot up, the removal table stays the durable record if it is not listening
+		send_notification(config.get('BOT_NOTIFY', {}).get('SOCKET', 'bot.sock'), UNLINK)
 
 	except Exception as e:
 		app.logger.error("Failed to remove authentication. " + str(e))
@@ -224,30 +260,20 @@ def link_to_database():
 	if session['Linked'] == True:
 		flash('Already linked!')
 		return redirect(url_for('login'))
+	if LINK_QUEUE:
+		return queue_link()
 
 	app.logger.info("Making ESI post request to characters/affiliation endpoint with character id " + str(session['EveID']))
-	r = requests.post("https://esi.tech.ccp.is/latest/characters/affiliation/?datasource=tranquility", json=[session['EveID']],
-		headers = {'Content-Type': 'application/json', 'Accept':'application/json','User-Agent': 'Maintainer: ' + config['MAINTAINER']})
-	result = r.json()
-	if not result:
+	try:
+		data = esi.get_affiliation(session['EveID'])
+	except (requests.RequestException, ValueError) as e:
+		app.logger.error("ESI affiliation lookup failed: " + str(e))
+		flash('EVE\'s API is not responding, please try again later.', 'error')
+		return redirect(url_for('login'))
+	if data is None:
 		error = "Character ID " + str(session['EveID']) + " is not valid! Message a mentor!"
 		flash(error, 'error')
 		return redirect(url_for('login')) 
-
-	if 'error' in result:
-		#Make different endpoint check
-		app.logger.info("ESI Post failed, using names endpoint instead")
-		r = requests.get("https://esi.tech.ccp.is/latest/characters/" + str(session['EveID']) + "/?datasource=tranquility", headers={
-                    'User-Agent': 'Maintainer: '+ config['MAINTAINER']
-                    })
-		result = r.json()
-		if not result:
-			error = "Character ID " + str(session['EveID']) + " is not valid! Message a mentor!"
-			flash(error, 'error')
-			return redirect(url_for('login')) 
-		data = result
-	else:
-		data = result[0]
 	
     #Update corp and alliance in json
 	alliance_id = None
@@ -267,6 +293,49 @@ def link_to_database():
 	flash('Succesfully linked accounts.', 'success')
 	return redirect(url_for('login')) 
 
+def queue_link():
+	"""Queues the link for the bot, which resolves the affiliation and creates the user
+	Args:
+	None
+	Returns:
+		Login page, which polls the status of the link
+	"""
+	job = LinkJob.query.filter(LinkJob.discord_id == session['DiscordID'], LinkJob.status == LinkJob.PENDING).first()
+	if job is None:
+		avatar = None
+		if 'DiscordAvatar' in session:
+			avatar = session['DiscordAvatar']
+		job = LinkJob(session['EveName'],session['EveID'],session['DiscordID'],session['DiscordName'],avatar)
+		db.session.add(job)
+		db.session.commit()
+		app.logger.info("Queued link of " + session['EveName'] + " with Discord " + session['DiscordName'])
+		#Wake the bot up, it polls the queue now and then if it is not listening
+		send_notification(config.get('BOT_NOTIFY', {}).get('SOCKET', 'bot.sock'), LINK)
+	session['LinkJob'] = job.id
+	return redirect(url_for('login'))
+
+@app.route('/link/status')
+def link_status():
+	"""Reports the status of a queued link
+	Args:
+	None
+	Returns:
+		str: JSON with the status, 'pending', 'done', 'failed' or 'none'
+	"""
+	jobID = session.get('LinkJob')
+	job = LinkJob.query.get(jobID) if jobID is not None else None
+	if job is None:
+		session.pop('LinkJob', None)
+		return jsonify(status='none')
+	if job.status == LinkJob.DONE:
+		session.pop('LinkJob')
+		session['Linked'] = True
+		flash('Succesfully linked accounts.', 'success')
+	elif job.status == LinkJob.FAILED:
+		session.pop('LinkJob')
+		flash(job.error, 'error')
+	return jsonify(status=job.status)
+
 def get_eve_avatar(characterID, size):
 	"""Retrieves the URL for an eve avatar
 	Args:
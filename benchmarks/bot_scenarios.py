@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+"""
+Runs the bot's hot paths offline against a fake ESI and a fake guild.
+For every roster size three scenarios run one after another:
+    join    update_on_server() finds the whole roster on the server unmarked
+    sweep   check_corp() checks every affiliation while some characters changed corporation
+    unlink  remove_auth_user_roles() drains removal requests for part of the roster
+Each scenario reports wall time, ESI and Discord requests, database commits
+and the time the event loop was blocked, including the member edits and
+database writes it queued.
+
+Usage:
+    python benchmarks/bot_scenarios.py [--sizes 1000 10000 50000] [--esi-latency 0.05] [--json results.json]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import namedtuple
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from sqlalchemy import event
+
+from fake_discord import FakeBot, make_guild
+from fake_esi import FakeEsi, CORPORATION_BASE
+
+SERVER_ID = '100000000000000000'
+CHANNEL_ID = '100000000000000001'
+CHARACTER_BASE = 90000000
+DISCORD_BASE = 200000000000000000
+AUTH_CORPORATIONS = 10
+
+Result = namedtuple('Result', ['scenario', 'size', 'wall', 'esi_requests', 'affiliation_requests', 'discord_edits',
+    'discord_messages', 'db_commits', 'loop_stalls', 'loop_stalled'])
+
+def write_config(directory, esi_url, database):
+    authRoles = [{'role_name': 'Corp {}'.format(i), 'corp_id': CORPORATION_BASE + i} for i in range(AUTH_CORPORATIONS)]
+    config = {
+        'SQLALCHEMY_DATABASE_URI': 'sqlite:///' + database,
+        'LOGGING': {'LEVEL': {'ALL': 30, 'CONSOLE': 30, 'FILE': 30}, 'FILE': os.path.join(directory, 'log.txt')},
+        'MAINTAINER': 'benchmark',
+        'ESI': {'BASE_URL': esi_url},
+        'BOT_NOTIFY': {'SOCKET': os.path.join(directory, 'bot.sock')},
+        'DISCORD_WRITES': {'RATE': 1000000, 'PER': 1},
+        'LOOP_MONITOR': {'INTERVAL': 0.05, 'THRESHOLD': 0.02},
+        'METRICS': {'PORT': None},
+        'EVE_CLIENT_ID': '', 'EVE_CLIENT_SECRET': '', 'EVE_CALLBACK_URI': '',
+        'DISCORD_CLIENT_ID': '', 'DISCORD_CLIENT_SECRET': '', 'DISCORD_REDIRECT_URI': '',
+        'DISCORD_TOKEN': '', 'DISCORD_COMMAND_PREFIX': '!', 'DISCORD_DESCRIPTION': '',
+        'DISCORD_SERVER': SERVER_ID, 'DISCORD_SERVER_INVITE': '',
+        'DISCORD_AUTH_ROLES': authRoles,
+        'DISCORD_PRIVATE_COMMAND_CHANNELS': {'RECRUITMENT': CHANNEL_ID},
+        'BASE_AUTH_ROLE': 'Authenticated'
+    }
+    with open(os.path.join(directory, 'config.json'), 'w') as f:
+        json.dump(config, f)
+    return config
+
+class Harness:
+    def __init__(self, botmodule, esi, fake_bot):
+        self.bot = botmodule
+        self.esi = esi
+        self.fake_bot = fake_bot
+        self.commits = 0
+        event.listen(botmodule.db.engine, 'commit', self._commit)
+
+    def _commit(self, connection):
+        self.commits += 1
+
+    def snapshot(self):
+        affiliations = sum(count for (method, endpoint, status), count in self.esi.requests.items() if endpoint == '/characters/affiliation/')
+        stats = self.bot.loop_monitor.stats()
+        return (self.esi.total(), affiliations, self.fake_bot.requests['edit_member'], self.fake_bot.requests['send_message'],
+            self.commits, stats['stalls'], stats['stalled_seconds'])
+
+    async def measure(self, scenario, size, function):
+        before = self.snapshot()
+        start = time.perf_counter()
+        await function()
+        #Include the edits and writes the scenario queued
+        while self.bot.member_edits.pending:
+            await asyncio.sleep(0.01)
+        await self.bot.writes.flush()
+        wall = time.perf_counter() - start
+        after = self.snapshot()
+        delta = [b - a for a, b in zip(before, after)]
+        return Result(scenario, size, wall, *delta)
+
+    def reset(self, size, invalid):
+        db = self.bot.db
+        DiscordUser = self.bot.DiscordUser
+        db.session.remove()
+        db.drop_all()
+        self.bot.migrations.upgrade()
+        now = datetime.datetime.utcnow()
+        rows = []
+        for i in range(size):
+            characterID = CHARACTER_BASE + i
+            corpID = self.esi.corporation_of(characterID)
+            rows.append({'date': now, 'character_name': 'Pilot {}'.format(i), 'character_id': characterID, 'corporation_id': corpID,
+                'alliance_id': self.esi.alliance_of(corpID), 'discord_id': str(DISCORD_BASE + i), 'discord_name': 'user#{}'.format(i),
+                'discord_avatar': None, 'on_server': False})
+        db.session.bulk_insert_mappings(DiscordUser, rows)
+        db.session.commit()
+
+        self.esi.moved.clear()
+        self.esi.invalid = set(random.sample(range(CHARACTER_BASE, CHARACTER_BASE + size), min(invalid, size)))
+        roleNames = ['Authenticated'] + ['Corp {}'.format(i) for i in range(AUTH_CORPORATIONS)] + ['Unmanaged']
+        guild = make_guild(SERVER_ID, size, roleNames, [CHANNEL_ID], [str(DISCORD_BASE + i) for i in range(size)])
+        self.fake_bot.servers = {SERVER_ID: guild}
+        self.bot.guilds.primary.role_index.rebuild(guild)
+        self.bot.invalid_characters.clear()
+        self.bot.tickers._entries.clear()
+        self.bot.sweep_cursor = 0
+
+    async def run(self, size, args):
+        self.reset(size, args.invalid)
+        results = []
+        results.append(await self.measure('join', size, self.bot.update_on_server))
+
+        #Every snapshot expires at once and part of the roster changed corporation
+        db = self.bot.db
+        DiscordUser = self.bot.DiscordUser
+        db.session.query(DiscordUser).update({'affiliation_expires': None}, synchronize_session=False)
+        db.session.commit()
+        self.esi.move(range(CHARACTER_BASE, CHARACTER_BASE + size), args.churn)
+        self.bot.CORP_CHECK_MIN_BATCH = size
+        results.append(await self.measure('sweep', size, self.bot.check_corp))
+
+        #Part of the roster unlinks, like /trapcard does
+        unlinked = random.sample(range(size), int(size * args.unlink))
+        discordIDs = [str(DISCORD_BASE + i) for i in unlinked]
+        for i in range(0, len(discordIDs), 500):
+            db.session.query(DiscordUser).filter(DiscordUser.discord_id.in_(discordIDs[i:i + 500])).delete(synchronize_session=False)
+        db.session.bulk_insert_mappings(self.bot.DiscordLinkRemoval, [{'discord_id': discordID} for discordID in discordIDs])
+        db.session.commit()
+        async def drain():
+            while await self.bot.remove_auth_user_roles():
+                pass
+        results.append(await self.measure('unlink', size, drain))
+        db.session.remove()
+        return results
+
+def print_results(results):
+    header = '{:<8} {:>7} {:>9} {:>8} {:>8} {:>8} {:>8} {:>8} {:>7} {:>9}'
+    row = '{:<8} {:>7} {:>9.2f} {:>8} {:>8} {:>8} {:>8} {:>8} {:>7} {:>9.3f}'
+    print(header.format('scenario', 'members', 'wall s', 'esi', 'affil', 'edits', 'messages', 'commits', 'stalls', 'stalled s'))
+    for r in results:
+        print(row.format(r.scenario, r.size, r.wall, r.esi_requests, r.affiliation_requests, r.discord_edits,
+            r.discord_messages, r.db_commits, r.loop_stalls, r.loop_stalled))
+
+def main():
+    parser = argparse.ArgumentParser(description='Offline benchmark of the bot against a fake ESI and a fake guild')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 50000], help='roster sizes')
+    parser.add_argument('--esi-latency', type=float, default=0.05, help='seconds every ESI response takes')
+    parser.add_argument('--esi-jitter', type=float, default=0.02, help='random extra ESI latency in seconds')
+    parser.add_argument('--esi-error-rate', type=float, default=0.0, help='fraction of ESI requests failing with a 502')
+    parser.add_argument('--esi-expires', type=int, default=3600, help='seconds in the Expires header')
+    parser.add_argument('--discord-latency', type=float, default=0.0, help='seconds every Discord request takes')
+    parser.add_argument('--churn', type=float, default=0.05, help='share of characters that change corporation before the sweep')
+    parser.add_argument('--unlink', type=float, default=0.1, help='share of the roster that unlinks')
+    parser.add_argument('--invalid', type=int, default=5, help='number of characters ESI reports as not existing')
+    parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+    random.seed(args.seed)
+    output = os.path.abspath(args.json) if args.json else None
+
+    loop = asyncio.get_event_loop()
+    esi = FakeEsi(loop, latency=args.esi_latency, jitter=args.esi_jitter, error_rate=args.esi_error_rate, expires=args.esi_expires)
+    esiURL = loop.run_until_complete(esi.start())
+
+    #The bot reads config.json from the working directory when it is imported
+    directory = tempfile.mkdtemp()
+    write_config(directory, esiURL, os.path.join(directory, 'bench.db'))
+    os.chdir(directory)
+    import bot as botmodule
+
+    fakeBot = FakeBot(loop, latency=args.discord_latency)
+    botmodule.bot = fakeBot
+    botmodule.member_edits.bot = fakeBot
+    harness = Harness(botmodule, esi, fakeBot)
+    tasks = [loop.create_task(botmodule.member_edits.run()), loop.create_task(botmodule.writes.run()),
+        loop.create_task(botmodule.loop_monitor.run())]
+
+    results = []
+    try:
+        for size in args.sizes:
+            results.extend(loop.run_until_complete(harness.run(size, args)))
+    finally:
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        botmodule.esi.close()
+        botmodule.repository.close()
+        loop.run_until_complete(esi.stop())
+
+    print_results(results)
+    if output:
+        with open(output, 'w') as f:
+            json.dump([r._asdict() for r in results], f, indent=2)
+
+if __name__ == '__main__':
+    main()
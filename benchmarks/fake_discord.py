@@ -0,0 +1,124 @@
+"""
+Fake Discord guild and bot for the benchmarks.
+Implements the parts of discord.py 0.16 the bot touches: servers with
+members, roles and channels, send_message() and http.edit_member(). Edits
+are applied to the fake members, so a second pass over the same roster
+finds nothing left to change, just like on a real guild.
+"""
+import asyncio
+import random
+
+class FakeRole:
+    def __init__(self, role_id, name, is_everyone=False):
+        self.id = role_id
+        self.name = name
+        self.is_everyone = is_everyone
+
+    def __repr__(self):
+        return 'FakeRole({})'.format(self.name)
+
+class FakeChannel:
+    def __init__(self, channel_id, name):
+        self.id = channel_id
+        self.name = name
+
+class FakeMember:
+    def __init__(self, member_id, name, server, roles):
+        self.id = member_id
+        self.name = name
+        self.nick = None
+        self.server = server
+        self.roles = roles
+
+class FakeServer:
+    """
+    Guild with a synthetic roster
+    Args:
+        server_id (str) - id of the guild
+        role_names (list) - names of the roles besides @everyone
+        channel_ids (list) - ids of the text channels
+    """
+    def __init__(self, server_id, role_names, channel_ids):
+        self.id = server_id
+        self.everyone = FakeRole(server_id, '@everyone', is_everyone=True)
+        self.roles = [self.everyone] + [FakeRole(str(1000 + i), name) for i, name in enumerate(role_names)]
+        self.channels = dict((channelID, FakeChannel(channelID, channelID)) for channelID in channel_ids)
+        self._members = {}
+
+    @property
+    def members(self):
+        return list(self._members.values())
+
+    def add_member(self, member_id, name, roles=()):
+        member = FakeMember(member_id, name, self, [self.everyone] + list(roles))
+        self._members[member_id] = member
+        return member
+
+    def get_member(self, member_id):
+        return self._members.get(member_id)
+
+    def get_channel(self, channel_id):
+        return self.channels.get(channel_id)
+
+class FakeHttp:
+    """
+    Stand-in for discord.py's HTTPClient
+    Args:
+        bot (FakeBot) - bot the requests are counted on
+        latency (float) - seconds every request takes
+    """
+    def __init__(self, bot, latency):
+        self.bot = bot
+        self.latency = latency
+
+    async def edit_member(self, guild_id, user_id, **fields):
+        self.bot.requests['edit_member'] += 1
+        await asyncio.sleep(self.latency)
+        member = self.bot.servers[guild_id].get_member(user_id)
+        if 'nick' in fields:
+            member.nick = fields['nick'] or None
+        if 'roles' in fields:
+            rolesByID = dict((role.id, role) for role in member.server.roles)
+            member.roles = [member.server.everyone] + [rolesByID[roleID] for roleID in fields['roles']]
+
+class FakeBot:
+    """
+    Stand-in for discord.ext.commands.Bot
+    Args:
+        loop (asyncio.AbstractEventLoop) - loop the bot runs on
+        latency (float) - seconds every Discord request takes
+    """
+    def __init__(self, loop, latency=0.0):
+        self.loop = loop
+        self.servers = {}
+        self.requests = {'edit_member': 0, 'send_message': 0}
+        self.http = FakeHttp(self, latency)
+
+    def get_server(self, server_id):
+        return self.servers.get(server_id)
+
+    async def wait_until_ready(self):
+        return
+
+    async def send_message(self, channel, content):
+        self.requests['send_message'] += 1
+        await asyncio.sleep(self.http.latency)
+
+def make_guild(server_id, size, role_names, channel_ids, discord_ids):
+    """
+    Builds a guild with a synthetic roster
+    Args:
+        server_id (str) - id of the guild
+        size (int) - number of members
+        role_names (list) - names of the roles besides @everyone
+        channel_ids (list) - ids of the text channels
+        discord_ids (list) - ids to give the members, in order
+    Returns:
+        FakeServer
+    """
+    server = FakeServer(server_id, role_names, channel_ids)
+    unmanaged = [role for role in server.roles if role.name.startswith('Unmanaged')]
+    for i in range(size):
+        #A few members carry roles the bot must leave alone
+        server.add_member(discord_ids[i], 'user{}'.format(i), unmanaged if unmanaged and random.random() < 0.1 else ())
+    return server
@@ -0,0 +1,181 @@
+"""
+Local stand-in for the ESI endpoints the bot uses.
+Serves /characters/affiliation/, /characters/{id}/, /corporations/{id}/
+and /alliances/{id}/ with a deterministic universe of characters,
+corporations and alliances. Latency, server errors, invalid characters and
+the Expires header are configurable, and every request is counted.
+"""
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+from email.utils import formatdate
+
+from aiohttp import web
+
+CORPORATION_BASE = 98000000
+ALLIANCE_BASE = 99000000
+
+class FakeEsi:
+    """
+    In-process ESI server
+    Args:
+        loop (asyncio.AbstractEventLoop) - loop to serve on
+        corporations (int) - number of corporations characters are spread over
+        alliances (int) - number of alliances, every third corporation is in none
+        latency (float) - seconds every response is delayed
+        jitter (float) - random extra delay of up to this many seconds
+        error_rate (float) - fraction of requests answered with a 502
+        expires (int) - seconds in the Expires header
+        error_limit (int) - errors allowed per window, reported in the X-Esi-Error-Limit headers
+    """
+    def __init__(self, loop, corporations=200, alliances=20, latency=0.05, jitter=0.02, error_rate=0.0, expires=3600, error_limit=100):
+        self.loop = loop
+        self.corporations = corporations
+        self.alliances = alliances
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.expires = expires
+        self.error_limit = error_limit
+        self.invalid = set()
+        self.moved = {}
+        self.requests = Counter()
+        self.errors = 0
+        self._window = time.monotonic()
+        self._handler = None
+        self._server = None
+        self.app = web.Application(loop=loop)
+        self.app.router.add_route('POST', '/characters/affiliation/', self.affiliation)
+        self.app.router.add_route('GET', '/characters/{id}/', self.character)
+        self.app.router.add_route('GET', '/corporations/{id}/', self.corporation)
+        self.app.router.add_route('GET', '/alliances/{id}/', self.alliance)
+
+    async def start(self, host='127.0.0.1', port=0):
+        """
+        Starts serving
+        Args:
+            host (str) - address to bind
+            port (int) - port to bind, 0 picks a free one
+        Returns:
+            str: base URL of the server
+        """
+        self._handler = self.app.make_handler()
+        self._server = await self.loop.create_server(self._handler, host, port)
+        return 'http://{}:{}'.format(host, self._server.sockets[0].getsockname()[1])
+
+    async def stop(self):
+        self._server.close()
+        await self._server.wait_closed()
+        await self.app.shutdown()
+        await self._handler.finish_connections(1.0)
+        await self.app.cleanup()
+
+    def total(self):
+        return sum(self.requests.values())
+
+    def corporation_of(self, character_id):
+        """
+        Returns the corporation a character is currently in
+        Args:
+            character_id (int) - id of the character
+        Returns:
+            int: id of the corporation
+        """
+        if character_id in self.moved:
+            return self.moved[character_id]
+        return CORPORATION_BASE + character_id % self.corporations
+
+    def alliance_of(self, corporation_id):
+        """
+        Returns the alliance of a corporation
+        Args:
+            corporation_id (int) - id of the corporation
+        Returns:
+            int: id of the alliance, None if the corporation is not in one
+        """
+        if corporation_id % 3 == 0:
+            return None
+        return ALLIANCE_BASE + corporation_id % self.alliances
+
+    def move(self, character_ids, fraction):
+        """
+        Moves a random share of characters to another corporation
+        Args:
+            character_ids (list) - characters to pick from
+            fraction (float) - share of them that moves
+        Returns:
+            int: number of characters moved
+        """
+        moved = random.sample(list(character_ids), int(len(character_ids) * fraction))
+        for characterID in moved:
+            self.moved[characterID] = CORPORATION_BASE + (self.corporation_of(characterID) - CORPORATION_BASE + 1) % self.corporations
+        return len(moved)
+
+    async def _respond(self, request, endpoint, build):
+        await asyncio.sleep(self.latency + random.uniform(0, self.jitter))
+        if time.monotonic() - self._window > 60:
+            self._window = time.monotonic()
+            self.errors = 0
+        headers = {
+            'Expires': formatdate(time.time() + self.expires, usegmt=True),
+            'X-Esi-Error-Limit-Reset': str(max(1, int(60 - (time.monotonic() - self._window))))
+        }
+        if self.error_rate and random.random() < self.error_rate:
+            status, body = 502, {'error': 'Bad gateway'}
+        else:
+            status, body, etag = await build(request)
+            if etag is not None:
+                headers['ETag'] = etag
+                if request.headers.get('If-None-Match') == etag:
+                    status, body = 304, None
+        if status >= 400:
+            self.errors += 1
+        headers['X-Esi-Error-Limit-Remain'] = str(max(0, self.error_limit - self.errors))
+        self.requests[(request.method, endpoint, status)] += 1
+        if body is None:
+            return web.Response(status=status, headers=headers)
+        return web.Response(status=status, text=json.dumps(body), content_type='application/json', headers=headers)
+
+    async def affiliation(self, request):
+        async def build(request):
+            ids = await request.json()
+            if len(ids) > 1000 or any(characterID in self.invalid for characterID in ids):
+                return 404, {'error': 'Invalid character ID'}, None
+            result = []
+            for characterID in ids:
+                corpID = self.corporation_of(characterID)
+                entry = {'character_id': characterID, 'corporation_id': corpID}
+                if self.alliance_of(corpID) is not None:
+                    entry['alliance_id'] = self.alliance_of(corpID)
+                result.append(entry)
+            return 200, result, None
+        return await self._respond(request, '/characters/affiliation/', build)
+
+    async def character(self, request):
+        async def build(request):
+            characterID = int(request.match_info['id'])
+            if characterID in self.invalid:
+                return 404, {'error': 'Character not found'}, None
+            corpID = self.corporation_of(characterID)
+            body = {'name': 'Pilot {}'.format(characterID), 'corporation_id': corpID}
+            if self.alliance_of(corpID) is not None:
+                body['alliance_id'] = self.alliance_of(corpID)
+            return 200, body, None
+        return await self._respond(request, '/characters/{id}/', build)
+
+    async def corporation(self, request):
+        async def build(request):
+            corpID = int(request.match_info['id'])
+            body = {'name': 'Corporation {}'.format(corpID), 'ticker': 'C{}'.format(corpID % 100000)}
+            if self.alliance_of(corpID) is not None:
+                body['alliance_id'] = self.alliance_of(corpID)
+            return 200, body, '"corporation-{}"'.format(corpID)
+        return await self._respond(request, '/corporations/{id}/', build)
+
+    async def alliance(self, request):
+        async def build(request):
+            allianceID = int(request.match_info['id'])
+            return 200, {'name': 'Alliance {}'.format(allianceID), 'ticker': 'A{}'.format(allianceID % 100000)}, '"alliance-{}"'.format(allianceID)
+        return await self._respond(request, '/alliances/{id}/', build)
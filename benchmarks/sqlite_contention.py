@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+"""
+Measures SQLite write contention between the web app and the bot.
+Writer threads link and unlink users one commit at a time, like the /link
+and /trapcard routes, while a sweep thread reads the on-server roster and
+writes it back in one transaction, like the bot's corp check. Every storage
+profile runs against a fresh database file and reports throughput, latency
+and 'database is locked' errors.
+
+Usage:
+    python benchmarks/sqlite_contention.py [--duration 10] [--writers 4] [--rows 5000]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from sqlalchemy import create_engine
+from sqlalchemy.exc import OperationalError
+
+from storage import DEFAULT_PROFILE, configure_engine, engine_options
+
+PROFILES = {
+    'rollback-journal': {'JOURNAL_MODE': 'DELETE', 'BUSY_TIMEOUT': None, 'SYNCHRONOUS': 'FULL', 'CACHE_SIZE': None},
+    'wal': DEFAULT_PROFILE,
+}
+
+SCHEMA = [
+    'CREATE TABLE discord_users (id INTEGER PRIMARY KEY, date DATETIME NOT NULL, character_name VARCHAR UNIQUE NOT NULL, '
+    'character_id INTEGER UNIQUE NOT NULL, corporation_id INTEGER NOT NULL, alliance_id INTEGER, discord_id VARCHAR UNIQUE NOT NULL, '
+    'discord_name VARCHAR UNIQUE NOT NULL, discord_avatar VARCHAR, on_server BOOLEAN NOT NULL, '
+    'affiliation_checked DATETIME, affiliation_expires DATETIME)',
+    'CREATE TABLE discord_link_removal (discord_id VARCHAR PRIMARY KEY NOT NULL)',
+]
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = []
+        self.locked = 0
+        self.sweeps = 0
+
+    def record(self, seconds):
+        with self.lock:
+            self.latencies.append(seconds)
+
+    def error(self):
+        with self.lock:
+            self.locked += 1
+
+    def percentile(self, p):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+def make_engine(path, profile):
+    engine = create_engine('sqlite:///' + path, **engine_options(profile))
+    configure_engine(engine, profile)
+    return engine
+
+def populate(engine, rows):
+    with engine.begin() as connection:
+        for statement in SCHEMA:
+            connection.execute(statement)
+        connection.execute('INSERT INTO discord_users (date, character_name, character_id, corporation_id, discord_id, discord_name, on_server) '
+            'VALUES (CURRENT_TIMESTAMP, ?, ?, ?, ?, ?, 1)',
+            [('Character {}'.format(i), i, 1000 + i % 50, str(i), 'user{}'.format(i)) for i in range(rows)])
+
+def writer(engine, stats, stop, offset):
+    counter = 0
+    while not stop.is_set():
+        counter += 1
+        characterID = offset * 10 ** 7 + counter
+        start = time.perf_counter()
+        try:
+            #Link, then unlink, each with its own commit
+            with engine.begin() as connection:
+                connection.execute('INSERT INTO discord_users (date, character_name, character_id, corporation_id, discord_id, discord_name, on_server) '
+                    'VALUES (CURRENT_TIMESTAMP, ?, ?, 1, ?, ?, 0)', ('Link {}'.format(characterID), characterID, 'l{}'.format(characterID), 'l{}'.format(characterID)))
+            stats.record(time.perf_counter() - start)
+            start = time.perf_counter()
+            with engine.begin() as connection:
+                connection.execute('DELETE FROM discord_users WHERE character_id = ?', (characterID,))
+                connection.execute('INSERT OR IGNORE INTO discord_link_removal (discord_id) VALUES (?)', ('l{}'.format(characterID),))
+            stats.record(time.perf_counter() - start)
+        except OperationalError as e:
+            if 'locked' not in str(e):
+                raise
+            stats.error()
+
+def sweeper(engine, stats, stop, interval):
+    while not stop.is_set():
+        try:
+            with engine.begin() as connection:
+                rows = connection.execute('SELECT id, corporation_id FROM discord_users WHERE on_server = 1').fetchall()
+                connection.execute('UPDATE discord_users SET corporation_id = ?, affiliation_checked = CURRENT_TIMESTAMP WHERE id = ?',
+                    [(row[1] + random.randint(0, 1), row[0]) for row in rows])
+                connection.execute('DELETE FROM discord_link_removal')
+            stats.sweeps += 1
+        except OperationalError as e:
+            if 'locked' not in str(e):
+                raise
+            stats.error()
+        stop.wait(interval)
+
+def run_profile(name, profile, args):
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'contention.db')
+    engine = make_engine(path, profile)
+    populate(engine, args.rows)
+
+    stats = Stats()
+    stop = threading.Event()
+    threads = [threading.Thread(target=writer, args=(engine, stats, stop, i)) for i in range(args.writers)]
+    threads.append(threading.Thread(target=sweeper, args=(engine, stats, stop, args.sweep_interval)))
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+
+    print('{:<18} {:>10.1f} {:>10.2f} {:>10.2f} {:>8d} {:>8d}'.format(name, len(stats.latencies) / args.duration,
+        stats.percentile(0.5) * 1000, stats.percentile(0.99) * 1000, stats.locked, stats.sweeps))
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    os.rmdir(directory)
+
+def main():
+    parser = argparse.ArgumentParser(description='SQLite write contention between link/unlink writes and a sweep')
+    parser.add_argument('--duration', type=float, default=10, help='seconds per profile')
+    parser.add_argument('--writers', type=int, default=4, help='concurrent link/unlink threads')
+    parser.add_argument('--rows', type=int, default=5000, help='users in the roster')
+    parser.add_argument('--sweep-interval', type=float, default=0.5, help='seconds between sweeps')
+    parser.add_argument('--profile', choices=sorted(PROFILES), action='append', help='profiles to run, default all')
+    args = parser.parse_args()
+
+    print('{:<18} {:>10} {:>10} {:>10} {:>8} {:>8}'.format('profile', 'writes/s', 'p50 ms', 'p99 ms', 'locked', 'sweeps'))
+    for name in args.profile or sorted(PROFILES):
+        run_profile(name, PROFILES[name], args)
+
+if __name__ == '__main__':
+    main()
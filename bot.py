@@ -1,22 +1,34 @@
 import logging
 import time
-import requests
 import datetime
 import asyncio
 import json
 import sys
+import math
 
 import discord
 from discord.ext import commands
 
-from app import db
 from app import app
 from models import *
+from esi import EsiClient, EsiError
+from tickers import TickerCache
+from invalids import InvalidCharacterCache
+from notify import NotificationListener, UNLINK, LINK, REFRESH
+from guilds import GuildRegistry
+import reconcile
+import migrations
+from writes import WriteBuffer
+from repository import BotRepository
+from monitor import LoopMonitor
+from joins import JoinBatcher
+from profiling import CycleProfiler, NO_TRACE
+from metrics import REGISTRY, Counter, Gauge, Histogram, serve as serve_metrics
+from scheduler import MemberEditScheduler, PRIORITY_JOIN, PRIORITY_UNLINK, PRIORITY_SWEEP, EDIT_FAILED, EDIT_REJECTED
 import sqlite3
 
 DISCORD_BOT_AUTH_SLEEP = 60
 DATABASE_MEMBER_UPDATE = 60
-CHUNK_SIZE = 20
 
 # config setup
 with open('config.json') as f:
@@ -25,6 +37,62 @@ with open('config.json') as f:
 # bot setup
 app.logger.info('Creating bot object ...')
 bot = commands.Bot(command_prefix=config['DISCORD_COMMAND_PREFIX'], description=config['DISCORD_DESCRIPTION'])
+esi = EsiClient.from_config(config, loop=bot.loop)
+repository = BotRepository.from_config(config, loop=bot.loop)
+loop_monitor = LoopMonitor.from_config(config, loop=bot.loop)
+profiler = CycleProfiler.from_config(config)
+#Renicks are defined further down, look the handler up when a ticker changes
+tickers = TickerCache.from_config(esi, repository, config, on_change=lambda *change: schedule_renick(*change))
+guilds = GuildRegistry.from_config(config)
+member_edits = MemberEditScheduler.from_config(bot, config)
+writes = WriteBuffer.from_config(repository, config)
+#Joins are defined further down, look the handler up when a batch is ready
+joins = JoinBatcher.from_config(lambda members: handle_join_batch(members), config)
+notifications = NotificationListener(config.get('BOT_NOTIFY', {}).get('SOCKET', 'bot.sock'), loop=bot.loop)
+UNLINK_FALLBACK_POLL = config.get('BOT_NOTIFY', {}).get('UNLINK_FALLBACK_POLL', 300)
+UNLINK_BATCH_SIZE = config.get('BOT_NOTIFY', {}).get('UNLINK_BATCH_SIZE', 100)
+UNLINK_MAX_ATTEMPTS = config.get('BOT_NOTIFY', {}).get('UNLINK_MAX_ATTEMPTS', 5)
+UNLINK_RETRY_DELAY = config.get('BOT_NOTIFY', {}).get('UNLINK_RETRY_DELAY', 30)
+CORP_CHECK_INTERVAL = config.get('CORP_CHECK', {}).get('INTERVAL', 3600)
+CORP_CHECK_MIN_BATCH = config.get('CORP_CHECK', {}).get('MIN_BATCH', 20)
+CORP_CHECK_PURGE_INVALID = config.get('CORP_CHECK', {}).get('PURGE_INVALID', False)
+CORP_CHECK_INVALID_RECHECK = config.get('CORP_CHECK', {}).get('INVALID_RECHECK', 7 * 24 * 3600)
+LINK_BATCH_SIZE = config.get('LINK_QUEUE', {}).get('BATCH_SIZE', 100)
+LINK_MAX_ATTEMPTS = config.get('LINK_QUEUE', {}).get('MAX_ATTEMPTS', 5)
+LINK_RETRY_DELAY = config.get('LINK_QUEUE', {}).get('RETRY_DELAY', 5)
+#With sweep workers the bot only applies the affiliation changes they find
+SWEEP_WORKERS = config.get('SWEEP_WORKERS', {}).get('ENABLED', False)
+REFRESH_BATCH_SIZE = config.get('SWEEP_WORKERS', {}).get('REFRESH_BATCH_SIZE', 100)
+TICKER_REFRESH_INTERVAL = config.get('TICKER_CACHE', {}).get('REFRESH_INTERVAL', 600)
+METRICS_HOST = config.get('METRICS', {}).get('HOST', '127.0.0.1')
+METRICS_PORT = config.get('METRICS', {}).get('PORT', 9101)
+metrics_server = None
+#Characters ESI reported as no longer existing, they are only checked again once their entry expires
+invalid_characters = InvalidCharacterCache.from_config(esi, repository, config)
+sweep_cursor = 0
+
+CORP_CHECK_SECONDS = Histogram('corp_check_seconds', 'Duration of a corp check cycle')
+CORP_CHECK_MEMBERS = Counter('corp_check_members_total', 'Members handled by the corp check, by outcome', ('outcome',))
+CORP_CHECK_ESI_REQUESTS = Gauge('corp_check_esi_requests', 'ESI requests sent while the last corp check ran')
+QUEUE_DEPTH = Gauge('bot_queue_depth', 'Work waiting in the bot, by queue', ('queue',))
+BOT_STATS = Gauge('bot_stats', 'Counters and levels reported by the bot components', ('component', 'stat'))
+
+@REGISTRY.collector
+def collect_metrics():
+    #Only runs when the metrics are scraped
+    stats = member_edits.stats()
+    for lane in ('join', 'unlink', 'sweep'):
+        QUEUE_DEPTH.set(stats[lane], ('member_edits_' + lane,))
+    QUEUE_DEPTH.set(len(writes), ('writes',))
+    QUEUE_DEPTH.set(len(joins), ('joins',))
+    for component, stats in (('member_edits', stats), ('event_loop', loop_monitor.stats()), ('esi', esi.stats()),
+            ('joins', joins.stats()), ('tickers', tickers.stats()), ('invalid_characters', invalid_characters.stats()),
+            ('profiling', profiler.stats())):
+        for stat, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                BOT_STATS.set(value, (component, stat))
+    BOT_STATS.set(1 if esi.retry_after() else 0, ('esi', 'circuit_open'))
+
 app.logger.info('Setup complete')
 
 @bot.event
@@ -32,12 +100,32 @@ async def on_ready():
     app.logger.info('Logged in')
     await bot.change_presence(game=discord.Game(name='Auth stuff'))
     #Do some more checks
-    server = bot.get_server(config['DISCORD_SERVER'])
-    if server is None:
-        app.logger.error("Server " + config['DISCORD_SERVER'] + " not found!")
-    channel = server.get_channel(config['DISCORD_PRIVATE_COMMAND_CHANNELS']['RECRUITMENT'])
-    if channel is None:
-        app.logger.error("Channel " + config['DISCORD_PRIVATE_COMMAND_CHANNELS']['RECRUITMENT]'] + " not found!")
+    for guild in guilds:
+        server = bot.get_server(guild.server_id)
+        if server is None:
+            app.logger.error("Server %s not found!", guild.server_id)
+            continue
+        channel = server.get_channel(guild.recruitment_channel_id)
+        if channel is None:
+            app.logger.error("Channel %s not found!", guild.recruitment_channel_id)
+        guild.role_index.rebuild(server)
+
+def rebuild_roles(server):
+    guild = guilds.get(server.id)
+    if guild is not None:
+        guild.role_index.rebuild(server)
+
+@bot.event
+async def on_server_role_create(role):
+    rebuild_roles(role.server)
+
+@bot.event
+async def on_server_role_delete(role):
+    rebuild_roles(role.server)
+
+@bot.event
+async def on_server_role_update(before, after):
+    rebuild_roles(after.server)
 
 @bot.event
 async def on_message(message):
@@ -52,9 +140,9 @@ async def on_message(message):
         if message.author == bot.user:
             return
         if message.content.startswith(config['DISCORD_COMMAND_PREFIX']):
-            app.logger.info('Command "{}" from "{}" in "{}"'.format(message.content, message.author.name, message.channel.name))
+            app.logger.info('Command "%s" from "%s" in "%s"', message.content, message.author.name, message.channel.name)
         if 'bot' in message.content.lower():
-            app.logger.info('Bot in message: "{}" by "{}" in "{}"'.format(message.content, message.author.name, message.channel.name))
+            app.logger.info('Bot in message: "%s" by "%s" in "%s"', message.content, message.author.name, message.channel.name)
         await bot.process_commands(message)
     except Exception as e:
         app.logger.error('Exception in on_message(): ' + str(e))
@@ -68,15 +156,17 @@ async def on_member_remove(member):
     Returns:
         None
     """
-    server = bot.get_server(config['DISCORD_SERVER'])
-    channel = server.get_channel(config['DISCORD_PRIVATE_COMMAND_CHANNELS']['RECRUITMENT'])
+    guild = guilds.get(member.server.id)
+    if guild is None:
+        return
+    channel = member.server.get_channel(guild.recruitment_channel_id)
 
     #Query the database to see if they're in there
-    discordQuery = DiscordUser.query.filter(DiscordUser.discord_id == member.id).first()
+    discordQuery = await repository.get_user_by_discord_id(member.id)
     if discordQuery is not None:
-        #Update that they are on the server
-        discordQuery.on_server = False
-        db.session.commit()
+        #Update that they are on the server, unless they are still on another one
+        if not guilds.memberships(bot, member.id):
+            writes.update(DiscordUser, discordQuery.id, on_server=False)
 
         await bot.send_message(channel,"User " + member.name + " ("+ discordQuery.character_name +") left the server!")
     else:
@@ -85,345 +175,558 @@ async def on_member_remove(member):
 @bot.event
 async def on_member_join(member):
     """
-    Event when user joins the server
+    Event when user joins the server, handled with the others joining around the same time
     Args:
         member (discord.Member) - member that joined the server
     Returns:
         None
     """
-    server = bot.get_server(config['DISCORD_SERVER'])
-    if server is None:
-        app.logger.error("Server " + config['DISCORD_SERVER'] + " not found!")
-        return
-    channel = server.get_channel(config['DISCORD_PRIVATE_COMMAND_CHANNELS']['RECRUITMENT'])
-    if channel is None:
-        app.logger.error("Channel " + config['DISCORD_PRIVATE_COMMAND_CHANNELS']['RECRUITMENT]'] + " not found!")
+    joins.add(member)
+
+async def handle_join_batch(members):
+    """
+    Handles a batch of joins collected by the join batcher
+    Args:
+        members (list) - discord.Member objects that joined the server
+    Returns:
+        None
+    """
+    if len(members) > 1:
+        app.logger.info("Handling %s members that joined together", len(members))
+    with profiler.cycle('join_batch') as trace:
+        trace.annotate(members=len(members))
+        await handle_member_joins(members, trace=trace)
+        #One commit for the whole batch, so update_on_server sees them right away
+        with trace.span('commit'):
+            await writes.flush()
+
+async def handle_member_joins(members, users=None, trace=NO_TRACE):
+    """
+    Gives a batch of members that joined a server their nickname and roles.
+    The members may have joined different servers. Affiliations and tickers
+    are resolved once per character for the whole batch and the database is
+    committed once.
+    Args:
+        members (list) - discord.Member objects that joined a server
+        users (dict) - DiscordUser rows keyed by discord_id, queried if not given
+        trace (profiling.Trace) - trace the phases are recorded on
+    Returns:
+        None
+    """
+    channels = {}
+    for guild, server in guilds.servers(bot):
+        channel = server.get_channel(guild.recruitment_channel_id)
+        if channel is None:
+            app.logger.error("Channel %s not found!", guild.recruitment_channel_id)
+            continue
+        guild.role_index.ensure(server)
+        channels[server.id] = channel
+    members = [member for member in members if member.server.id in channels]
+    if not members:
         return
 
     #Query the database to see if they're in there
-    discordQuery = DiscordUser.query.filter(DiscordUser.discord_id == member.id).first()
-    if discordQuery is not None:
-        #If they are, give them the appropriate roles and update their roles
-        #Update corp / alliance
-        app.logger.info("Making ESI post request to characters/affiliation endpoint for character id "+str(discordQuery.character_id))
-        r = requests.post("https://esi.tech.ccp.is/latest/characters/affiliation/?datasource=tranquility", json=[discordQuery.character_id],
-            headers = {'Content-Type': 'application/json', 'Accept':'application/json','User-Agent': 'Maintainer: ' + config['MAINTAINER']})
-        result = r.json()
-        if not result:
-            error = "Character ID " + discordQuery.character_id + " is not valid! Message a mentor!"
-            app.logger.error(error)
-            await bot.send_message(channel, error)
-            return
-        if 'error' in result:
-                #Make different endpoint check
-                app.logger.info("ESI Post failed, using names endpoint instead")
-                r = requests.get("https://esi.tech.ccp.is/latest/characters/" + str(discordQuery.character_id) + "/?datasource=tranquility", headers={
-                    'User-Agent': 'Maintainer: '+ config['MAINTAINER']
-                     })
-                result = r.json()
-                if not result:
-                        error = "Character ID " + str(discordQuery.character_id) + " is not valid! Message a mentor!"
-                        flash(error, 'error')
-                        return redirect(url_for('login')) 
-                data = result
-        else:
-                data = result[0]
-
-        #Update corp and alliance in json
-        alliance_id = None
-        corp_id = data['corporation_id']
-        ticker = ""
-        if 'alliance_id' in data:
-            alliance_id = data['alliance_id']
-            r = requests.get("https://esi.tech.ccp.is/latest/alliances/" + str(alliance_id) + "/?datasource=tranquility", headers={
-                'User-Agent': 'Maintainer: ' + config['MAINTAINER']})
-            ticker = r.json()['ticker']
-        else:
-            r = requests.get("https://esi.tech.ccp.is/latest/corporations/" + str(corp_id) + "/?datasource=tranquility", headers={
-                'User-Agent': 'Maintainer: ' + config['MAINTAINER']})
-            ticker = r.json()['ticker']
-
-        discordQuery.corporation_id = corp_id
-        discordQuery.alliance_id = alliance_id
-        discordQuery.on_server = True
-        db.session.commit()
-
-        nick = "[" + ticker + "] " + discordQuery.character_name
-        if len(nick) > 32:
-             temp = nick.split(" ")
-             nick = temp [0] + " " + temp [1] + " "
-             if len(temp) <= 2:
-                 nick = "LONG USERNAME"
-             for i in range(2,len(temp)):
-                 nick += temp[i].title()[0] + "."
-        await bot.send_message(channel,"User " + member.name + " joined the server as " + nick)
-        try:
-            app.logger.info("Giving " + member.name + " the nickname " + nick + "!")
-            await bot.change_nickname(member,nick)
-        except Exception as e:
-            app.logger.error('Exception in change_nickname(): ' + str(e))
-
-
-        #Update roles if they're in a certain corp
-        rolesToGive = []
-
-        #Update auth role
-        authRole = discord.utils.get(server.roles,name=config['BASE_AUTH_ROLE'])
-        if authRole is None:
-            app.logger.error("Role " + config['BASE_AUTH_ROLE'] + " not found!")
-        else:
-            rolesToGive.append(authRole)
+    if users is None:
+        with trace.span('db_read'):
+            users = await repository.get_users_by_discord_id(set(member.id for member in members))
+    authenticated = [member for member in members if member.id in users]
+    with trace.span('discord_writes'):
+        for member in members:
+            if member.id not in users:
+                await bot.send_message(channels[member.server.id],"User " + member.name + " joined the server without authentication!")
+    if not authenticated:
+        return
 
-        for entry in config['DISCORD_AUTH_ROLES']:
-            role = discord.utils.get(server.roles, name=entry['role_name'])
-            if role is None:
-                app.logger.error("Role " + entry['role_name'] + " not found!")
-                continue
-            if entry['corp_id'] == corp_id:
-                if role not in member.roles:
-                    app.logger.info("Giving " + member.name + " the " + role.name + " role!")
-                    rolesToGive.append(role)
+    #Update corp / alliance, once per character however many servers they joined
+    linked = dict((member.id, users[member.id]) for member in authenticated)
+    app.logger.info("Making ESI post request to characters/affiliation endpoint for %s characters", len(linked))
+    with trace.span('affiliations'):
+        affiliations = await lookup_affiliations({discordQuery.character_id for discordQuery in linked.values()})
 
-        #Apply roles
-        if len(rolesToGive) > 0:
-            try:
-                await bot.add_roles(member,*rolesToGive)
-            except Exception as e:
-                app.logger.error('Exception in add_roles(): ' + str(e))
-    else:
-        await bot.send_message(channel,"User " + member.name + " joined the server without authentication!")
+    async def resolve(discordQuery):
+        data = affiliations.get(discordQuery.character_id)
+        if data is None:
+            return None
+        try:
+            ticker = await tickers.get_ticker(data.corporation_id, data.alliance_id)
+        except EsiError as e:
+            app.logger.error('Exception in get_ticker(): ' + str(e))
+            return None
+        return (data, ticker)
+
+    #The lookups run concurrently, so they are timed together
+    with trace.span('tickers'):
+        resolved = dict(zip(linked, await asyncio.gather(*[resolve(discordQuery) for discordQuery in linked.values()])))
+
+    #Update corp and alliance
+    now = datetime.datetime.utcnow()
+    for discordID, result in resolved.items():
+        if result is not None:
+            data, ticker = result
+            writes.update(DiscordUser, linked[discordID].id, corporation_id=data.corporation_id, alliance_id=data.alliance_id,
+                on_server=True, affiliation_checked=now, affiliation_expires=data.expires)
+
+    for member in authenticated:
+        discordQuery = linked[member.id]
+        channel = channels[member.server.id]
+        if resolved[member.id] is None:
+            if discordQuery.character_id in invalid_characters:
+                error = "Character ID " + str(discordQuery.character_id) + " is not valid! Message a mentor!"
+                app.logger.error(error)
+                await bot.send_message(channel, error)
+            else:
+                #Left off the server list, so the next update_on_server pass tries again
+                app.logger.warning("Affiliation of character ID %s could not be looked up", discordQuery.character_id)
+            continue
+        data, ticker = resolved[member.id]
+        with trace.span('diff'):
+            desired = reconcile.desired_state(discordQuery.character_name, ticker, data.corporation_id,
+                guilds.get(member.server.id).role_index)
+        with trace.span('discord_writes'):
+            await bot.send_message(channel,"User " + member.name + " joined the server as " + desired.nick)
+        member_edits.submit(member, desired, PRIORITY_JOIN)
+    trace.annotate(authenticated=len(authenticated), characters=len(linked),
+        resolved=sum(1 for result in resolved.values() if result is not None))
+
+async def lookup_affiliations(characterIDs):
+    """
+    Looks up affiliations, skipping characters known to no longer exist.
+    Characters ESI confirms as not existing are added to the negative cache
+    and stored, they are checked again once their entry expires.
+    Args:
+        characterIDs (set) - character ids to look up
+    Returns:
+        dict: esi.Affiliation keyed by character_id
+    """
+    return await invalid_characters.lookup(characterIDs)
 
 async def schedule_corp_update():
     while True:
         try:
-            app.logger.info('Sleeping for {} seconds'.format(DISCORD_BOT_AUTH_SLEEP))
+            app.logger.info('Sleeping for %s seconds', DISCORD_BOT_AUTH_SLEEP)
             await asyncio.sleep(DISCORD_BOT_AUTH_SLEEP)
             app.logger.info('Updating discord names')
-            result = await check_corp()
+            sent = esi.sent
+            with profiler.cycle('corp_check') as trace, CORP_CHECK_SECONDS.time():
+                result = await check_corp(trace)
+                trace.annotate(esi_requests=esi.sent - sent)
+            CORP_CHECK_ESI_REQUESTS.set(esi.sent - sent)
             app.logger.info(result) 
+            app.logger.info('Member edits: %(sent)s sent, %(skipped)s skipped, %(coalesced)s coalesced, %(failed)s failed, %(rate_limited)s rate limited; queued %(join)s join, %(unlink)s unlink, %(sweep)s sweep', member_edits.stats())
+            app.logger.info('Event loop: %(stalls)s stalls, %(stalled_seconds).3f seconds blocked, longest %(max_stall).3f seconds', loop_monitor.stats())
+            app.logger.info('ESI: limit %(limit)s, %(in_flight)s in flight, %(backoffs)s backoffs, %(retried)s retries, %(deferred)s deferred, circuit %(circuit)s (opened %(opened)s times, %(rejected)s refused), error limit %(error_limit_remain)s', esi.stats())
+            app.logger.info('Joins: %(batches)s batches, %(members)s members, largest %(largest)s, longest wait %(max_wait).3f seconds', joins.stats())
+            app.logger.info('Ticker cache: %(hits)s hits, %(misses)s misses, %(revalidations)s revalidations, %(evictions)s evictions, %(size)s entries', tickers.stats())
         except Exception as e:
             app.logger.error('Exception in schedule_corp_update(): ' + str(e))
 
-async def check_corp():
-    #Retrieve members in database
-    server = bot.get_server(config['DISCORD_SERVER'])                 
-    data = DiscordUser.query.filter(DiscordUser.on_server == True).all()
-
-    #Sort the data since the return from esi is sorted too
-    currentIndex = 0
-    sortedData = sorted(data,key=lambda x:x.character_id)
-
-    #Break the data into chunks, since ESI has a max amount of characters per post request
-    while currentIndex < len(sortedData):
-        tempList = []
-        tempIndex = 0
-        while tempIndex < CHUNK_SIZE:
-            tempList.append(sortedData[currentIndex])
-            tempIndex+=1
-            currentIndex+=1
-            if currentIndex >= len(sortedData):
-                break 
-        charIDList = [row.character_id for row in tempList]
-        #Check corp and alliance
-        app.logger.info("Making ESI post request to characters/affiliation endpoint")
-        r = requests.post("https://esi.tech.ccp.is/latest/characters/affiliation/?datasource=tranquility", json=charIDList,
-            headers = {'Content-Type': 'application/json', 'Accept':'application/json','User-Agent': 'Maintainer: ' + config['MAINTAINER']})
-        d = r.json()
-        if 'error' not in d:
-            sortedJSON = sorted(d,key=lambda x:x['character_id'])
-        else:
-            app.logger.info("ESI post request returned an error. Going over every character individually")
-            sortedJSON = []
-            #Fill up sortedJSON with manually entered values
-            for char in charIDList:
-                app.logger.info("Making request to " + "https://esi.tech.ccp.is/latest/characters/" + str(char) + "/?datasource=tranquility")
-                rChar = requests.get("https://esi.tech.ccp.is/latest/characters/" + str(char) + "/?datasource=tranquility", headers={
-                    'User-Agent': 'Maintainer: '+ config['MAINTAINER']
-                    })
-                returnData = rChar.json()
-                if 'error' not in returnData:
-                    jsonObject = {}
-                    if 'alliance_id' in returnData:
-                        jsonObject["alliance_id"] = returnData['alliance_id']
-                    jsonObject["corporation_id"] = returnData['corporation_id']
-                    jsonObject["character_id"] = char
-                    jsonData = json.dumps(jsonObject)
-                    sortedJSON.append(jsonObject)
-        #Incase of a missmatch, remove the non-existant character IDs
-        while len(sortedJSON) is not len(tempList):
-            app.logger.info("Number of characters in database does not match the amount of returned characters in ESI. Checking which character is no longer valid")
-            invalidList = []
-            for char in charIDList:
-                app.logger.info("Checking if " + str(char) + " still exists...")
-                rChar = requests.get("https://esi.tech.ccp.is/latest/characters/" + str(char) + "/?datasource=tranquility", headers={
-                    'User-Agent': 'Maintainer: '+ config['MAINTAINER']
-                    })
-                if 'error' in rChar.json():
-                    invalidList.append(char)
-                    app.logger.info(str(char) + " is not a valid character! Removed from list!")
-            tempList = [t for t in tempList if t.character_id not in invalidList]
-        for index in range(len(tempList)):
-            member = server.get_member(tempList[index].discord_id)
-            if member is None:
-                continue
-            if not tempList[index].character_id == sortedJSON[index]['character_id']:
-                app.logger.error("Character id " + str(tempList[index]['character_id']) + " does not match the data equivelant " + str(sortedJSON[index]['character_id']) + "!")
-                continue
-            corpID_db = tempList[index].corporation_id
-            allianceID_db = tempList[index].alliance_id
-            allianceID = None
-
-            if 'alliance_id' in sortedJSON[index]:
-                allianceID = sortedJSON[index]['alliance_id']
-
-            if not corpID_db == sortedJSON[index]['corporation_id'] or not allianceID_db == allianceID or member.nick is None:
-                app.logger.info(tempList[index].character_name  + "'s nickname needs to be changed due to change in corp / alliance / invalid username")
-                ticker = ""
-                if allianceID is not None:
-                    allianceID = sortedJSON[index]['alliance_id']
-                    #Set alliance ticker
-                    rTicker = requests.get("https://esi.tech.ccp.is/latest/alliances/" + str(allianceID) + "/?datasource=tranquility", headers={
-                        'User-Agent': 'Maintainer: '+ config['MAINTAINER']
-                        })
-                    ticker = rTicker.json()['ticker']
-                else:
-                    #Set corp ticker
-                    rTicker = requests.get("https://esi.tech.ccp.is/latest/corporations/" + str(sortedJSON[index]['corporation_id']) + "/?datasource=tranquility", headers={
-                        'User-Agent': 'Maintainer: '+ config['MAINTAINER']
-                        })
-                    ticker = rTicker.json()['ticker']
-                #Update id
-                app.logger.info("Added corp id (" + str(sortedJSON[index]['corporation_id']) + ") and alliance id (" + str(allianceID) +") to character id (" + str(sortedJSON[index]['character_id']) + ")!")
-                user = DiscordUser.query.filter(DiscordUser.character_id == sortedJSON[index]['character_id']).first()
-                if user is None:
-                    app.logger.error("Character id " + sortedJSON[index]['character_id'] + " not found!")
-                    continue
-                user.corporation_id = sortedJSON[index]['corporation_id']
-                user.alliance_id = allianceID
-                db.session.commit()
-                #Set nickname and give role
-                try:
-                    nick = "[" + ticker + "] " + tempList[index].character_name
-                    if len(nick) > 32:
-                        temp = nick.split(" ")
-                        nick = temp [0] + " " + temp [1] + " "
-                        if len(temp) <= 2:
-                            nick = "LONG USERNAME"
-                        for i in range(2,len(temp)):
-                            nick += temp[i].title()[0] + "."
-                        app.logger.info("Giving " + member.name + " the nickname " + nick + "!")
-                    await bot.change_nickname(member,nick)
-
-                    for entry in config['DISCORD_AUTH_ROLES']:
-                        role = discord.utils.get(server.roles, name=entry['role_name'])
-                        if role is None:
-                            app.logger.error("Role " + entry['role_name'] + " not found!")
-                            continue
-                        if entry['corp_id'] == sortedJSON[index]['corporation_id']:
-                            if role not in member.roles:
-                                try:
-                                    app.logger.info("Giving " + member.nick + " the " + role.name + " role!")
-                                    await bot.add_roles(member,role)
-                                except Exception as e:
-                                    app.logger.error('Exception in add_roles(): ' + str(e))
-                        else:
-                            if role in member.roles:
-                                try:
-                                    app.logger.info("Removing " + role.name + " from " + member.nick + "!")
-                                    await bot.remove_roles(member,role)
-                                except Exception as e:
-                                    app.logger.error('Exception in remove_roles(): ' + str(e))
-                except Exception as e:
-                    app.logger.error('Exception in change_nickname(): ' + str(e))
-    return "Corp check done!"
+async def select_due_users(now):
+    """
+    Picks the on-server users whose affiliation snapshot has expired.
+    At most one tick's share of the roster is returned, continuing after the
+    last character that was checked, so the checks are spread evenly across
+    CORP_CHECK_INTERVAL instead of bunching up when many snapshots expire at once.
+    Args:
+        now (datetime.datetime) - current UTC time
+    Returns:
+        list: DiscordUser rows to check
+    """
+    global sweep_cursor
+    total = await repository.count_on_server_users()
+    batch = max(CORP_CHECK_MIN_BATCH, int(math.ceil(total * DISCORD_BOT_AUTH_SLEEP / CORP_CHECK_INTERVAL)))
+    rows = await repository.get_due_users(now, sweep_cursor, batch)
+    if rows:
+        sweep_cursor = rows[-1].character_id
+    return rows
+
+async def check_corp(trace=NO_TRACE):
+    """
+    Checks the affiliations of the users that are due and queues the edits of members whose corporation or alliance changed
+    Args:
+        trace (profiling.Trace) - trace the phases are recorded on
+    Returns:
+        str: summary of the cycle
+    """
+    #Retrieve members in database whose affiliation may have changed
+    if esi.retry_after():
+        #Keep the cursor where it is, the characters are checked once ESI recovers
+        return "Corp check deferred, ESI is unavailable for another {:.0f} seconds".format(esi.retry_after())
+    now = datetime.datetime.utcnow()
+    with trace.span('db_read'):
+        data = await select_due_users(now)
+    if not data:
+        return "Corp check done! No affiliations have expired"
+
+    #Check corp and alliance of every character at once, ESI requests are packed and sent in parallel
+    app.logger.info("Making ESI post requests to characters/affiliation endpoint for %s characters", len(data))
+    requested = {row.character_id for row in data}
+    with trace.span('affiliations'):
+        affiliations = await lookup_affiliations(requested)
+    #Whatever is neither returned nor known to be invalid failed for a transient reason
+    skipped = set(characterID for characterID in requested - affiliations.keys() if characterID not in invalid_characters)
+    if skipped:
+        app.logger.info("ESI did not return %s characters, they are skipped this cycle", len(skipped))
+
+    #Remember when every character was checked and until when ESI's answer stays valid
+    #The changes of the whole cycle are written as one bulk update with a single commit
+    edits = 0
+    purged = 0
+    for row in data:
+        if row.character_id in invalid_characters:
+            purged += handle_invalid_user(row, now)
+            continue
+        affiliation = affiliations.get(row.character_id)
+        if affiliation is None:
+            writes.update(DiscordUser, row.id, affiliation_checked=now,
+                affiliation_expires=now + datetime.timedelta(seconds=CORP_CHECK_INTERVAL))
+            continue
+        writes.update(DiscordUser, row.id, affiliation_checked=now,
+            affiliation_expires=affiliation.expires or now + datetime.timedelta(seconds=CORP_CHECK_INTERVAL))
+        corpID = affiliation.corporation_id
+        allianceID = affiliation.alliance_id
+
+        if not row.corporation_id == corpID or not row.alliance_id == allianceID:
+            #Update id
+            app.logger.info("Added corp id (%s) and alliance id (%s) to character id (%s)!", corpID, allianceID, row.character_id)
+            writes.update(DiscordUser, row.id, corporation_id=corpID, alliance_id=allianceID)
+
+        memberships = guilds.memberships(bot, row.discord_id)
+        if not memberships:
+            continue
+
+        try:
+            with trace.span('tickers'):
+                ticker = await tickers.get_ticker(corpID, allianceID)
+        except EsiError as e:
+            app.logger.error('Exception in get_ticker(): ' + str(e))
+            continue
+        #Set nickname and roles on every server the user is on, unchanged members cost no requests
+        for guild, member in memberships:
+            with trace.span('diff'):
+                desired = reconcile.desired_state(row.character_name, ticker, corpID, guild.role_index)
+            #The edits are sent by the member edit scheduler, this only queues them
+            with trace.span('discord_writes'):
+                if member_edits.submit(member, desired, PRIORITY_SWEEP) is not None:
+                    edits += 1
+    with trace.span('commit'):
+        await writes.flush()
+    trace.annotate(members=len(data), skipped=len(skipped), edits=edits, purged=purged)
+    CORP_CHECK_MEMBERS.inc(('checked',), len(data))
+    CORP_CHECK_MEMBERS.inc(('skipped',), len(skipped))
+    CORP_CHECK_MEMBERS.inc(('edited',), edits)
+    CORP_CHECK_MEMBERS.inc(('purged',), purged)
+    return "Corp check done! {} of {} members queued for an edit, {} invalid characters purged".format(edits, len(data), purged)
+
+def handle_invalid_user(row, now):
+    """
+    Deals with a linked character that no longer exists.
+    With CORP_CHECK_PURGE_INVALID the link is removed and the member loses the
+    authentication roles, otherwise the user is only checked again after
+    CORP_CHECK_INVALID_RECHECK seconds, which costs no request.
+    Args:
+        row (DiscordUser) - user linked to the character
+        now (datetime.datetime) - current UTC time
+    Returns:
+        int: 1 if the user was purged, 0 otherwise
+    """
+    if not CORP_CHECK_PURGE_INVALID:
+        writes.update(DiscordUser, row.id, affiliation_checked=now,
+            affiliation_expires=now + datetime.timedelta(seconds=CORP_CHECK_INVALID_RECHECK))
+        return 0
+    app.logger.info("Purging link of invalid character %s (%s)", row.character_name, row.character_id)
+    writes.delete(DiscordUser, row.id)
+    for guild, member in guilds.memberships(bot, row.discord_id):
+        member_edits.submit(member, reconcile.unlinked_state(guild.role_index), PRIORITY_UNLINK)
+    return 1
 
 async def schedule_remove_auth_roles():
+    await bot.wait_until_ready()
     while True:
         try:
-            await asyncio.sleep(1)
-            await remove_auth_user_roles()
+            #Drain the removal table, then sleep until the web app reports an unlink.
+            #The table is still polled now and then in case a notification was lost.
+            with profiler.cycle('unlink') as trace:
+                removed = await remove_auth_user_roles(trace)
+            if removed < UNLINK_BATCH_SIZE:
+                #Wake up for the earliest retry of a failed request, if it comes before the fallback poll
+                wait = UNLINK_FALLBACK_POLL
+                due = await repository.next_removal_due()
+                if due is not None:
+                    wait = min(wait, max(0, (due - datetime.datetime.utcnow()).total_seconds()))
+                await notifications.wait(UNLINK, wait)
         except Exception as e:
             app.logger.error('Exception in schedule_remove_auth_roles(): ' + str(e))
+            await asyncio.sleep(1)
 
-async def remove_auth_user_roles():
+async def remove_auth_user_roles(trace=NO_TRACE):
     """
-    Remove all roles related to authentication
+    Remove all roles related to authentication from a batch of unlinked users
     Args:
-        None
+        trace (profiling.Trace) - trace the phases are recorded on
     Returns:
-        None
+        int: number of removal requests handled
     """
-    dlList = DiscordLinkRemoval.query.all()
-    server = bot.get_server(config['DISCORD_SERVER'])
+    now = datetime.datetime.utcnow()
+    with trace.span('db_read'):
+        dlList = await repository.pop_pending_removals(UNLINK_BATCH_SIZE, now)
+    if not dlList:
+        return 0
+
+    #Check if the users haven't been re-authenticated
+    with trace.span('db_read'):
+        relinked = await repository.get_users_by_discord_id([discordID.discord_id for discordID in dlList])
+
+    removed = 0
+    edits = []
     for discordID in dlList:
-        roleList = []
-
-        member = server.get_member(discordID.discord_id)
-        if member is None:
-            app.logger.error("Member " + discordID.discord_id + " not found in remove_auth_user_roles()!")
-            db.session.delete(discordID)
-            db.session.commit()
+        memberships = guilds.memberships(bot, discordID.discord_id)
+        if not memberships:
+            app.logger.error("Member %s not found in remove_auth_user_roles()!", discordID.discord_id)
+            writes.delete(DiscordLinkRemoval, discordID.discord_id)
+            removed += 1
             continue
 
-        authRole = discord.utils.get(server.roles,name=config['BASE_AUTH_ROLE'])
-        if authRole is None:
-            app.logger.error("Role " + config['BASE_AUTH_ROLE'] + " not found!")
-        else:
-            roleList.append(authRole)
-
-        #Check if the user hasn't been re-authenticated
-        duq = DiscordUser.query.filter(DiscordUser.discord_id == discordID.discord_id).first()
-        if duq:
-            db.session.delete(discordID)
-            db.session.commit()
+        if discordID.discord_id in relinked:
+            writes.delete(DiscordLinkRemoval, discordID.discord_id)
+            removed += 1
             continue
 
-        for entry in config['DISCORD_AUTH_ROLES']:
-            role = discord.utils.get(server.roles, name=entry['role_name'])
-            if role is None:
-                    app.logger.error("Role " + entry['role_name'] + " not found!")
-                    continue
-            elif role in member.roles:
-                roleList.append(role)
+        #Unlinking removes the auth roles on every server
+        pending = []
+        for guild, member in memberships:
+            with trace.span('diff'):
+                desired = reconcile.unlinked_state(guild.role_index)
+            pending.append(member_edits.submit(member, desired, PRIORITY_UNLINK))
+        edits.append((discordID, pending))
+
+    #Keep the removal request if an edit failed for a transient reason, so it is retried after a backoff
+    with trace.span('discord_writes'):
+        for discordID, pending in edits:
+            results = set()
+            for edit in pending:
+                if edit is not None:
+                    results.add(await edit)
+            if EDIT_FAILED in results and discordID.attempts + 1 < UNLINK_MAX_ATTEMPTS:
+                attempts = discordID.attempts + 1
+                writes.update(DiscordLinkRemoval, discordID.discord_id, attempts=attempts,
+                    next_attempt=now + datetime.timedelta(seconds=UNLINK_RETRY_DELAY * 2 ** (attempts - 1)))
+                continue
+            writes.delete(DiscordLinkRemoval, discordID.discord_id)
+            removed += 1
+            if EDIT_FAILED in results:
+                app.logger.error('Giving up on unauthenticating %s after %s attempts', discordID.discord_id, discordID.attempts + 1)
+            elif EDIT_REJECTED in results:
+                app.logger.error('Discord refused to unauthenticate %s, not retrying', discordID.discord_id)
+            else:
+                app.logger.info('%s has been unauthenticated!', discordID.discord_id)
+    #The next drain must not see these requests again
+    with trace.span('commit'):
+        await writes.flush()
+    trace.annotate(requests=len(dlList), removed=removed)
+    return removed
+
+async def schedule_link_jobs():
+    await bot.wait_until_ready()
+    while True:
+        try:
+            #Drain the link queue, then sleep until the web app queues a link or a retry is due
+            resolved, retrying = await resolve_link_jobs()
+            if retrying or resolved < LINK_BATCH_SIZE:
+                await notifications.wait(LINK, max(LINK_RETRY_DELAY, esi.retry_after()) if retrying else UNLINK_FALLBACK_POLL)
+        except Exception as e:
+            app.logger.error('Exception in schedule_link_jobs(): ' + str(e))
+            await asyncio.sleep(1)
 
+async def resolve_link_jobs():
+    """
+    Finishes a batch of links queued by the web app.
+    The affiliations of the whole batch are looked up at once, then every
+    job either creates its DiscordUser or fails with a message the web app
+    shows the user. Linked members already on the server get their roles
+    through the join batcher.
+    Args:
+        None
+    Returns:
+        tuple: number of jobs handled and number of jobs left pending for a retry
+    """
+    if esi.retry_after():
+        #Jobs stay pending without using up attempts, the caller tries again once ESI recovers
+        return 0, len(await repository.get_pending_link_jobs(LINK_BATCH_SIZE))
+    jobs = await repository.get_pending_link_jobs(LINK_BATCH_SIZE)
+    if not jobs:
+        return 0, 0
+    affiliations = await lookup_affiliations({job.character_id for job in jobs})
+
+    outcomes = {}
+    for job in jobs:
+        if job.character_id in invalid_characters:
+            outcomes[job.id] = (None, "Character ID " + str(job.character_id) + " is not valid! Message a mentor!")
+        else:
+            outcomes[job.id] = (affiliations.get(job.character_id), None)
+    linked = await repository.finish_link_jobs(outcomes, datetime.datetime.utcnow(), LINK_MAX_ATTEMPTS)
+
+    for user in linked:
+        app.logger.info("Added user %s with Discord %s!", user.character_name, user.discord_name)
+        for guild, member in guilds.memberships(bot, user.discord_id):
+            joins.add(member)
+    retrying = sum(1 for job in jobs if outcomes[job.id] == (None, None) and job.attempts + 1 < LINK_MAX_ATTEMPTS)
+    return len(jobs), retrying
+
+async def schedule_member_refresh():
+    await bot.wait_until_ready()
+    while True:
         try:
-            await bot.remove_roles(member,*roleList)
-            await bot.change_nickname(member,None)
-            db.session.delete(discordID)
-            app.logger.info(discordID.discord_id + ' has been unauthenticated!')
-            db.session.commit()
+            #Drain the refresh queue, then sleep until a sweep worker queues more
+            with profiler.cycle('member_refresh') as trace:
+                refreshed = await refresh_members(trace)
+            if refreshed < REFRESH_BATCH_SIZE:
+                await notifications.wait(REFRESH, UNLINK_FALLBACK_POLL)
+        except Exception as e:
+            app.logger.error('Exception in schedule_member_refresh(): ' + str(e))
+            await asyncio.sleep(1)
 
+async def refresh_members(trace=NO_TRACE):
+    """
+    Updates the nickname and roles of members whose affiliation a sweep worker changed
+    Args:
+        trace (profiling.Trace) - trace the phases are recorded on
+    Returns:
+        int: number of refreshes handled
+    """
+    with trace.span('db_read'):
+        refreshes = await repository.pop_member_refreshes(REFRESH_BATCH_SIZE)
+    if not refreshes:
+        return 0
+    with trace.span('db_read'):
+        users = await repository.get_users_by_discord_id([refresh.discord_id for refresh in refreshes])
+
+    edits = 0
+    for refresh in refreshes:
+        row = users.get(refresh.discord_id)
+        memberships = guilds.memberships(bot, refresh.discord_id)
+        if row is not None and memberships:
+            try:
+                with trace.span('tickers'):
+                    ticker = await tickers.get_ticker(row.corporation_id, row.alliance_id)
+            except EsiError as e:
+                #Keep the refresh, the next drain tries again
+                app.logger.error('Exception in get_ticker(): ' + str(e))
+                continue
+            for guild, member in memberships:
+                with trace.span('diff'):
+                    desired = reconcile.desired_state(row.character_name, ticker, row.corporation_id, guild.role_index)
+                if member_edits.submit(member, desired, PRIORITY_SWEEP) is not None:
+                    edits += 1
+        writes.delete(MemberRefresh, refresh.discord_id)
+    with trace.span('commit'):
+        await writes.flush()
+    trace.annotate(refreshes=len(refreshes), edits=edits)
+    return len(refreshes)
+
+async def schedule_ticker_refresh():
+    await bot.wait_until_ready()
+    while True:
+        await asyncio.sleep(TICKER_REFRESH_INTERVAL)
+        try:
+            #Changed tickers trigger a renick of their members through the ticker cache
+            refreshed = await tickers.refresh_expired()
+            if refreshed:
+                app.logger.info('Revalidated %s tickers', refreshed)
         except Exception as e:
-            app.logger.error('Exception in remove_roles(): ' + str(e))
-        
+            app.logger.error('Exception in schedule_ticker_refresh(): ' + str(e))
+
+def schedule_renick(entity_type, entity_id, old_ticker, new_ticker):
+    bot.loop.create_task(renick_entity(entity_type, entity_id, new_ticker))
+
+async def renick_entity(entity_type, entity_id, ticker):
+    """
+    Gives every member showing a ticker that changed the new one.
+    Only the members of that corporation or alliance are looked up, through
+    the indexes on corporation_id and alliance_id, and their edits are
+    paced and coalesced by the member edit scheduler.
+    Args:
+        entity_type (str) - tickers.CORPORATION or tickers.ALLIANCE
+        entity_id (int) - id of the corporation or alliance
+        ticker (str) - the new ticker
+    Returns:
+        int: number of member edits queued
+    """
+    try:
+        rows = await repository.get_users_by_entity(entity_type, entity_id)
+        edits = 0
+        for row in rows:
+            for guild, member in guilds.memberships(bot, row.discord_id):
+                desired = reconcile.desired_state(row.character_name, ticker, row.corporation_id, guild.role_index)
+                if member_edits.submit(member, desired, PRIORITY_SWEEP) is not None:
+                    edits += 1
+        app.logger.info('Ticker of %s %s is now %s, %s of %s users queued for a new nickname', entity_type, entity_id,
+            ticker, edits, len(rows))
+        return edits
+    except Exception as e:
+        app.logger.error('Exception in renick_entity(): ' + str(e))
+        return 0
 
 async def schedule_update_on_server():
     while True:
         try:
-            app.logger.info('Sleeping for {} seconds'.format(DATABASE_MEMBER_UPDATE))
+            app.logger.info('Sleeping for %s seconds', DATABASE_MEMBER_UPDATE)
             await asyncio.sleep(DATABASE_MEMBER_UPDATE)
             app.logger.info('Updating server connected users')
-            dq = DiscordUser.query.filter(DiscordUser.on_server == False).all()
-            server = bot.get_server(config['DISCORD_SERVER'])
-            if server is None:
-                app.logger.error("Server " + config['DISCORD_SERVER'] + " not found!")
-                return
-            for m in server.members:
-                for r in dq:
-                    if m.id == r.discord_id:
-                        app.logger.info("User " + m.name + " was on the server but was not marked being so!")
-                        await on_member_join(m)
-                        break
+            with profiler.cycle('update_on_server') as trace:
+                result = await update_on_server(trace)
+            app.logger.info(result)
         except Exception as e:
             app.logger.error('Exception in schedule_update_on_server(): ' + str(e))
 
+async def update_on_server(trace=NO_TRACE):
+    """
+    Marks members that are on a managed server but not flagged as such in the database
+    Args:
+        trace (profiling.Trace) - trace the phases are recorded on
+    Returns:
+        str: summary of the pass
+    """
+    start = time.perf_counter()
+    servers = guilds.servers(bot)
+    if not servers:
+        return "None of the " + str(len(guilds)) + " servers found!"
+    with trace.span('db_read'):
+        offServer = {r.discord_id: r for r in await repository.get_off_server_users()}
+    with trace.span('diff'):
+        members = [m for guild, server in servers for m in server.members if m.id in offServer]
+    total = sum(len(server.members) for guild, server in servers)
+    for m in members:
+        app.logger.info("User %s was on the server but was not marked being so!", m.name)
+    if members:
+        await handle_member_joins(members, {m.id: offServer[m.id] for m in members}, trace)
+    trace.annotate(members=total, reconciled=len(members))
+    return "Reconciled {} of {} members in {:.3f} seconds".format(len(members), total, time.perf_counter() - start)
+
 if __name__ == '__main__':
     try:
+        #Bring databases made by older versions up to date
+        app.logger.info('Applied {} database migrations'.format(migrations.upgrade()))
+        app.logger.info('Loaded {} cached tickers'.format(tickers.load()))
+        app.logger.info('Loaded {} invalid characters'.format(invalid_characters.load()))
+        notifications.start()
+        if METRICS_PORT:
+            metrics_server = bot.loop.run_until_complete(serve_metrics(REGISTRY, METRICS_HOST, METRICS_PORT))
+            app.logger.info('Serving metrics on http://{}:{}/metrics'.format(METRICS_HOST, METRICS_PORT))
         app.logger.info('Scheduling background tasks ...')
         app.logger.info('Starting run loop ...')
-        bot.loop.create_task(schedule_corp_update())
+        bot.loop.create_task(member_edits.run())
+        bot.loop.create_task(writes.run())
+        bot.loop.create_task(joins.run())
+        bot.loop.create_task(loop_monitor.run())
+        if SWEEP_WORKERS:
+            app.logger.info('Affiliations are swept by the sweep workers')
+            bot.loop.create_task(schedule_member_refresh())
+        else:
+            bot.loop.create_task(schedule_corp_update())
         bot.loop.create_task(schedule_remove_auth_roles())
+        bot.loop.create_task(schedule_link_jobs())
         bot.loop.create_task(schedule_update_on_server())
+        bot.loop.create_task(schedule_ticker_refresh())
         bot.run(config['DISCORD_TOKEN'])
     except KeyboardInterrupt:
         app.logger.warning('Logging out ...')
@@ -433,5 +736,14 @@ if __name__ == '__main__':
         app.logger.error('Caught unknown error: ' + str(e))
     finally:
         app.logger.warning('Closing ...')
+        #bot.run() closes the loop when it returns normally, the next sweep rewrites anything lost
+        if not bot.loop.is_closed():
+            bot.loop.run_until_complete(writes.flush())
+        repository.close()
+        esi.close()
+        notifications.close()
+        profiler.close()
+        if metrics_server is not None:
+            metrics_server.close()
         bot.loop.close()
         app.logger.info('Done')
@@ -1,9 +1,13 @@
 #!/usr/bin/env python
 from app import db
 from models import *
+import migrations
 
 #Drop all
 db.drop_all()
 
 #Create the database
 db.create_all()
+
+#Apply the storage profile and record the schema version
+migrations.upgrade()
@@ -0,0 +1,425 @@
+import asyncio
+import json
+import random
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+from email.utils import parsedate_to_datetime
+
+import aiohttp
+import async_timeout
+
+from metrics import Counter, Histogram, endpoint_label
+from throttle import AdaptiveLimiter, CircuitBreaker
+
+ESI_BASE_URL = 'https://esi.tech.ccp.is/latest'
+ESI_DATASOURCE = 'tranquility'
+AFFILIATION_MAX_IDS = 1000
+#Statuses ESI answers with when a request contains an id that does not exist
+INVALID_ID_STATUSES = (400, 404)
+
+Affiliation = namedtuple('Affiliation', ['character_id', 'corporation_id', 'alliance_id', 'expires'])
+Character = namedtuple('Character', ['character_id', 'name', 'corporation_id', 'alliance_id'])
+Corporation = namedtuple('Corporation', ['corporation_id', 'name', 'ticker', 'alliance_id'])
+Alliance = namedtuple('Alliance', ['alliance_id', 'name', 'ticker'])
+EsiResponse = namedtuple('EsiResponse', ['status', 'data', 'etag', 'expires'])
+
+ESI_REQUESTS = Counter('esi_requests_total', 'ESI requests by endpoint and status, "error" if no response was received',
+    ('method', 'endpoint', 'status'))
+ESI_SECONDS = Histogram('esi_request_seconds', 'Time until ESI answered', ('method', 'endpoint'))
+
+def parse_expires(value, default=300):
+    """
+    Converts an ESI Expires header into a naive UTC datetime
+    Args:
+        value (str) - value of the Expires header, may be None
+        default (int) - seconds from now used when the header is missing or invalid
+    Returns:
+        datetime: moment the response stops being fresh
+    """
+    if value:
+        try:
+            expires = parsedate_to_datetime(value)
+            if expires.tzinfo is not None:
+                expires = expires.replace(tzinfo=None) - expires.utcoffset()
+            return expires
+        except (TypeError, ValueError):
+            pass
+    return datetime.utcnow() + timedelta(seconds=default)
+
+class EsiError(Exception):
+    """
+    Raised when ESI returns an error or cannot be reached.
+    Args:
+        status (int) - HTTP status of the response, None if no response was received
+        message (str) - error message
+    """
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+class EsiClient:
+    """
+    Asynchronous ESI client with a pooled keep-alive connector.
+    One instance is shared by every coroutine in the bot, so the number of open
+    connections and in-flight requests stays bounded no matter how many
+    lookups are scheduled at once.
+    The number of requests in flight adapts to ESI: it grows while requests
+    succeed and is halved on server errors or when the error limit runs low.
+    Requests are held back until the error limit resets when it is nearly
+    used up. Server errors and timeouts are retried with jittered backoff,
+    and after breaker_threshold failures in a row the circuit opens and
+    requests fail right away, so callers defer their work instead of adding
+    to the load.
+    Args:
+        maintainer (str) - maintainer contact for the User-Agent header
+        loop (asyncio.AbstractEventLoop) - loop the client runs on
+        base_url (str) - ESI base URL, without trailing slash
+        datasource (str) - ESI datasource
+        max_connections (int) - size of the keep-alive connection pool
+        concurrency (int) - maximum number of requests in flight
+        min_concurrency (int) - number of requests in flight the limit never drops below
+        timeout (float) - seconds before a single request is abandoned
+        keepalive (float) - seconds an idle connection is kept open
+        affiliation_chunk_size (int) - character ids per affiliation request, at most AFFILIATION_MAX_IDS
+        affiliation_concurrency (int) - maximum number of affiliation requests in flight
+        retries (int) - retries of a request that failed with a server error or a timeout
+        retry_backoff (float) - base of the exponential backoff between retries, in seconds
+        error_limit_low (int) - remaining errors below which the limit is lowered
+        error_limit_hold (int) - remaining errors below which requests wait for the error limit to reset
+        breaker_threshold (int) - consecutive failures that open the circuit
+        breaker_reset (float) - seconds the circuit stays open
+    """
+    def __init__(self, maintainer, loop=None, base_url=ESI_BASE_URL, datasource=ESI_DATASOURCE,
+                 max_connections=20, concurrency=10, timeout=10, keepalive=30,
+                 affiliation_chunk_size=AFFILIATION_MAX_IDS, affiliation_concurrency=4,
+                 min_concurrency=1, retries=2, retry_backoff=0.5, error_limit_low=20, error_limit_hold=5,
+                 breaker_threshold=5, breaker_reset=30):
+        self.loop = loop or asyncio.get_event_loop()
+        self.base_url = base_url.rstrip('/')
+        self.datasource = datasource
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.keepalive = keepalive
+        self.headers = {
+            'Accept': 'application/json',
+            'User-Agent': 'Maintainer: ' + maintainer
+        }
+        self.affiliation_chunk_size = max(1, min(affiliation_chunk_size, AFFILIATION_MAX_IDS))
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.error_limit_low = error_limit_low
+        self.error_limit_hold = error_limit_hold
+        self.error_limit_remain = None
+        self.retried = 0
+        self.sent = 0
+        self.deferred = 0
+        self.limiter = AdaptiveLimiter(self.loop, min_limit=min_concurrency, max_limit=concurrency)
+        self.breaker = CircuitBreaker(self.loop, threshold=breaker_threshold, reset_timeout=breaker_reset)
+        self._affiliation_semaphore = asyncio.Semaphore(affiliation_concurrency)
+        self._session = None
+
+    @classmethod
+    def from_config(cls, config, loop=None):
+        """
+        Builds a client from the 'ESI' section of config.json
+        Args:
+            config (dict) - parsed config.json
+            loop (asyncio.AbstractEventLoop) - loop the client runs on
+        Returns:
+            EsiClient
+        """
+        esiConfig = config.get('ESI', {})
+        return cls(config['MAINTAINER'], loop=loop,
+            base_url=esiConfig.get('BASE_URL', ESI_BASE_URL),
+            datasource=esiConfig.get('DATASOURCE', ESI_DATASOURCE),
+            max_connections=esiConfig.get('MAX_CONNECTIONS', 20),
+            concurrency=esiConfig.get('CONCURRENCY', 10),
+            timeout=esiConfig.get('TIMEOUT', 10),
+            keepalive=esiConfig.get('KEEPALIVE', 30),
+            affiliation_chunk_size=esiConfig.get('AFFILIATION_CHUNK_SIZE', AFFILIATION_MAX_IDS),
+            affiliation_concurrency=esiConfig.get('AFFILIATION_CONCURRENCY', 4),
+            min_concurrency=esiConfig.get('MIN_CONCURRENCY', 1),
+            retries=esiConfig.get('RETRIES', 2),
+            retry_backoff=esiConfig.get('RETRY_BACKOFF', 0.5),
+            error_limit_low=esiConfig.get('ERROR_LIMIT_LOW', 20),
+            error_limit_hold=esiConfig.get('ERROR_LIMIT_HOLD', 5),
+            breaker_threshold=esiConfig.get('BREAKER_THRESHOLD', 5),
+            breaker_reset=esiConfig.get('BREAKER_RESET', 30))
+
+    @property
+    def session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=self.keepalive, loop=self.loop)
+            self._session = aiohttp.ClientSession(connector=connector, headers=self.headers, loop=self.loop)
+        return self._session
+
+    def retry_after(self):
+        """
+        Tells whether requests are currently refused because ESI is failing
+        Args:
+            None
+        Returns:
+            float: seconds until the circuit allows a trial request, 0 if requests are sent
+        """
+        return self.breaker.retry_after()
+
+    def stats(self):
+        """
+        Returns the traffic counters
+        Args:
+            None
+        Returns:
+            dict: concurrency limit, requests in flight, backoffs, requests sent, retries, deferred lookups,
+                  circuit state, times opened, refused requests and the last seen error limit
+        """
+        return {
+            'limit': int(self.limiter.limit),
+            'in_flight': self.limiter.in_flight,
+            'backoffs': self.limiter.backoffs,
+            'sent': self.sent,
+            'retried': self.retried,
+            'deferred': self.deferred,
+            'circuit': self.breaker.state,
+            'opened': self.breaker.opened,
+            'rejected': self.breaker.rejected,
+            'error_limit_remain': self.error_limit_remain
+        }
+
+    def close(self):
+        """
+        Closes the pooled session
+        Args:
+            None
+        Returns:
+            None
+        """
+        if self._session is not None and not self._session.closed:
+            self._session.close()
+        self._session = None
+
+    async def fetch(self, method, path, payload=None, etag=None):
+        """
+        Makes a request to ESI and keeps the caching headers of the response.
+        Server errors and timeouts are retried up to retries times.
+        Args:
+            method (str) - HTTP method
+            path (str) - path relative to the base URL, e.g. '/characters/123/'
+            payload (object) - JSON body, if any
+            etag (str) - ETag of a cached copy, sent as If-None-Match
+        Returns:
+            EsiResponse: data is None when ESI answered 304 Not Modified
+        Raises:
+            EsiError: on an error response, a timeout or a connection failure, or right away while the circuit is open
+        """
+        url = self.base_url + path
+        params = {'datasource': self.datasource}
+        headers = {}
+        data = None
+        if payload is not None:
+            headers['Content-Type'] = 'application/json'
+            data = json.dumps(payload)
+        if etag is not None:
+            headers['If-None-Match'] = etag
+        for attempt in range(self.retries + 1):
+            if not self.breaker.allow():
+                raise EsiError(None, 'ESI is unavailable, {} deferred for {:.0f} seconds'.format(path, self.breaker.retry_after()))
+            try:
+                response = await self._send(method, url, path, params, data, headers, etag)
+            except EsiError as e:
+                error = e
+            else:
+                self.breaker.success()
+                self.limiter.success()
+                return response
+            if error.status is not None and error.status < 500:
+                #ESI is up, it refused this particular request
+                self.breaker.success()
+                raise error
+            self.limiter.backoff()
+            if self.breaker.failure() or attempt == self.retries:
+                raise error
+            self.retried += 1
+            #Full jitter, so requests that failed together do not come back together
+            await asyncio.sleep(random.uniform(0, self.retry_backoff * 2 ** attempt))
+
+    async def _send(self, method, url, path, params, data, headers, etag):
+        labels = (method, endpoint_label(path))
+        status = 'error'
+        async with self.limiter:
+            self.sent += 1
+            start = time.perf_counter()
+            try:
+                with async_timeout.timeout(self.timeout, loop=self.loop):
+                    async with self.session.request(method, url, params=params, data=data, headers=headers) as r:
+                        status = r.status
+                        self._check_error_limit(status, r.headers)
+                        result = None if status == 304 else await r.json()
+                        responseEtag = r.headers.get('ETag', etag)
+                        expires = parse_expires(r.headers.get('Expires'))
+            except asyncio.TimeoutError:
+                raise EsiError(None, 'Timed out after {} seconds requesting {}'.format(self.timeout, path))
+            except (aiohttp.ClientError, ValueError) as e:
+                raise EsiError(None, 'Request to {} failed: {}'.format(path, e))
+            finally:
+                ESI_SECONDS.observe(time.perf_counter() - start, labels)
+                ESI_REQUESTS.inc(labels + (status,))
+        if status >= 400 or (isinstance(result, dict) and 'error' in result):
+            message = result.get('error', '') if isinstance(result, dict) else ''
+            raise EsiError(status, 'ESI returned {} for {}: {}'.format(status, path, message))
+        return EsiResponse(status, result, responseEtag, expires)
+
+    def _check_error_limit(self, status, headers):
+        try:
+            remain = int(headers.get('X-Esi-Error-Limit-Remain'))
+            reset = int(headers.get('X-Esi-Error-Limit-Reset'))
+        except (TypeError, ValueError):
+            remain = reset = None
+        if remain is not None:
+            self.error_limit_remain = remain
+        if status == 420 or (remain is not None and remain <= self.error_limit_hold):
+            #Another error before the reset risks a ban, send nothing until then
+            self.limiter.hold(reset if reset is not None else 60)
+            self.limiter.backoff()
+        elif remain is not None and remain <= self.error_limit_low:
+            self.limiter.backoff()
+
+    async def request(self, method, path, payload=None):
+        """
+        Makes a request to ESI
+        Args:
+            method (str) - HTTP method
+            path (str) - path relative to the base URL, e.g. '/characters/123/'
+            payload (object) - JSON body, if any
+        Returns:
+            object: decoded JSON response
+        Raises:
+            EsiError: on an error response, a timeout or a connection failure
+        """
+        return (await self.fetch(method, path, payload)).data
+
+    async def get_affiliations(self, character_ids):
+        """
+        Looks up the corporation and alliance of a list of characters
+        Args:
+            character_ids (list) - character ids to look up
+        Returns:
+            list: Affiliation for every character ESI returned, with the Expires time of the response
+        """
+        response = await self.fetch('POST', '/characters/affiliation/', list(character_ids))
+        return [Affiliation(entry['character_id'], entry['corporation_id'], entry.get('alliance_id'), response.expires) for entry in response.data]
+
+    async def get_affiliation_map(self, character_ids, invalid=None):
+        """
+        Looks up the corporation and alliance of any number of characters.
+        The ids are packed into requests of affiliation_chunk_size ids, which
+        are sent in parallel, at most affiliation_concurrency at a time.
+        Args:
+            character_ids (iterable) - character ids to look up
+            invalid (set) - if given, receives the ids ESI left out of a response or answered with a 404 for
+        Returns:
+            dict: Affiliation keyed by character_id, characters ESI did not return are left out
+        """
+        ids = sorted(set(character_ids))
+        size = self.affiliation_chunk_size
+        chunks = [ids[i:i + size] for i in range(0, len(ids), size)]
+        found = set()
+        results = await asyncio.gather(*[self._get_affiliation_chunk(chunk, found) for chunk in chunks])
+        if len(ids) > 1 and len(found) == len(ids):
+            #Every character existing nowhere points at ESI, e.g. a wrong BASE_URL, not at the characters
+            self.deferred += len(ids)
+            found.clear()
+        if invalid is not None:
+            invalid.update(found)
+        affiliations = {}
+        for result in results:
+            for affiliation in result:
+                affiliations[affiliation.character_id] = affiliation
+        return affiliations
+
+    async def _get_affiliation_chunk(self, chunk, invalid):
+        try:
+            async with self._affiliation_semaphore:
+                affiliations = await self.get_affiliations(chunk)
+        except EsiError as e:
+            error = e
+        else:
+            #ESI leaves characters that no longer exist out of the response
+            invalid.update(set(chunk) - set(affiliation.character_id for affiliation in affiliations))
+            return affiliations
+        if error.status in INVALID_ID_STATUSES:
+            if len(chunk) > 1:
+                #A single invalid id fails the whole request, so split until it is isolated
+                half = len(chunk) // 2
+                results = await asyncio.gather(self._get_affiliation_chunk(chunk[:half], invalid), self._get_affiliation_chunk(chunk[half:], invalid))
+                return results[0] + results[1]
+            #Only a 404 for the character itself proves it does not exist
+            affiliation = await self._check_chunk_character(chunk[0], invalid)
+            return [affiliation] if affiliation is not None else []
+        #Rate limited or ESI is struggling. Looking the characters up one by one would only
+        #add to the load, so they are left out and the caller tries again later
+        self.deferred += len(chunk)
+        return []
+
+    async def _check_chunk_character(self, character_id, invalid):
+        try:
+            affiliation = await self.check_character(character_id)
+        except EsiError:
+            self.deferred += 1
+            return None
+        if affiliation is None:
+            invalid.add(character_id)
+        return affiliation
+
+    async def check_character(self, character_id):
+        """
+        Looks a single character up to find out whether it exists
+        Args:
+            character_id (int) - id of the character
+        Returns:
+            Affiliation: None if ESI answered that the character does not exist
+        Raises:
+            EsiError: on any other error
+        """
+        try:
+            response = await self.fetch('GET', '/characters/{}/'.format(character_id))
+        except EsiError as e:
+            if e.status == 404:
+                return None
+            raise
+        return Affiliation(int(character_id), response.data['corporation_id'], response.data.get('alliance_id'), response.expires)
+
+    async def get_character(self, character_id):
+        """
+        Retrieves public information of a character
+        Args:
+            character_id (int) - id of the character
+        Returns:
+            Character
+        """
+        result = await self.request('GET', '/characters/{}/'.format(character_id))
+        return Character(int(character_id), result.get('name'), result['corporation_id'], result.get('alliance_id'))
+
+    async def get_corporation(self, corporation_id):
+        """
+        Retrieves public information of a corporation
+        Args:
+            corporation_id (int) - id of the corporation
+        Returns:
+            Corporation
+        """
+        result = await self.request('GET', '/corporations/{}/'.format(corporation_id))
+        return Corporation(int(corporation_id), result.get('name', result.get('corporation_name')),
+            result['ticker'], result.get('alliance_id'))
+
+    async def get_alliance(self, alliance_id):
+        """
+        Retrieves public information of an alliance
+        Args:
+            alliance_id (int) - id of the alliance
+        Returns:
+            Alliance
+        """
+        result = await self.request('GET', '/alliances/{}/'.format(alliance_id))
+        return Alliance(int(alliance_id), result.get('name', result.get('alliance_name')), result['ticker'])
@@ -0,0 +1,108 @@
+from roles import RoleIndex
+
+class Guild:
+    """
+    A Discord server the bot manages, with its own role mapping and channels
+    Args:
+        server_id (str) - id of the server
+        role_index (RoleIndex) - auth roles of the server
+        channels (dict) - channel ids by purpose, e.g. {'RECRUITMENT': '123'}
+    """
+    def __init__(self, server_id, role_index, channels):
+        self.server_id = server_id
+        self.role_index = role_index
+        self.channels = channels
+
+    @classmethod
+    def from_config(cls, entry):
+        """
+        Builds a guild from a DISCORD_GUILDS entry, or from the top level of config.json
+        Args:
+            entry (dict) - with DISCORD_SERVER, BASE_AUTH_ROLE, DISCORD_AUTH_ROLES and DISCORD_PRIVATE_COMMAND_CHANNELS
+        Returns:
+            Guild
+        """
+        return cls(entry['DISCORD_SERVER'], RoleIndex.from_config(entry), entry['DISCORD_PRIVATE_COMMAND_CHANNELS'])
+
+    @property
+    def recruitment_channel_id(self):
+        return self.channels['RECRUITMENT']
+
+class GuildRegistry:
+    """
+    The servers the bot manages.
+    Characters are linked once and their affiliation is resolved once per
+    cycle, the result is then applied on every server the user is on with
+    that server's roles.
+    Args:
+        guilds (list) - Guild objects, the first one is the primary server
+    """
+    def __init__(self, guilds):
+        self.guilds = guilds
+        self._by_id = dict((guild.server_id, guild) for guild in guilds)
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Builds the registry from DISCORD_GUILDS in config.json.
+        Configs without DISCORD_GUILDS describe a single server with
+        DISCORD_SERVER and the other top level keys, as before.
+        Args:
+            config (dict) - parsed config.json
+        Returns:
+            GuildRegistry
+        """
+        entries = config.get('DISCORD_GUILDS') or [config]
+        return cls([Guild.from_config(entry) for entry in entries])
+
+    def __iter__(self):
+        return iter(self.guilds)
+
+    def __len__(self):
+        return len(self.guilds)
+
+    @property
+    def primary(self):
+        return self.guilds[0]
+
+    def get(self, server_id):
+        """
+        Returns the guild of a server
+        Args:
+            server_id (str) - id of the server
+        Returns:
+            Guild: None if the bot does not manage the server
+        """
+        return self._by_id.get(server_id)
+
+    def servers(self, bot):
+        """
+        Returns the managed servers the bot is connected to
+        Args:
+            bot (discord.Client) - the bot
+        Returns:
+            list: (Guild, discord.Server) tuples, servers that are not found are left out
+        """
+        servers = []
+        for guild in self.guilds:
+            server = bot.get_server(guild.server_id)
+            if server is not None:
+                servers.append((guild, server))
+        return servers
+
+    def memberships(self, bot, discord_id):
+        """
+        Returns every managed server a user is on
+        Args:
+            bot (discord.Client) - the bot
+            discord_id (str) - id of the discord account
+        Returns:
+            list: (Guild, discord.Member) tuples
+        """
+        memberships = []
+        for guild, server in self.servers(bot):
+            member = server.get_member(discord_id)
+            if member is not None:
+                guild.role_index.ensure(server)
+                memberships.append((guild, member))
+        return memberships
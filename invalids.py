@@ -0,0 +1,124 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from app import app
+from esi import EsiError
+from models import InvalidCharacter
+
+class InvalidCharacterCache:
+    """
+    Negative cache of characters ESI reported as no longer existing.
+    Cached characters are left out of affiliation lookups until their entry
+    expires. An expired character is checked again on its own with a single
+    GET /characters/{id}/, and either cached for another recheck period or,
+    if it exists after all, forgotten and looked up normally. Entries are
+    mirrored to the invalid_characters table.
+    Args:
+        esi (esi.EsiClient) - client used for lookups
+        repository (repository.BotRepository) - database access for the stored entries
+        recheck (float) - seconds before a cached character is checked again
+    """
+    def __init__(self, esi, repository, recheck=7 * 24 * 3600):
+        self.esi = esi
+        self.repository = repository
+        self.recheck = recheck
+        self.rechecked = 0
+        self.restored = 0
+        self._expires = {}
+
+    @classmethod
+    def from_config(cls, esi, repository, config):
+        """
+        Builds a cache from the 'CORP_CHECK' section of config.json
+        Args:
+            esi (esi.EsiClient) - client used for lookups
+            repository (repository.BotRepository) - database access for the stored entries
+            config (dict) - parsed config.json
+        Returns:
+            InvalidCharacterCache
+        """
+        return cls(esi, repository, recheck=config.get('CORP_CHECK', {}).get('INVALID_RECHECK', 7 * 24 * 3600))
+
+    def load(self):
+        """
+        Loads the stored entries.
+        Meant to be called once at startup, before the event loop runs.
+        Entries stored without an expiry expire recheck seconds after detection.
+        Args:
+            None
+        Returns:
+            int: number of entries loaded
+        """
+        for row in InvalidCharacter.query.all():
+            self._expires[row.character_id] = row.expires or row.detected + timedelta(seconds=self.recheck)
+        return len(self._expires)
+
+    def __contains__(self, character_id):
+        expires = self._expires.get(character_id)
+        return expires is not None and expires > datetime.utcnow()
+
+    def __len__(self):
+        return len(self._expires)
+
+    def clear(self):
+        self._expires.clear()
+
+    def stats(self):
+        """
+        Returns the cache counters
+        Args:
+            None
+        Returns:
+            dict: rechecks, characters that turned out to exist and current size
+        """
+        return {'rechecked': self.rechecked, 'restored': self.restored, 'size': len(self._expires)}
+
+    async def lookup(self, character_ids):
+        """
+        Looks up affiliations, skipping characters cached as not existing.
+        Characters ESI confirms as not existing are cached, expired entries
+        are checked again.
+        Args:
+            character_ids (iterable) - character ids to look up
+        Returns:
+            dict: esi.Affiliation keyed by character_id
+        """
+        now = datetime.utcnow()
+        ids = set(character_ids)
+        expired = [characterID for characterID in ids if characterID in self._expires and characterID not in self]
+        invalid = set()
+        affiliations = await self.esi.get_affiliation_map(ids - self._expires.keys(), invalid)
+
+        restored = []
+        results = await asyncio.gather(*[self._check(characterID) for characterID in expired])
+        for characterID, (checked, affiliation) in zip(expired, results):
+            if not checked:
+                continue
+            if affiliation is None:
+                invalid.add(characterID)
+            else:
+                affiliations[characterID] = affiliation
+                restored.append(characterID)
+
+        if invalid:
+            app.logger.warning("ESI reports %s characters as not existing: %s", len(invalid), ", ".join(str(c) for c in sorted(invalid)))
+            expires = now + timedelta(seconds=self.recheck)
+            for characterID in invalid:
+                self._expires[characterID] = expires
+            await self.repository.add_invalid_characters(invalid, now, expires)
+        if restored:
+            app.logger.info("%s characters cached as not existing were found again", len(restored))
+            for characterID in restored:
+                del self._expires[characterID]
+            self.restored += len(restored)
+            await self.repository.remove_invalid_characters(restored)
+        return affiliations
+
+    async def _check(self, characterID):
+        self.rechecked += 1
+        try:
+            return True, await self.esi.check_character(characterID)
+        except EsiError as e:
+            #The entry stays expired and is checked again with the next lookup
+            app.logger.error('Exception in InvalidCharacterCache._check(): ' + str(e))
+            return False, None
@@ -0,0 +1,111 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from app import app
+
+class JoinBatcher:
+    """
+    Coalesces member joins into batches.
+    The first join after a quiet period opens a window of window seconds,
+    every member joining during it is handled together when the window
+    closes, or as soon as max_batch members are waiting. A member therefore
+    waits at most window seconds plus the time the batch before it takes.
+    Args:
+        handler (coroutine function) - called with the list of discord.Member objects of a batch
+        window (float) - seconds a batch stays open after its first join
+        max_batch (int) - number of waiting members that closes a batch early
+    """
+    def __init__(self, handler, window=2.0, max_batch=50):
+        self.handler = handler
+        self.window = window
+        self.max_batch = max_batch
+        self.batches = 0
+        self.members = 0
+        self.largest = 0
+        self.max_wait = 0.0
+        self._waiting = OrderedDict()
+        self._arrived = asyncio.Event()
+        self._full = asyncio.Event()
+
+    @classmethod
+    def from_config(cls, handler, config):
+        """
+        Builds a batcher from the 'JOIN_BATCH' section of config.json
+        Args:
+            handler (coroutine function) - called with the list of discord.Member objects of a batch
+            config (dict) - parsed config.json
+        Returns:
+            JoinBatcher
+        """
+        batchConfig = config.get('JOIN_BATCH', {})
+        return cls(handler, window=batchConfig.get('WINDOW', 2.0), max_batch=batchConfig.get('MAX_BATCH', 50))
+
+    def __len__(self):
+        return len(self._waiting)
+
+    def stats(self):
+        """
+        Returns the batch counters
+        Args:
+            None
+        Returns:
+            dict: batches handled, members handled, largest batch and longest wait in seconds
+        """
+        return {'batches': self.batches, 'members': self.members, 'largest': self.largest, 'max_wait': self.max_wait}
+
+    def add(self, member):
+        """
+        Queues a member that joined the server
+        Args:
+            member (discord.Member) - the member
+        Returns:
+            None
+        """
+        #A member that rejoins within the window is only handled once per server
+        key = (member.server.id, member.id)
+        self._waiting.pop(key, None)
+        self._waiting[key] = (member, time.monotonic())
+        self._arrived.set()
+        if len(self._waiting) >= self.max_batch:
+            self._full.set()
+
+    def _take(self):
+        waiting = list(self._waiting.values())[:self.max_batch]
+        for member, joined in waiting:
+            del self._waiting[(member.server.id, member.id)]
+        if not self._waiting:
+            self._arrived.clear()
+        if len(self._waiting) < self.max_batch:
+            self._full.clear()
+        return waiting
+
+    async def run(self):
+        """
+        Hands batches to the handler until cancelled
+        Args:
+            None
+        Returns:
+            None
+        """
+        while True:
+            await self._arrived.wait()
+            if not self._full.is_set():
+                #The window is counted from the oldest waiting member
+                oldest = next(iter(self._waiting.values()))[1]
+                try:
+                    await asyncio.wait_for(self._full.wait(), max(0, oldest + self.window - time.monotonic()))
+                except asyncio.TimeoutError:
+                    pass
+            waiting = self._take()
+            if not waiting:
+                continue
+            now = time.monotonic()
+            self.batches += 1
+            self.members += len(waiting)
+            self.largest = max(self.largest, len(waiting))
+            self.max_wait = max(self.max_wait, now - waiting[0][1])
+            try:
+                await self.handler([member for member, joined in waiting])
+            except Exception as e:
+                app.logger.error('Exception in JoinBatcher handler: ' + str(e))
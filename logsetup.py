@@ -0,0 +1,128 @@
+import atexit
+import datetime
+import json
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+from metrics import Counter
+
+LOG_RECORDS_DROPPED = Counter('log_records_dropped_total', 'Log records dropped because the log queue was full')
+
+TEXT_FORMAT = '{asctime} [{levelname}] {message}'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as one JSON object per line, for log shippers
+    """
+    def format(self, record):
+        entry = {
+            'time': datetime.datetime.utcfromtimestamp(record.created).isoformat() + 'Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry)
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Hands records to a listener thread without ever blocking the caller.
+    The queue is bounded. When it is full because the handlers are stalled,
+    e.g. on a slow disk, records are dropped and counted instead of waiting,
+    and the next record that fits is preceded by a warning with the number
+    dropped. Only the message arguments are merged in the calling thread,
+    timestamps and the final formatting are done by the listener.
+    Args:
+        log_queue (queue.Queue) - bounded queue the listener reads
+    """
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+        self._unreported = 0
+        self._exceptions = logging.Formatter()
+
+    def prepare(self, record):
+        #The arguments may change after the call returns, so the message is fixed now
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = self._exceptions.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self._unreported:
+            warning = logging.LogRecord(record.name, logging.WARNING, __file__, 0,
+                'Dropped {} log records, the log queue was full'.format(self._unreported), None, None)
+            try:
+                self.queue.put_nowait(warning)
+                self._unreported = 0
+            except queue.Full:
+                pass
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            self._unreported += 1
+            LOG_RECORDS_DROPPED.inc()
+
+def make_formatter(style):
+    """
+    Builds the formatter of the log handlers
+    Args:
+        style (str) - 'text' or 'json'
+    Returns:
+        logging.Formatter
+    """
+    if style == 'json':
+        return JsonFormatter()
+    return logging.Formatter(style='{', fmt=TEXT_FORMAT, datefmt=DATE_FORMAT)
+
+def setup_logging(logger, config):
+    """
+    Sends a logger's records to the console and the log file from the 'LOGGING' section of config.json.
+    With QUEUE_SIZE set, which is the default, the console and file handlers
+    run on a listener thread behind a bounded queue, so logging never waits
+    on a write. A QUEUE_SIZE of 0 attaches them directly, as before.
+    Args:
+        logger (logging.Logger) - logger to set up
+        config (dict) - parsed config.json
+    Returns:
+        logging.handlers.QueueListener: the running listener, None if the handlers are attached directly
+    """
+    logConfig = config['LOGGING']
+    levels = logConfig['LEVEL']
+    formatter = make_formatter(logConfig.get('FORMAT', 'text'))
+    logger.setLevel(levels['ALL'])
+
+    handlers = []
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(formatter)
+    handler.setLevel(levels['CONSOLE'])
+    handlers.append(handler)
+    handler = logging.FileHandler(logConfig['FILE'])
+    handler.setFormatter(formatter)
+    handler.setLevel(levels['FILE'])
+    handlers.append(handler)
+
+    queueSize = logConfig.get('QUEUE_SIZE', 10000)
+    if not queueSize:
+        for handler in handlers:
+            logger.addHandler(handler)
+        return None
+
+    queueHandler = DroppingQueueHandler(queue.Queue(queueSize))
+    #Records no handler would write are filtered before they are queued
+    queueHandler.setLevel(min(levels['CONSOLE'], levels['FILE']))
+    logger.addHandler(queueHandler)
+    listener = QueueListener(queueHandler.queue, *handlers, respect_handler_level=True)
+    listener.start()
+    #Write out what is still queued when the process exits
+    atexit.register(listener.stop)
+    return listener
@@ -0,0 +1,225 @@
+import asyncio
+import bisect
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class Registry:
+    """
+    Collection of metrics rendered together in the Prometheus text format.
+    Recording a value only updates a number in memory, all formatting is done
+    when the metrics are scraped.
+    """
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def collector(self, function):
+        """
+        Adds a function that is called on every scrape, e.g. to read queue depths into gauges
+        Args:
+            function (callable) - called without arguments
+        Returns:
+            callable: the function
+        """
+        self.collectors.append(function)
+        return function
+
+    def render(self):
+        """
+        Renders every metric
+        Args:
+            None
+        Returns:
+            str: metrics in the Prometheus text exposition format
+        """
+        for function in self.collectors:
+            try:
+                function()
+            except Exception:
+                pass
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+REGISTRY = Registry()
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+def _labels(names, values, extra=None):
+    pairs = ['{}="{}"'.format(name, _escape(value)) for name, value in zip(names, values)]
+    if extra is not None:
+        pairs.append('{}="{}"'.format(extra[0], extra[1]))
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError('{} takes labels {}'.format(self.name, self.labelnames))
+        return tuple(str(value) for value in labels)
+
+    def render(self):
+        if not self._values and self.labelnames:
+            return []
+        lines = ['# HELP {} {}'.format(self.name, self.documentation), '# TYPE {} {}'.format(self.name, self.kind)]
+        with self._lock:
+            values = sorted(self._values.items())
+        if not values:
+            values = [((), 0)]
+        for labels, value in values:
+            lines.extend(self._samples(labels, value))
+        return lines
+
+    def _samples(self, labels, value):
+        return ['{}{} {}'.format(self.name, _labels(self.labelnames, labels), _number(value))]
+
+class Counter(_Metric):
+    """
+    Value that only goes up
+    Args:
+        name (str) - metric name, ending in _total
+        documentation (str) - help text
+        labelnames (tuple) - names of the labels
+        registry (Registry) - registry the metric is part of
+    """
+    kind = 'counter'
+
+    def inc(self, labels=(), amount=1):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    """
+    Value that goes up and down
+    Args:
+        name (str) - metric name
+        documentation (str) - help text
+        labelnames (tuple) - names of the labels
+        registry (Registry) - registry the metric is part of
+    """
+    kind = 'gauge'
+
+    def set(self, value, labels=()):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+class Histogram(_Metric):
+    """
+    Distribution of observed values, e.g. latencies in seconds
+    Args:
+        name (str) - metric name
+        documentation (str) - help text
+        labelnames (tuple) - names of the labels
+        buckets (tuple) - upper bounds of the buckets, in increasing order
+        registry (Registry) - registry the metric is part of
+    """
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, labels=()):
+        """
+        Observes how long the body of a with statement took
+        Args:
+            labels (tuple) - label values
+        Returns:
+            None
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, labels)
+
+    def _samples(self, labels, value):
+        if not isinstance(value, list):
+            value = [[0] * (len(self.buckets) + 1), 0.0]
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(self.name, _labels(self.labelnames, labels, ('le', _number(bound))), cumulative))
+        lines.append('{}_sum{} {}'.format(self.name, _labels(self.labelnames, labels), _number(total)))
+        lines.append('{}_count{} {}'.format(self.name, _labels(self.labelnames, labels), cumulative))
+        return lines
+
+def endpoint_label(path):
+    """
+    Turns a request path into a label with the ids replaced, so every character does not get a series of its own
+    Args:
+        path (str) - e.g. '/characters/123/'
+    Returns:
+        str: e.g. '/characters/{id}/'
+    """
+    return re.sub(r'/\d+(?=/|$)', '/{id}', path)
+
+async def serve(registry, host='127.0.0.1', port=9101):
+    """
+    Serves GET /metrics on a small HTTP listener
+    Args:
+        registry (Registry) - metrics to serve
+        host (str) - address to bind
+        port (int) - port to bind
+    Returns:
+        asyncio.AbstractServer
+    """
+    async def handle(reader, writer):
+        try:
+            requestLine = await reader.readline()
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            parts = requestLine.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, contentType, body = '200 OK', CONTENT_TYPE, registry.render().encode()
+            else:
+                status, contentType, body = '404 Not Found', 'text/plain', b'Not found\n'
+            writer.write('HTTP/1.0 {}\r\nContent-Type: {}\r\nContent-Length: {}\r\nConnection: close\r\n\r\n'.format(
+                status, contentType, len(body)).encode() + body)
+            await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+    #Serves on the loop that awaits this coroutine
+    return await asyncio.start_server(handle, host, port)
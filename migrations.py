@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+"""
+Schema migrations for databases created by older versions.
+Tables that do not exist yet are created by db.create_all(), the migrations
+below change tables that already exist. Every migration runs once and the
+highest applied version is stored in the schema_version table.
+"""
+import argparse
+
+from sqlalchemy import inspect
+
+from app import app, db
+from models import *
+
+def _columns(connection, table):
+    return set(column['name'] for column in inspect(connection).get_columns(table))
+
+def _add_column(connection, table, column, ddl):
+    if column not in _columns(connection, table):
+        connection.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(table, column, ddl))
+
+def _indexes(connection, table):
+    return set(index['name'] for index in inspect(connection).get_indexes(table))
+
+def _add_index(connection, index):
+    if index.name not in _indexes(connection, index.table.name):
+        index.create(connection)
+
+def affiliation_snapshot(connection):
+    _add_column(connection, 'discord_users', 'affiliation_checked', 'DATETIME')
+    _add_column(connection, 'discord_users', 'affiliation_expires', 'DATETIME')
+
+def storage_profile(connection):
+    #WAL is a property of the database file, the other pragmas are set per connection
+    if connection.dialect.name == 'sqlite' and db.profile.get('JOURNAL_MODE'):
+        connection.execute('PRAGMA journal_mode={}'.format(db.profile['JOURNAL_MODE']))
+
+def discord_user_indexes(connection):
+    for index in DiscordUser.__table__.indexes:
+        _add_index(connection, index)
+    if connection.dialect.name == 'sqlite':
+        #Give the query planner statistics to choose between the new indexes
+        connection.execute('ANALYZE discord_users')
+
+def invalid_character_expiry(connection):
+    _add_column(connection, 'invalid_characters', 'expires', 'DATETIME')
+
+def link_removal_retries(connection):
+    _add_column(connection, 'discord_link_removal', 'attempts', 'INTEGER NOT NULL DEFAULT 0')
+    _add_column(connection, 'discord_link_removal', 'next_attempt', 'DATETIME')
+
+MIGRATIONS = [
+    (1, 'Affiliation snapshot columns on discord_users', affiliation_snapshot),
+    (2, 'SQLite journal mode from the storage profile', storage_profile),
+    (3, 'Secondary indexes on discord_users', discord_user_indexes),
+    (4, 'Expiry of the invalid character cache', invalid_character_expiry),
+    (5, 'Retry columns on discord_link_removal', link_removal_retries),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+def current_version():
+    """
+    Returns the schema version of the database
+    Args:
+        None
+    Returns:
+        int: highest applied migration, 0 if none
+    """
+    row = SchemaVersion.query.order_by(SchemaVersion.version.desc()).first()
+    return row.version if row is not None else 0
+
+def stamp(version=LATEST_VERSION):
+    """
+    Marks the database as being at a version without running migrations
+    Args:
+        version (int) - version to record
+    Returns:
+        None
+    """
+    SchemaVersion.query.delete()
+    db.session.add(SchemaVersion(version))
+    db.session.commit()
+
+def upgrade():
+    """
+    Creates missing tables and runs every migration that has not been applied
+    Args:
+        None
+    Returns:
+        int: number of migrations applied
+    """
+    db.create_all()
+    version = current_version()
+    applied = 0
+    for migrationVersion, description, migration in MIGRATIONS:
+        if migrationVersion <= version:
+            continue
+        app.logger.info('Applying migration {}: {}'.format(migrationVersion, description))
+        with db.engine.begin() as connection:
+            migration(connection)
+        stamp(migrationVersion)
+        applied += 1
+    return applied
+
+def status():
+    """
+    Describes every migration and whether it has been applied
+    Args:
+        None
+    Returns:
+        list: (version, description, applied) tuples
+    """
+    version = current_version()
+    return [(migrationVersion, description, migrationVersion <= version) for migrationVersion, description, migration in MIGRATIONS]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Upgrades the database schema, safe to run repeatedly')
+    parser.add_argument('command', nargs='?', default='upgrade', choices=['upgrade', 'status', 'stamp'])
+    parser.add_argument('version', nargs='?', type=int, default=LATEST_VERSION, help='version recorded by stamp')
+    args = parser.parse_args()
+
+    if args.command == 'upgrade':
+        print('Applied {} migrations, database is at version {}'.format(upgrade(), current_version()))
+    elif args.command == 'status':
+        db.create_all()
+        for migrationVersion, description, applied in status():
+            print('{:>3} {:<8} {}'.format(migrationVersion, 'applied' if applied else 'pending', description))
+    else:
+        stamp(args.version)
+        print('Database stamped at version {}'.format(args.version))
@@ -5,6 +5,14 @@ import random
 class DiscordUser(db.Model):
 
 	__tablename__ = "discord_users"
+	__table_args__ = (
+		#Roster scans and the affiliation sweep, which walks on-server users by character_id
+		db.Index('ix_discord_users_on_server_character_id', 'on_server', 'character_id'),
+		db.Index('ix_discord_users_on_server_affiliation_expires', 'on_server', 'affiliation_expires'),
+		#Corp and alliance based role lookups
+		db.Index('ix_discord_users_corporation_id', 'corporation_id'),
+		db.Index('ix_discord_users_alliance_id', 'alliance_id'),
+	)
 
 	id = db.Column(db.Integer, primary_key=True)
 	date = db.Column(db.DateTime, nullable=False)
@@ -16,6 +24,8 @@ class DiscordUser(db.Model):
 	discord_name= db.Column(db.String, unique=True, nullable = False)
 	discord_avatar = db.Column(db.String)
 	on_server = db.Column(db.Boolean, nullable = False)
+	affiliation_checked = db.Column(db.DateTime)
+	affiliation_expires = db.Column(db.DateTime)
 
 	def __init__(self,character_name,character_id,corporation_id,alliance_id,discord_id,discord_name,discord_avatar,on_server=False):
 		self.date = datetime.utcnow()
@@ -36,9 +46,125 @@ class DiscordLinkRemoval(db.Model):
 	__tablename__ = "discord_link_removal"
 
 	discord_id = db.Column(db.String, unique=True, nullable = False, primary_key=True)
+	attempts = db.Column(db.Integer, nullable = False, default=0)
+	next_attempt = db.Column(db.DateTime)
 
 	def __init__(self, discord_id):
 		self.discord_id = discord_id
+		self.attempts = 0
 
 	def __repre(self):
-		return '{}'.format(self.discord_id)
\ No newline at end of file
+		return '{}'.format(self.discord_id)
+
+class EntityTicker(db.Model):
+
+	__tablename__ = "entity_tickers"
+
+	entity_type = db.Column(db.String, primary_key=True)
+	entity_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+	ticker = db.Column(db.String, nullable = False)
+	etag = db.Column(db.String)
+	expires = db.Column(db.DateTime, nullable = False)
+
+	def __init__(self, entity_type, entity_id, ticker, etag, expires):
+		self.entity_type = entity_type
+		self.entity_id = entity_id
+		self.ticker = ticker
+		self.etag = etag
+		self.expires = expires
+
+	def __repr__(self):
+		return '{},{},{},{}'.format(self.entity_type,self.entity_id,self.ticker,self.expires)
+
+class InvalidCharacter(db.Model):
+
+	__tablename__ = "invalid_characters"
+
+	character_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+	detected = db.Column(db.DateTime, nullable = False)
+	expires = db.Column(db.DateTime)
+
+	def __init__(self, character_id, detected, expires=None):
+		self.character_id = character_id
+		self.detected = detected
+		self.expires = expires
+
+	def __repr__(self):
+		return '{},{},{}'.format(self.character_id,self.detected,self.expires)
+
+class LinkJob(db.Model):
+
+	__tablename__ = "link_jobs"
+	__table_args__ = (
+		db.Index('ix_link_jobs_status_id', 'status', 'id'),
+	)
+
+	PENDING = 'pending'
+	DONE = 'done'
+	FAILED = 'failed'
+
+	id = db.Column(db.Integer, primary_key=True)
+	created = db.Column(db.DateTime, nullable = False)
+	character_name = db.Column(db.String, nullable = False)
+	character_id = db.Column(db.Integer, nullable = False)
+	discord_id = db.Column(db.String, nullable = False)
+	discord_name = db.Column(db.String, nullable = False)
+	discord_avatar = db.Column(db.String)
+	status = db.Column(db.String, nullable = False)
+	attempts = db.Column(db.Integer, nullable = False)
+	error = db.Column(db.String)
+	finished = db.Column(db.DateTime)
+
+	def __init__(self,character_name,character_id,discord_id,discord_name,discord_avatar):
+		self.created = datetime.utcnow()
+		self.character_name = character_name
+		self.character_id = character_id
+		self.discord_id = discord_id
+		self.discord_name = discord_name
+		self.discord_avatar = discord_avatar
+		self.status = LinkJob.PENDING
+		self.attempts = 0
+
+	def __repr__(self):
+		return '{},{},{},{},{}'.format(self.id,self.character_id,self.discord_id,self.status,self.attempts)
+
+class SweepLease(db.Model):
+
+	__tablename__ = "sweep_leases"
+
+	partition = db.Column(db.Integer, primary_key=True, autoincrement=False)
+	owner = db.Column(db.String)
+	expires = db.Column(db.DateTime)
+	heartbeat = db.Column(db.DateTime)
+
+	def __init__(self, partition):
+		self.partition = partition
+
+	def __repr__(self):
+		return '{},{},{}'.format(self.partition,self.owner,self.expires)
+
+class MemberRefresh(db.Model):
+
+	__tablename__ = "member_refreshes"
+
+	discord_id = db.Column(db.String, primary_key=True)
+	queued = db.Column(db.DateTime, nullable = False)
+
+	def __init__(self, discord_id, queued):
+		self.discord_id = discord_id
+		self.queued = queued
+
+	def __repr__(self):
+		return '{},{}'.format(self.discord_id,self.queued)
+
+class SchemaVersion(db.Model):
+
+	__tablename__ = "schema_version"
+
+	version = db.Column(db.Integer, primary_key=True, autoincrement=False)
+
+	def __init__(self, version):
+		self.version = version
+
+	def __repr__(self):
+		return '{}'.format(self.version)
@@ -0,0 +1,64 @@
+import asyncio
+import time
+
+from app import app
+
+class LoopMonitor:
+    """
+    Detects event loop iterations that block for too long.
+    A coroutine sleeps for a short interval and measures how late it wakes
+    up. Lateness beyond the threshold means something ran on the loop
+    without yielding, and is logged as a warning.
+    Args:
+        loop (asyncio.AbstractEventLoop) - loop to watch
+        interval (float) - seconds between measurements
+        threshold (float) - lateness in seconds that is reported
+    """
+    def __init__(self, loop=None, interval=0.5, threshold=0.25):
+        self.loop = loop or asyncio.get_event_loop()
+        self.interval = interval
+        self.threshold = threshold
+        self.stalls = 0
+        self.stalled_seconds = 0.0
+        self.max_stall = 0.0
+
+    @classmethod
+    def from_config(cls, config, loop=None):
+        """
+        Builds a monitor from the 'LOOP_MONITOR' section of config.json
+        Args:
+            config (dict) - parsed config.json
+            loop (asyncio.AbstractEventLoop) - loop to watch
+        Returns:
+            LoopMonitor
+        """
+        monitorConfig = config.get('LOOP_MONITOR', {})
+        return cls(loop=loop, interval=monitorConfig.get('INTERVAL', 0.5), threshold=monitorConfig.get('THRESHOLD', 0.25))
+
+    def stats(self):
+        """
+        Returns the stall counters
+        Args:
+            None
+        Returns:
+            dict: number of stalls, total and longest stall in seconds
+        """
+        return {'stalls': self.stalls, 'stalled_seconds': self.stalled_seconds, 'max_stall': self.max_stall}
+
+    async def run(self):
+        """
+        Measures the loop until cancelled
+        Args:
+            None
+        Returns:
+            None
+        """
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - start - self.interval
+            if lag > self.threshold:
+                self.stalls += 1
+                self.stalled_seconds += lag
+                self.max_stall = max(self.max_stall, lag)
+                app.logger.warning('Event loop was blocked for {:.3f} seconds'.format(lag))
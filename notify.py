@@ -0,0 +1,106 @@
+import asyncio
+import os
+import socket
+
+UNLINK = 'unlink'
+LINK = 'link'
+REFRESH = 'refresh'
+
+def send_notification(path, kind):
+    """
+    Wakes the bot up through its notification socket.
+    This is best effort: if the bot is not running the notification is
+    dropped, and the bot finds the work in the database on its next poll.
+    Args:
+        path (str) - path of the bot's unix socket
+        kind (str) - kind of notification, e.g. UNLINK
+    Returns:
+        bool: True if the notification was delivered to the socket
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        sock.setblocking(False)
+        sock.sendto(kind.encode(), path)
+        return True
+    except OSError:
+        return False
+    finally:
+        sock.close()
+
+class NotificationListener:
+    """
+    Receives notifications on a unix datagram socket and wakes the coroutines
+    waiting for them.
+    Args:
+        path (str) - path of the unix socket to bind
+        loop (asyncio.AbstractEventLoop) - loop the listener runs on
+    """
+    def __init__(self, path, loop=None):
+        self.path = path
+        self.loop = loop or asyncio.get_event_loop()
+        self.received = 0
+        self._events = {}
+        self._sock = None
+
+    def start(self):
+        """
+        Binds the socket and starts listening
+        Args:
+            None
+        Returns:
+            None
+        """
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.bind(self.path)
+        self._sock.setblocking(False)
+        self.loop.add_reader(self._sock.fileno(), self._read)
+
+    def close(self):
+        """
+        Stops listening and removes the socket
+        Args:
+            None
+        Returns:
+            None
+        """
+        if self._sock is None:
+            return
+        self.loop.remove_reader(self._sock.fileno())
+        self._sock.close()
+        self._sock = None
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def _event(self, kind):
+        if kind not in self._events:
+            self._events[kind] = asyncio.Event()
+        return self._events[kind]
+
+    def _read(self):
+        while True:
+            try:
+                data = self._sock.recv(1024)
+            except (BlockingIOError, InterruptedError):
+                return
+            self.received += 1
+            self._event(data.decode(errors='replace')).set()
+
+    async def wait(self, kind, timeout):
+        """
+        Waits until a notification of the given kind arrives
+        Args:
+            kind (str) - kind of notification, e.g. UNLINK
+            timeout (float) - seconds to wait before giving up
+        Returns:
+            bool: True if a notification arrived, False on timeout
+        """
+        event = self._event(kind)
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            event.clear()
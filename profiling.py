@@ -0,0 +1,229 @@
+import cProfile
+import datetime
+import json
+import os
+import random
+import time
+from contextlib import contextmanager
+
+from app import app
+
+class Trace:
+    """
+    Timing of one background cycle, split into phases.
+    Spans of the same phase are added up, so a phase entered once per member
+    shows its total time and how often it ran. Spans may be nested, e.g.
+    ticker lookups inside the diff, in which case the outer phase includes
+    the inner one.
+    Args:
+        task (str) - name of the background task, e.g. 'corp_check'
+    """
+    def __init__(self, task):
+        self.task = task
+        self.started = datetime.datetime.utcnow()
+        self.start = time.perf_counter()
+        self.duration = None
+        self.phases = {}
+        self.fields = {}
+        self.error = None
+        self.profile = None
+
+    @contextmanager
+    def span(self, phase):
+        """
+        Times the body of a with statement as part of a phase
+        Args:
+            phase (str) - name of the phase, e.g. 'db_read'
+        Returns:
+            None
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry = self.phases.setdefault(phase, [0, 0.0])
+            entry[0] += 1
+            entry[1] += time.perf_counter() - start
+
+    def annotate(self, **fields):
+        """
+        Adds fields to the trace record, e.g. the number of members handled
+        Args:
+            fields - values to record, must be JSON serializable
+        Returns:
+            None
+        """
+        self.fields.update(fields)
+
+    def record(self):
+        """
+        Returns the trace as a JSON serializable dict
+        Args:
+            None
+        Returns:
+            dict: task, start time, duration, phases and annotations
+        """
+        record = {
+            'task': self.task,
+            'started': self.started.isoformat() + 'Z',
+            'duration': round(self.duration, 6) if self.duration is not None else None,
+            'phases': dict((phase, {'count': count, 'seconds': round(seconds, 6)}) for phase, (count, seconds) in self.phases.items()),
+            'profiled': self.profile is not None
+        }
+        if self.error is not None:
+            record['error'] = self.error
+        record.update(self.fields)
+        return record
+
+class _NoTrace:
+    """
+    Trace that records nothing, used when profiling is off
+    """
+    @contextmanager
+    def span(self, phase):
+        yield
+
+    def annotate(self, **fields):
+        pass
+
+NO_TRACE = _NoTrace()
+
+class CycleProfiler:
+    """
+    Opt-in profiling of the bot's background cycles.
+    Every cycle produces a Trace whose phases are appended to a JSONL file,
+    one record per line. A sampled share of the cycles also runs under
+    cProfile. Per task, the profile of the slowest sampled cycle in every
+    window is kept and written to profile_dir when the window ends, for
+    analysis with pstats or snakeviz. cProfile sees everything the loop runs
+    while the cycle is in progress, including other tasks, and only one
+    cycle is profiled at a time.
+    Args:
+        enabled (bool) - whether cycles are traced at all
+        trace_file (str) - JSONL file the traces are appended to
+        profile_dir (str) - directory for the .prof files, None disables cProfile
+        profile_sample (float) - share of the cycles run under cProfile
+        profile_window (float) - seconds after which the slowest profile of each task is written
+    """
+    def __init__(self, enabled=False, trace_file='traces.jsonl', profile_dir=None, profile_sample=0.1, profile_window=3600):
+        self.enabled = enabled
+        self.trace_file = trace_file
+        self.profile_dir = profile_dir
+        self.profile_sample = profile_sample
+        self.profile_window = profile_window
+        self.traces = 0
+        self.profiles_written = 0
+        self._profiling = False
+        self._slowest = {}
+        self._window = time.monotonic()
+        self._file = None
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Builds a profiler from the 'PROFILING' section of config.json
+        Args:
+            config (dict) - parsed config.json
+        Returns:
+            CycleProfiler
+        """
+        profilingConfig = config.get('PROFILING', {})
+        return cls(enabled=profilingConfig.get('ENABLED', False),
+            trace_file=profilingConfig.get('TRACE_FILE', 'traces.jsonl'),
+            profile_dir=profilingConfig.get('PROFILE_DIR'),
+            profile_sample=profilingConfig.get('PROFILE_SAMPLE', 0.1),
+            profile_window=profilingConfig.get('PROFILE_WINDOW', 3600))
+
+    def stats(self):
+        """
+        Returns the profiler counters
+        Args:
+            None
+        Returns:
+            dict: traces written and profiles written
+        """
+        return {'traces': self.traces, 'profiles_written': self.profiles_written}
+
+    @contextmanager
+    def cycle(self, task):
+        """
+        Traces the body of a with statement as one cycle of a background task
+        Args:
+            task (str) - name of the task
+        Returns:
+            Trace: to record spans on, a no-op trace when profiling is off
+        """
+        if not self.enabled:
+            yield NO_TRACE
+            return
+        trace = Trace(task)
+        if self.profile_dir and not self._profiling and random.random() < self.profile_sample:
+            trace.profile = cProfile.Profile()
+            self._profiling = True
+            trace.profile.enable()
+        try:
+            yield trace
+        except Exception as e:
+            trace.error = str(e)
+            raise
+        finally:
+            if trace.profile is not None:
+                trace.profile.disable()
+                self._profiling = False
+            trace.duration = time.perf_counter() - trace.start
+            self._finish(trace)
+
+    def _finish(self, trace):
+        try:
+            self._write(trace.record())
+            if trace.profile is not None:
+                slowest = self._slowest.get(trace.task)
+                if slowest is None or trace.duration > slowest.duration:
+                    self._slowest[trace.task] = trace
+            if time.monotonic() - self._window >= self.profile_window:
+                self.dump()
+        except (OSError, ValueError) as e:
+            #Profiling must never take the task it watches down with it
+            app.logger.error('Exception in CycleProfiler: ' + str(e))
+
+    def _write(self, record):
+        if self._file is None:
+            self._file = open(self.trace_file, 'a')
+        self._file.write(json.dumps(record, sort_keys=True) + '\n')
+        self._file.flush()
+        self.traces += 1
+
+    def dump(self):
+        """
+        Writes the slowest profile of every task in the current window and starts a new window
+        Args:
+            None
+        Returns:
+            list: paths of the files written
+        """
+        paths = []
+        if self._slowest:
+            os.makedirs(self.profile_dir, exist_ok=True)
+        for task, trace in sorted(self._slowest.items()):
+            path = os.path.join(self.profile_dir, '{}-{}-{:.0f}ms.prof'.format(task, trace.started.strftime('%Y%m%dT%H%M%S'), trace.duration * 1000))
+            trace.profile.dump_stats(path)
+            paths.append(path)
+            self.profiles_written += 1
+            app.logger.info('Wrote profile of the slowest {} cycle ({:.3f} seconds) to {}'.format(task, trace.duration, path))
+        self._slowest = {}
+        self._window = time.monotonic()
+        return paths
+
+    def close(self):
+        """
+        Writes the pending profiles and closes the trace file
+        Args:
+            None
+        Returns:
+            None
+        """
+        if self._slowest:
+            self.dump()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
@@ -0,0 +1,95 @@
+from collections import namedtuple
+from functools import lru_cache
+
+NICKNAME_MAX_LENGTH = 32
+
+#The auth roles the member should have out of the managed ones, the other roles are read when the edit is sent
+MemberState = namedtuple('MemberState', ['nick', 'roles', 'managed'])
+
+#Sweeps build the same nicknames over and over, the result only depends on the arguments
+@lru_cache(maxsize=65536)
+def build_nickname(ticker, character_name):
+    """
+    Builds the nickname of an authenticated member, shortening it to fit Discord's limit
+    Args:
+        ticker (str) - alliance or corporation ticker
+        character_name (str) - name of the character
+    Returns:
+        str: '[TICKER] Character Name', with trailing names abbreviated if too long
+    """
+    nick = "[" + ticker + "] " + character_name
+    if len(nick) > NICKNAME_MAX_LENGTH:
+        temp = nick.split(" ")
+        nick = temp [0] + " " + temp [1] + " "
+        if len(temp) <= 2:
+            nick = "LONG USERNAME"
+        for i in range(2,len(temp)):
+            nick += temp[i].title()[0] + "."
+    return nick
+
+def _unmanaged_roles(member, managed):
+    return set(role for role in member.roles if not role.is_everyone and role not in managed)
+
+def desired_state(character_name, ticker, corp_id, role_index):
+    """
+    Computes the nickname and auth roles an authenticated member should have.
+    Roles the bot does not manage are not part of the state, they are left as
+    the member has them when the edit is sent.
+    Args:
+        character_name (str) - name of the linked character
+        ticker (str) - alliance or corporation ticker
+        corp_id (int) - id of the character's corporation
+        role_index (roles.RoleIndex) - resolved auth roles
+    Returns:
+        MemberState
+    """
+    roles = set(role_index.roles_for_corp(corp_id))
+    if role_index.base_role is not None:
+        roles.add(role_index.base_role)
+    return MemberState(build_nickname(ticker, character_name), roles, role_index.resolved_roles)
+
+def unlinked_state(role_index):
+    """
+    Computes the nickname and auth roles of a member that removed their authentication
+    Args:
+        role_index (roles.RoleIndex) - resolved auth roles
+    Returns:
+        MemberState: no nickname and none of the auth roles
+    """
+    return MemberState(None, set(), role_index.resolved_roles)
+
+def diff_member(member, desired):
+    """
+    Compares a member against their desired state.
+    The member's current roles the bot does not manage are kept, so roles
+    given or taken by admins or other bots while an edit was queued survive.
+    Args:
+        member (discord.Member) - the member, as fresh as possible
+        desired (MemberState) - state the member should be in
+    Returns:
+        dict: fields of the member edit, empty if nothing differs
+    """
+    fields = {}
+    if member.nick != desired.nick:
+        #An empty nickname resets it to the username
+        fields['nick'] = desired.nick or ''
+    current = set(role for role in member.roles if not role.is_everyone)
+    roles = _unmanaged_roles(member, desired.managed) | desired.roles
+    if current != roles:
+        fields['roles'] = [role.id for role in roles]
+    return fields
+
+async def apply_member_edit(bot, member, fields):
+    """
+    Applies a member edit as a single Discord API request
+    Args:
+        bot (discord.Client) - the bot
+        member (discord.Member) - the member to edit
+        fields (dict) - fields returned by diff_member()
+    Returns:
+        bool: True if a request was made
+    """
+    if not fields:
+        return False
+    await bot.http.edit_member(member.server.id, member.id, **fields)
+    return True
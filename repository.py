@@ -0,0 +1,487 @@
+import asyncio
+import datetime
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import bindparam
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from app import db
+from metrics import Histogram
+from models import *
+from tickers import ALLIANCE
+
+QUERY_CHUNK_SIZE = 500
+
+LinkedUser = namedtuple('LinkedUser', ['discord_id', 'character_id', 'character_name', 'discord_name'])
+
+DB_CALL_SECONDS = Histogram('bot_db_call_seconds', 'Time the bot spent in a repository call, including waiting for the pool and the commit',
+    ('call',))
+
+class BotRepository:
+    """
+    Database access for the bot, run off the event loop.
+    Every method runs its SQLAlchemy work on a small thread pool with a
+    session of its own, so a database locked by a web worker blocks a pool
+    thread instead of the whole bot. Returned rows are detached from their
+    session and can be read, but not lazily loaded or modified.
+    Args:
+        loop (asyncio.AbstractEventLoop) - loop the bot runs on
+        workers (int) - number of database threads
+    """
+    def __init__(self, loop=None, workers=2):
+        self.loop = loop or asyncio.get_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.Session = scoped_session(sessionmaker(bind=db.engine, expire_on_commit=False))
+
+    @classmethod
+    def from_config(cls, config, loop=None):
+        """
+        Builds a repository from the 'BOT_DATABASE' section of config.json
+        Args:
+            config (dict) - parsed config.json
+            loop (asyncio.AbstractEventLoop) - loop the bot runs on
+        Returns:
+            BotRepository
+        """
+        return cls(loop=loop, workers=config.get('BOT_DATABASE', {}).get('WORKERS', 2))
+
+    def close(self):
+        """
+        Waits for running queries and stops the thread pool
+        Args:
+            None
+        Returns:
+            None
+        """
+        self.executor.shutdown(wait=True)
+
+    async def run(self, function, *args):
+        """
+        Runs a function on the thread pool with a fresh session
+        Args:
+            function (callable) - called as function(session, *args)
+            args (list) - extra arguments
+        Returns:
+            object: whatever the function returned
+        """
+        #Lambdas are named after the method they are defined in
+        with DB_CALL_SECONDS.time((function.__qualname__.split('.<locals>')[0],)):
+            return await self.loop.run_in_executor(self.executor, self._call, function, args)
+
+    def _call(self, function, args):
+        session = self.Session()
+        try:
+            return function(session, *args)
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            self.Session.remove()
+
+    async def get_off_server_users(self):
+        """
+        Returns every user not marked as being on the server
+        Args:
+            None
+        Returns:
+            list: DiscordUser rows
+        """
+        return await self.run(lambda session: session.query(DiscordUser).filter(DiscordUser.on_server == False).all())
+
+    async def get_user_by_discord_id(self, discordID):
+        """
+        Returns the user linked to a discord account
+        Args:
+            discordID (str) - id of the discord account
+        Returns:
+            DiscordUser: None if the account is not linked
+        """
+        return await self.run(lambda session: session.query(DiscordUser).filter(DiscordUser.discord_id == discordID).first())
+
+    async def get_users_by_discord_id(self, discordIDs):
+        """
+        Returns the users linked to a list of discord accounts
+        Args:
+            discordIDs (list) - ids of the discord accounts
+        Returns:
+            dict: DiscordUser keyed by discord_id
+        """
+        return await self.run(_users_by_discord_id, list(discordIDs))
+
+    async def get_users_by_entity(self, entity_type, entity_id):
+        """
+        Returns the on-server users whose nickname shows the ticker of a corporation or alliance
+        Args:
+            entity_type (str) - tickers.CORPORATION or tickers.ALLIANCE
+            entity_id (int) - id of the corporation or alliance
+        Returns:
+            list: DiscordUser rows
+        """
+        return await self.run(_users_by_entity, entity_type, entity_id)
+
+    async def get_due_users(self, now, cursor, batch, partition=None, partitions=1):
+        """
+        Returns on-server users whose affiliation snapshot expired, continuing after a cursor
+        Args:
+            now (datetime.datetime) - current UTC time
+            cursor (int) - character_id the previous batch ended at
+            batch (int) - maximum number of users to return
+            partition (int) - only return users of this partition, None for all
+            partitions (int) - number of partitions the roster is split into
+        Returns:
+            list: DiscordUser rows ordered by character_id, wrapping around after the last one
+        """
+        return await self.run(_due_users, now, cursor, batch, partition, partitions)
+
+    async def count_on_server_users(self, partition=None, partitions=1):
+        """
+        Counts the users marked as being on the server
+        Args:
+            partition (int) - only count users of this partition, None for all
+            partitions (int) - number of partitions the roster is split into
+        Returns:
+            int: number of users
+        """
+        return await self.run(lambda session: _on_server(session.query(DiscordUser), partition, partitions).count())
+
+    async def pop_pending_removals(self, limit, now):
+        """
+        Returns a batch of unlink requests that are due.
+        The requests stay in the table until they are deleted through the
+        write buffer, so nothing is lost if the bot stops halfway. Requests
+        waiting for a retry are left out until their next attempt, so they
+        cannot hold up new ones.
+        Args:
+            limit (int) - maximum number of requests
+            now (datetime.datetime) - current UTC time
+        Returns:
+            list: DiscordLinkRemoval rows, new requests first
+        """
+        return await self.run(lambda session: session.query(DiscordLinkRemoval).filter(
+            db.or_(DiscordLinkRemoval.next_attempt == None, DiscordLinkRemoval.next_attempt <= now))
+            .order_by(DiscordLinkRemoval.attempts, DiscordLinkRemoval.discord_id).limit(limit).all())
+
+    async def next_removal_due(self):
+        """
+        Returns when the next unlink request is due
+        Args:
+            None
+        Returns:
+            datetime.datetime: next attempt of the earliest request, datetime.min if a request is due right away,
+                None if there are no requests
+        """
+        return await self.run(_next_removal_due)
+
+    async def get_ticker(self, entity_type, entity_id):
+        """
+        Returns a stored ticker
+        Args:
+            entity_type (str) - 'corporation' or 'alliance'
+            entity_id (int) - id of the corporation or alliance
+        Returns:
+            EntityTicker: None if it was never stored
+        """
+        return await self.run(lambda session: session.query(EntityTicker).filter(
+            EntityTicker.entity_type == entity_type, EntityTicker.entity_id == entity_id).first())
+
+    async def save_ticker(self, ticker):
+        """
+        Inserts or updates a stored ticker
+        Args:
+            ticker (EntityTicker) - ticker to store
+        Returns:
+            None
+        """
+        await self.run(_merge, ticker)
+
+    async def add_invalid_characters(self, character_ids, detected, expires):
+        """
+        Records characters ESI reported as no longer existing
+        Args:
+            character_ids (iterable) - character ids
+            detected (datetime.datetime) - when they were detected
+            expires (datetime.datetime) - when they are checked again
+        Returns:
+            None
+        """
+        await self.run(_merge_all, [InvalidCharacter(characterID, detected, expires) for characterID in character_ids])
+
+    async def remove_invalid_characters(self, character_ids):
+        """
+        Forgets characters that turned out to exist after all
+        Args:
+            character_ids (list) - character ids
+        Returns:
+            None
+        """
+        await self.run(_remove_invalid_characters, list(character_ids))
+
+    async def get_pending_link_jobs(self, limit):
+        """
+        Returns the oldest link jobs that still have to be resolved
+        Args:
+            limit (int) - maximum number of jobs
+        Returns:
+            list: LinkJob rows
+        """
+        return await self.run(lambda session: session.query(LinkJob).filter(LinkJob.status == LinkJob.PENDING)
+            .order_by(LinkJob.id).limit(limit).all())
+
+    async def finish_link_jobs(self, outcomes, now, max_attempts):
+        """
+        Completes resolved link jobs.
+        A job with an affiliation creates its DiscordUser, a job with an error
+        fails and a job with neither is retried until max_attempts is reached.
+        Args:
+            outcomes (dict) - {job id: (esi.Affiliation or None, error message or None)}
+            now (datetime.datetime) - current UTC time
+            max_attempts (int) - attempts after which a job that could not be resolved fails
+        Returns:
+            list: LinkedUser tuples of the jobs that created a link
+        """
+        return await self.run(_finish_link_jobs, outcomes, now, max_attempts)
+
+    async def pop_member_refreshes(self, limit):
+        """
+        Returns a batch of members whose affiliation a sweep worker changed.
+        Like unlink requests, they stay in the table until they are deleted
+        through the write buffer.
+        Args:
+            limit (int) - maximum number of refreshes
+        Returns:
+            list: MemberRefresh rows, oldest first
+        """
+        return await self.run(lambda session: session.query(MemberRefresh).order_by(MemberRefresh.queued).limit(limit).all())
+
+    async def ensure_leases(self, partitions):
+        """
+        Creates the lease rows of every partition that does not have one yet
+        Args:
+            partitions (int) - number of partitions
+        Returns:
+            None
+        """
+        await self.run(_ensure_leases, partitions)
+
+    async def get_leases(self):
+        """
+        Returns every sweep lease
+        Args:
+            None
+        Returns:
+            list: SweepLease rows ordered by partition
+        """
+        return await self.run(lambda session: session.query(SweepLease).order_by(SweepLease.partition).all())
+
+    async def claim_lease(self, partition, owner, now, ttl):
+        """
+        Takes or renews the lease of a partition.
+        The lease is only taken if it is free, expired or already held by the
+        owner, in a single UPDATE so two workers can never both get it.
+        Args:
+            partition (int) - partition to claim
+            owner (str) - id of the worker
+            now (datetime.datetime) - current UTC time
+            ttl (float) - seconds the lease stays valid without a heartbeat
+        Returns:
+            bool: True if the owner holds the lease
+        """
+        return await self.run(_claim_lease, partition, owner, now, ttl, False)
+
+    async def renew_lease(self, partition, owner, now, ttl):
+        """
+        Extends a lease the owner still holds
+        Args:
+            partition (int) - partition of the lease
+            owner (str) - id of the worker
+            now (datetime.datetime) - current UTC time
+            ttl (float) - seconds the lease stays valid without a heartbeat
+        Returns:
+            bool: False if the lease expired or was taken over
+        """
+        return await self.run(_claim_lease, partition, owner, now, ttl, True)
+
+    async def release_leases(self, owner):
+        """
+        Gives up every lease of a worker, so others can take the partitions over right away
+        Args:
+            owner (str) - id of the worker
+        Returns:
+            int: number of leases released
+        """
+        return await self.run(_release_leases, owner)
+
+    async def apply_sweep(self, partition, owner, now, ttl, updates, refreshes):
+        """
+        Stores the result of a partition sweep if the worker still holds the partition.
+        The lease is renewed in the same transaction as the writes, so a
+        worker that lost its lease while waiting on ESI cannot overwrite
+        the results of the worker that took over.
+        Args:
+            partition (int) - partition that was swept
+            owner (str) - id of the worker
+            now (datetime.datetime) - current UTC time
+            ttl (float) - seconds the lease stays valid without a heartbeat
+            updates (dict) - {DiscordUser id: {column: value}}
+            refreshes (list) - discord ids of members the bot has to update
+        Returns:
+            bool: False if the lease was lost and nothing was written
+        """
+        return await self.run(_apply_sweep, partition, owner, now, ttl, updates, refreshes)
+
+    async def apply_writes(self, updates, deletes):
+        """
+        Applies bulk updates and deletes with a single commit
+        Args:
+            updates (dict) - {model: {primary key: {column: value}}}
+            deletes (dict) - {model: iterable of primary keys}
+        Returns:
+            int: number of rows written
+        """
+        return await self.run(_apply_writes, updates, deletes)
+
+def _users_by_discord_id(session, discordIDs):
+    users = {}
+    #Stay below SQLite's limit on bound parameters per query
+    for i in range(0, len(discordIDs), QUERY_CHUNK_SIZE):
+        for row in session.query(DiscordUser).filter(DiscordUser.discord_id.in_(discordIDs[i:i + QUERY_CHUNK_SIZE])).all():
+            users[row.discord_id] = row
+    return users
+
+def _users_by_entity(session, entity_type, entity_id):
+    query = session.query(DiscordUser).filter(DiscordUser.on_server == True)
+    if entity_type == ALLIANCE:
+        return query.filter(DiscordUser.alliance_id == entity_id).all()
+    #Members of a corporation in an alliance show the alliance ticker
+    return query.filter(DiscordUser.corporation_id == entity_id, DiscordUser.alliance_id == None).all()
+
+def _on_server(query, partition, partitions):
+    query = query.filter(DiscordUser.on_server == True)
+    if partition is not None:
+        query = query.filter(DiscordUser.character_id % partitions == partition)
+    return query
+
+def _due_users(session, now, cursor, batch, partition, partitions):
+    due = _on_server(session.query(DiscordUser), partition, partitions).filter(
+        db.or_(DiscordUser.affiliation_expires == None, DiscordUser.affiliation_expires <= now))
+    rows = due.filter(DiscordUser.character_id > cursor).order_by(DiscordUser.character_id).limit(batch).all()
+    if len(rows) < batch:
+        #Wrap around to the start of the roster
+        rows += due.filter(DiscordUser.character_id <= cursor).order_by(DiscordUser.character_id).limit(batch - len(rows)).all()
+    return rows
+
+def _merge(session, row):
+    session.merge(row)
+    session.commit()
+
+def _merge_all(session, rows):
+    for row in rows:
+        session.merge(row)
+    session.commit()
+
+def _next_removal_due(session):
+    if session.query(DiscordLinkRemoval.discord_id).filter(DiscordLinkRemoval.next_attempt == None).first() is not None:
+        return datetime.datetime.min
+    return session.query(db.func.min(DiscordLinkRemoval.next_attempt)).scalar()
+
+def _remove_invalid_characters(session, characterIDs):
+    for i in range(0, len(characterIDs), QUERY_CHUNK_SIZE):
+        session.query(InvalidCharacter).filter(InvalidCharacter.character_id.in_(characterIDs[i:i + QUERY_CHUNK_SIZE])).delete(
+            synchronize_session=False)
+    session.commit()
+
+def _finish_link_jobs(session, outcomes, now, max_attempts):
+    linked = []
+    for job in session.query(LinkJob).filter(LinkJob.id.in_(list(outcomes))).all():
+        affiliation, error = outcomes[job.id]
+        #Every job gets a savepoint of its own, so one duplicate link does not fail the others
+        try:
+            with session.begin_nested():
+                job.attempts += 1
+                if affiliation is not None:
+                    session.add(DiscordUser(job.character_name, job.character_id, affiliation.corporation_id,
+                        affiliation.alliance_id, job.discord_id, job.discord_name, job.discord_avatar))
+                    job.status = LinkJob.DONE
+                elif error is not None or job.attempts >= max_attempts:
+                    job.status = LinkJob.FAILED
+                    job.error = error or "Your character could not be looked up, please try again later."
+                if job.status != LinkJob.PENDING:
+                    job.finished = now
+        except IntegrityError:
+            #Rolling back to the savepoint expired the job, it is loaded again with its old values
+            job.attempts += 1
+            job.status = LinkJob.FAILED
+            job.error = "This character or Discord account is already linked!"
+            job.finished = now
+            continue
+        if job.status == LinkJob.DONE:
+            linked.append(LinkedUser(job.discord_id, job.character_id, job.character_name, job.discord_name))
+    session.commit()
+    return linked
+
+def _ensure_leases(session, partitions):
+    existing = set(row.partition for row in session.query(SweepLease).all())
+    for partition in range(partitions):
+        if partition not in existing:
+            session.add(SweepLease(partition))
+    try:
+        session.commit()
+    except IntegrityError:
+        #Another worker created them at the same time
+        session.rollback()
+
+def _update_lease(session, partition, owner, now, ttl, renew_only):
+    query = session.query(SweepLease).filter(SweepLease.partition == partition)
+    if renew_only:
+        query = query.filter(SweepLease.owner == owner, SweepLease.expires >= now)
+    else:
+        query = query.filter(db.or_(SweepLease.owner == None, SweepLease.owner == owner, SweepLease.expires < now))
+    return query.update({'owner': owner, 'heartbeat': now, 'expires': now + datetime.timedelta(seconds=ttl)},
+        synchronize_session=False) == 1
+
+def _claim_lease(session, partition, owner, now, ttl, renew_only):
+    claimed = _update_lease(session, partition, owner, now, ttl, renew_only)
+    session.commit()
+    return claimed
+
+def _release_leases(session, owner):
+    released = session.query(SweepLease).filter(SweepLease.owner == owner).update({'owner': None, 'expires': None},
+        synchronize_session=False)
+    session.commit()
+    return released
+
+def _apply_sweep(session, partition, owner, now, ttl, updates, refreshes):
+    #Renewing first takes the write lock, so the lease cannot change before the commit
+    if not _update_lease(session, partition, owner, now, ttl, True):
+        session.rollback()
+        return False
+    _update_rows(session, DiscordUser, updates)
+    for discordID in refreshes:
+        session.merge(MemberRefresh(discordID, now))
+    session.commit()
+    return True
+
+def _update_rows(session, model, rows):
+    #Unlike bulk_update_mappings, an UPDATE matching no row is not an error, the row was deleted meanwhile
+    column = model.__mapper__.primary_key[0]
+    groups = {}
+    for key, fields in rows.items():
+        groups.setdefault(tuple(sorted(fields)), []).append(dict(fields, row_key=key))
+    for params in groups.values():
+        session.execute(model.__table__.update().where(column == bindparam('row_key')), params)
+    return len(rows)
+
+def _apply_writes(session, updates, deletes):
+    count = 0
+    for model, rows in updates.items():
+        count += _update_rows(session, model, rows)
+    for model, keys in deletes.items():
+        column = model.__mapper__.primary_key[0]
+        keys = list(keys)
+        for i in range(0, len(keys), QUERY_CHUNK_SIZE):
+            session.query(model).filter(column.in_(keys[i:i + QUERY_CHUNK_SIZE])).delete(synchronize_session=False)
+        count += len(keys)
+    session.commit()
+    return count
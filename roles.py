@@ -0,0 +1,88 @@
+from app import app
+
+class RoleIndex:
+    """
+    Maps corporations to the Discord roles configured for them.
+    The configured role names are resolved against the server's roles once,
+    and again whenever a role is created, deleted or updated, so deciding a
+    member's roles is a dictionary lookup.
+    Args:
+        base_role_name (str) - name of the role every authenticated member gets
+        auth_roles (list) - DISCORD_AUTH_ROLES entries with 'role_name' and 'corp_id'
+    """
+    def __init__(self, base_role_name, auth_roles):
+        self.base_role_name = base_role_name
+        self.auth_roles = auth_roles
+        self.base_role = None
+        self.corp_roles = {}
+        self.resolved_roles = set()
+        self.missing = []
+        self.built = False
+
+    @classmethod
+    def from_config(cls, config):
+        """
+        Builds an index from BASE_AUTH_ROLE and DISCORD_AUTH_ROLES in config.json
+        Args:
+            config (dict) - parsed config.json
+        Returns:
+            RoleIndex
+        """
+        return cls(config['BASE_AUTH_ROLE'], config['DISCORD_AUTH_ROLES'])
+
+    def rebuild(self, server):
+        """
+        Resolves the configured role names against the server's roles
+        Args:
+            server (discord.Server) - server the roles live on
+        Returns:
+            None
+        """
+        rolesByName = {}
+        for role in server.roles:
+            rolesByName.setdefault(role.name, role)
+
+        missing = []
+        self.base_role = rolesByName.get(self.base_role_name)
+        if self.base_role is None:
+            missing.append(self.base_role_name)
+
+        corpRoles = {}
+        for entry in self.auth_roles:
+            role = rolesByName.get(entry['role_name'])
+            if role is None:
+                missing.append(entry['role_name'])
+                continue
+            corpRoles.setdefault(entry['corp_id'], []).append(role)
+        self.corp_roles = corpRoles
+
+        self.resolved_roles = set(role for roles in corpRoles.values() for role in roles)
+        if self.base_role is not None:
+            self.resolved_roles.add(self.base_role)
+        self.missing = missing
+        self.built = True
+        for name in missing:
+            app.logger.error("Role " + name + " not found!")
+        app.logger.info("Role index rebuilt: {} corporations, {} roles".format(len(corpRoles), len(self.resolved_roles)))
+
+    def ensure(self, server):
+        """
+        Builds the index if it has not been built yet
+        Args:
+            server (discord.Server) - server the roles live on
+        Returns:
+            RoleIndex: self
+        """
+        if not self.built:
+            self.rebuild(server)
+        return self
+
+    def roles_for_corp(self, corp_id):
+        """
+        Returns the corporation roles for a corporation
+        Args:
+            corp_id (int) - id of the corporation
+        Returns:
+            list: discord.Role objects, without the base role
+        """
+        return self.corp_roles.get(corp_id, [])
@@ -0,0 +1,281 @@
+import asyncio
+import time
+from collections import deque
+
+import discord
+
+import reconcile
+from app import app
+from metrics import Counter, Histogram
+
+PRIORITY_JOIN = 0
+PRIORITY_UNLINK = 1
+PRIORITY_SWEEP = 2
+LANE_NAMES = ('join', 'unlink', 'sweep')
+
+#Results of a submitted edit. A rejected edit, e.g. for missing permissions, fails again when retried
+EDIT_DONE = 'done'
+EDIT_FAILED = 'failed'
+EDIT_REJECTED = 'rejected'
+
+DISCORD_REQUESTS = Counter('discord_requests_total', 'Discord API calls by type and result, "ok" or the HTTP status', ('type', 'result'))
+DISCORD_SECONDS = Histogram('discord_request_seconds', 'Time Discord API calls took, including discord.py retries', ('type',))
+
+class RouteBucket:
+    """
+    Client side model of a Discord rate limit bucket.
+    discord.py retries 429s on its own without exposing the rate limit
+    headers of successful responses, so requests are paced with a token
+    bucket, and the headers of rate limited responses push it back.
+    Args:
+        rate (int) - requests allowed per period
+        per (float) - length of the period in seconds
+    """
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def delay(self):
+        """
+        Takes a token from the bucket
+        Args:
+            None
+        Returns:
+            float: seconds to wait before the request may be sent
+        """
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate / self.per)
+        self.updated = now
+        self.tokens -= 1
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 0:
+            wait = max(wait, -self.tokens * self.per / self.rate)
+        return wait
+
+    def update_from_headers(self, headers):
+        """
+        Blocks the bucket as long as Discord's rate limit headers ask
+        Args:
+            headers (dict) - response headers
+        Returns:
+            float: seconds the bucket is blocked for
+        """
+        retryAfter = headers.get('Retry-After')
+        remaining = headers.get('X-RateLimit-Remaining')
+        reset = headers.get('X-RateLimit-Reset')
+        wait = 0.0
+        try:
+            if retryAfter is not None:
+                wait = float(retryAfter)
+                #Older API versions send milliseconds
+                if wait > 60:
+                    wait /= 1000
+            elif remaining == '0' and reset is not None:
+                wait = max(0.0, float(reset) - time.time())
+        except ValueError:
+            return 0.0
+        self.tokens = min(self.tokens, 0.0)
+        self.blocked_until = max(self.blocked_until, time.monotonic() + wait)
+        return wait
+
+class MemberEditScheduler:
+    """
+    Central queue for nickname and role edits.
+    Edits are kept in priority lanes, so joins and unlinks are sent before the
+    periodic sweep, and are paced per rate limit bucket. Every server has its
+    own lanes and send loop, so a throttled server does not hold up the edits
+    of the others. Submitting another
+    edit for a member that is still queued replaces the queued desired state
+    instead of adding a request. The desired state only holds the nickname
+    and the auth roles, it is diffed against the current member right before
+    sending, so roles changed by others while the edit was queued are kept
+    and edits that became unnecessary are dropped.
+    Args:
+        bot (discord.Client) - the bot
+        rate (int) - member edits allowed per period and guild
+        per (float) - length of the period in seconds
+    """
+    def __init__(self, bot, rate=10, per=10):
+        self.bot = bot
+        self.rate = rate
+        self.per = per
+        self.lanes = {}
+        self.pending = {}
+        self.buckets = {}
+        self.sent = 0
+        self.skipped = 0
+        self.coalesced = 0
+        self.failed = 0
+        self.rate_limited = 0
+        self._wakeup = asyncio.Event()
+        self._wakeups = {}
+
+    @classmethod
+    def from_config(cls, bot, config):
+        """
+        Builds a scheduler from the 'DISCORD_WRITES' section of config.json
+        Args:
+            bot (discord.Client) - the bot
+            config (dict) - parsed config.json
+        Returns:
+            MemberEditScheduler
+        """
+        writeConfig = config.get('DISCORD_WRITES', {})
+        return cls(bot, rate=writeConfig.get('RATE', 10), per=writeConfig.get('PER', 10))
+
+    def depth(self):
+        """
+        Returns the number of queued edits per lane
+        Args:
+            None
+        Returns:
+            dict: queued edits keyed by lane name
+        """
+        depth = dict((name, 0) for name in LANE_NAMES)
+        for entry in self.pending.values():
+            depth[LANE_NAMES[entry['priority']]] += 1
+        return depth
+
+    def stats(self):
+        """
+        Returns the scheduler counters and queue depths
+        Args:
+            None
+        Returns:
+            dict: sent, skipped, coalesced, failed and rate limited edits plus the depth of every lane
+        """
+        stats = {
+            'sent': self.sent,
+            'skipped': self.skipped,
+            'coalesced': self.coalesced,
+            'failed': self.failed,
+            'rate_limited': self.rate_limited
+        }
+        stats.update(self.depth())
+        return stats
+
+    def submit(self, member, desired, priority):
+        """
+        Queues an edit bringing a member to their desired state
+        Args:
+            member (discord.Member) - the member
+            desired (reconcile.MemberState) - nickname and auth roles the member should have
+            priority (int) - PRIORITY_JOIN, PRIORITY_UNLINK or PRIORITY_SWEEP
+        Returns:
+            asyncio.Future: resolves to EDIT_DONE once the member is in the desired state,
+                EDIT_FAILED or EDIT_REJECTED if the edit failed. None if nothing needs to change.
+        """
+        key = (member.server.id, member.id)
+        entry = self.pending.get(key)
+        if entry is None:
+            if not reconcile.diff_member(member, desired):
+                return None
+            entry = {'member': member, 'desired': desired, 'priority': priority, 'future': asyncio.Future()}
+            self.pending[key] = entry
+            self._lanes(member.server.id)[priority].append(key)
+        else:
+            self.coalesced += 1
+            entry['member'] = member
+            entry['desired'] = desired
+            if priority < entry['priority']:
+                entry['priority'] = priority
+                self._lanes(member.server.id)[priority].append(key)
+        self._wakeups[member.server.id].set()
+        return entry['future']
+
+    def _lanes(self, serverID):
+        if serverID not in self.lanes:
+            self.lanes[serverID] = tuple(deque() for _ in LANE_NAMES)
+            self._wakeups[serverID] = asyncio.Event()
+            #Tell run() to start a send loop for the new server
+            self._wakeup.set()
+        return self.lanes[serverID]
+
+    def _pop(self, lanes):
+        for priority, lane in enumerate(lanes):
+            while lane:
+                key = lane.popleft()
+                entry = self.pending.get(key)
+                #Entries that were moved to a faster lane leave a stale key behind
+                if entry is not None and entry['priority'] == priority:
+                    del self.pending[key]
+                    return key, entry
+        return None, None
+
+    def _bucket(self, serverID):
+        if serverID not in self.buckets:
+            self.buckets[serverID] = RouteBucket(self.rate, self.per)
+        return self.buckets[serverID]
+
+    async def run(self):
+        """
+        Runs a send loop for every server with queued edits until cancelled
+        Args:
+            None
+        Returns:
+            None
+        """
+        await self.bot.wait_until_ready()
+        workers = {}
+        try:
+            while True:
+                for serverID in list(self.lanes):
+                    if serverID not in workers:
+                        workers[serverID] = self.bot.loop.create_task(self._run_server(serverID))
+                self._wakeup.clear()
+                await self._wakeup.wait()
+        finally:
+            for worker in workers.values():
+                worker.cancel()
+
+    async def _run_server(self, serverID):
+        lanes = self.lanes[serverID]
+        wakeup = self._wakeups[serverID]
+        while True:
+            key, entry = self._pop(lanes)
+            if entry is None:
+                wakeup.clear()
+                await wakeup.wait()
+                continue
+            try:
+                result = await self._send(key, entry)
+            except Exception as e:
+                app.logger.error('Exception in MemberEditScheduler._run_server(): ' + str(e))
+                result = EDIT_FAILED
+            if not entry['future'].done():
+                entry['future'].set_result(result)
+
+    async def _send(self, key, entry):
+        serverID, memberID = key
+        member = entry['member'].server.get_member(memberID) or entry['member']
+        fields = reconcile.diff_member(member, entry['desired'])
+        if not fields:
+            self.skipped += 1
+            return EDIT_DONE
+        bucket = self._bucket(serverID)
+        wait = bucket.delay()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        app.logger.info("Updating %s of %s!", ", ".join(sorted(fields)), member.name)
+        start = time.perf_counter()
+        try:
+            await reconcile.apply_member_edit(self.bot, member, fields)
+        except discord.HTTPException as e:
+            DISCORD_SECONDS.observe(time.perf_counter() - start, ('edit_member',))
+            DISCORD_REQUESTS.inc(('edit_member', getattr(getattr(e, 'response', None), 'status', 'error')))
+            self.failed += 1
+            response = getattr(e, 'response', None)
+            if response is not None and response.status == 429:
+                self.rate_limited += 1
+                app.logger.warning("Rate limited editing members, waiting {:.1f} seconds".format(bucket.update_from_headers(response.headers)))
+            app.logger.error('Exception in edit_member(): ' + str(e))
+            if isinstance(e, (discord.Forbidden, discord.NotFound)):
+                return EDIT_REJECTED
+            return EDIT_FAILED
+        DISCORD_SECONDS.observe(time.perf_counter() - start, ('edit_member',))
+        DISCORD_REQUESTS.inc(('edit_member', 'ok'))
+        self.sent += 1
+        return EDIT_DONE
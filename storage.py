@@ -0,0 +1,135 @@
+import sqlite3
+import time
+
+from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+
+from metrics import Histogram
+
+DEFAULT_PROFILE = {
+    'JOURNAL_MODE': 'WAL',
+    'BUSY_TIMEOUT': 5000,
+    'SYNCHRONOUS': 'NORMAL',
+    'CACHE_SIZE': -16000,
+    'POOL_SIZE': 5,
+    'MAX_OVERFLOW': 10
+}
+
+DB_QUERY_SECONDS = Histogram('db_query_seconds', 'Time SQL statements took to execute, by statement type', ('statement',))
+
+def _before_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('query_start', []).append(time.perf_counter())
+
+def _after_execute(connection, cursor, statement, parameters, context, executemany):
+    start = connection.info['query_start'].pop()
+    words = statement.split(None, 1)
+    DB_QUERY_SECONDS.observe(time.perf_counter() - start, (words[0].upper() if words else '',))
+
+def _execute_failed(context):
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+def load_profile(config):
+    """
+    Reads the storage profile from the 'DATABASE' section of config.json
+    Args:
+        config (dict) - parsed config.json
+    Returns:
+        dict: DEFAULT_PROFILE overridden by the configured values
+    """
+    profile = dict(DEFAULT_PROFILE)
+    profile.update(config.get('DATABASE', {}))
+    return profile
+
+def sqlite_pragmas(profile):
+    """
+    Lists the pragmas a profile sets on every SQLite connection
+    Args:
+        profile (dict) - storage profile
+    Returns:
+        list: PRAGMA statements
+    """
+    pragmas = []
+    if profile.get('JOURNAL_MODE'):
+        pragmas.append('PRAGMA journal_mode={}'.format(profile['JOURNAL_MODE']))
+    if profile.get('BUSY_TIMEOUT') is not None:
+        pragmas.append('PRAGMA busy_timeout={:d}'.format(int(profile['BUSY_TIMEOUT'])))
+    if profile.get('SYNCHRONOUS'):
+        pragmas.append('PRAGMA synchronous={}'.format(profile['SYNCHRONOUS']))
+    if profile.get('CACHE_SIZE') is not None:
+        pragmas.append('PRAGMA cache_size={:d}'.format(int(profile['CACHE_SIZE'])))
+    return pragmas
+
+def apply_pragmas(dbapi_connection, profile):
+    """
+    Sets a profile's pragmas on a raw SQLite connection
+    Args:
+        dbapi_connection (sqlite3.Connection) - the connection
+        profile (dict) - storage profile
+    Returns:
+        None
+    """
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in sqlite_pragmas(profile):
+            cursor.execute(pragma)
+    finally:
+        cursor.close()
+
+def engine_options(profile):
+    """
+    Builds create_engine() options for a file-based SQLite database.
+    Connections are pooled per process and may be handed to other threads,
+    which the bot's database thread pool relies on.
+    Args:
+        profile (dict) - storage profile
+    Returns:
+        dict: keyword arguments for sqlalchemy.create_engine()
+    """
+    connectArgs = {'check_same_thread': False}
+    if profile.get('BUSY_TIMEOUT') is not None:
+        connectArgs['timeout'] = profile['BUSY_TIMEOUT'] / 1000.0
+    return {
+        'poolclass': QueuePool,
+        'pool_size': profile.get('POOL_SIZE', 5),
+        'max_overflow': profile.get('MAX_OVERFLOW', 10),
+        'connect_args': connectArgs
+    }
+
+def configure_engine(engine, profile):
+    """
+    Applies a profile's pragmas to every new connection of an engine
+    Args:
+        engine (sqlalchemy.engine.Engine) - the engine
+        profile (dict) - storage profile
+    Returns:
+        None
+    """
+    event.listen(engine, 'connect', lambda dbapi_connection, record: apply_pragmas(dbapi_connection, profile))
+
+class ProfiledSQLAlchemy(SQLAlchemy):
+    """
+    Flask-SQLAlchemy with the storage profile applied to SQLite databases
+    Args:
+        app (flask.Flask) - the application
+        profile (dict) - storage profile, see load_profile()
+    """
+    def __init__(self, app=None, profile=None, **kwargs):
+        self.profile = profile if profile is not None else dict(DEFAULT_PROFILE)
+        #The engine is created lazily inside Flask-SQLAlchemy, so listen on every engine
+        event.listen(Engine, 'connect', self._on_connect)
+        event.listen(Engine, 'before_cursor_execute', _before_execute)
+        event.listen(Engine, 'after_cursor_execute', _after_execute)
+        event.listen(Engine, 'handle_error', _execute_failed)
+        super().__init__(app, **kwargs)
+
+    def apply_driver_hacks(self, app, info, options):
+        super().apply_driver_hacks(app, info, options)
+        if info.drivername.startswith('sqlite') and info.database not in (None, '', ':memory:'):
+            options.update(engine_options(self.profile))
+
+    def _on_connect(self, dbapi_connection, record):
+        if isinstance(dbapi_connection, sqlite3.Connection):
+            apply_pragmas(dbapi_connection, self.profile)
@@ -0,0 +1,296 @@
+#!/usr/bin/env python
+"""
+Affiliation sweep worker.
+The on-server roster is split into SWEEP_WORKERS.PARTITIONS partitions by
+character_id. Every worker process claims up to MAX_PARTITIONS of them
+through leases in the sweep_leases table, renews its leases with a
+heartbeat and sweeps only the characters of the partitions it holds. A
+lease that is not renewed for LEASE_TTL seconds is taken over by another
+worker, so extra workers act as standbys.
+
+Workers only talk to ESI and the database. Members whose corporation or
+alliance changed are queued in member_refreshes and the bot, the only
+process connected to the Discord gateway, updates their nickname and
+roles. Set SWEEP_WORKERS.ENABLED so the bot stops sweeping itself.
+
+Usage:
+    python sweep_worker.py [--owner NAME]
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import math
+import os
+import socket
+import time
+
+from app import app
+from esi import EsiClient
+from invalids import InvalidCharacterCache
+from repository import BotRepository
+from notify import send_notification, REFRESH
+from metrics import REGISTRY, Counter, Gauge, serve as serve_metrics
+
+SWEEP_MEMBERS = Counter('sweep_worker_members_total', 'Members handled by the sweep worker, by outcome', ('outcome',))
+SWEEP_LEASES = Gauge('sweep_worker_leases', 'Partitions the sweep worker holds')
+
+class SweepWorker:
+    """
+    Sweeps the affiliations of the partitions it holds a lease on
+    Args:
+        esi (EsiClient) - ESI client
+        repository (BotRepository) - database access
+        owner (str) - unique id of the worker, stored in the leases
+        partitions (int) - number of partitions the roster is split into
+        max_partitions (int) - partitions one worker holds at most
+        lease_ttl (float) - seconds a lease stays valid without a heartbeat
+        tick (float) - seconds between sweeps
+        interval (float) - seconds over which every partition is checked once
+        min_batch (int) - smallest number of characters checked per partition and tick
+        invalid_recheck (float) - seconds before a character ESI reported as not existing is checked again
+        notify_socket (str) - socket of the bot, woken up when members need refreshing
+    """
+    def __init__(self, esi, repository, owner, partitions=4, max_partitions=1, lease_ttl=90, tick=60, interval=3600,
+                 min_batch=20, invalid_recheck=7 * 24 * 3600, notify_socket='bot.sock'):
+        self.esi = esi
+        self.repository = repository
+        self.owner = owner
+        self.partitions = partitions
+        self.max_partitions = max_partitions
+        self.lease_ttl = lease_ttl
+        self.tick = tick
+        self.interval = interval
+        self.min_batch = min_batch
+        self.invalid_recheck = invalid_recheck
+        self.notify_socket = notify_socket
+        self.held = set()
+        self.invalid = InvalidCharacterCache(esi, repository, recheck=invalid_recheck)
+        self.cursors = {}
+        self.takeovers = 0
+        self.lost = 0
+        self.checked = 0
+        self.refreshed = 0
+        #The heartbeat and the sweep loop both claim, one at a time or they could exceed max_partitions
+        self._claiming = asyncio.Lock()
+
+    @classmethod
+    def from_config(cls, esi, repository, config, owner):
+        """
+        Builds a worker from the 'SWEEP_WORKERS' and 'CORP_CHECK' sections of config.json
+        Args:
+            esi (EsiClient) - ESI client
+            repository (BotRepository) - database access
+            config (dict) - parsed config.json
+            owner (str) - unique id of the worker
+        Returns:
+            SweepWorker
+        """
+        workerConfig = config.get('SWEEP_WORKERS', {})
+        corpConfig = config.get('CORP_CHECK', {})
+        return cls(esi, repository, owner,
+            partitions=workerConfig.get('PARTITIONS', 4),
+            max_partitions=workerConfig.get('MAX_PARTITIONS', 1),
+            lease_ttl=workerConfig.get('LEASE_TTL', 90),
+            tick=workerConfig.get('TICK', 60),
+            interval=corpConfig.get('INTERVAL', 3600),
+            min_batch=corpConfig.get('MIN_BATCH', 20),
+            invalid_recheck=corpConfig.get('INVALID_RECHECK', 7 * 24 * 3600),
+            notify_socket=config.get('BOT_NOTIFY', {}).get('SOCKET', 'bot.sock'))
+
+    def stats(self):
+        """
+        Returns the worker counters
+        Args:
+            None
+        Returns:
+            dict: partitions held, takeovers, leases lost, members checked and refreshes queued
+        """
+        return {'held': len(self.held), 'takeovers': self.takeovers, 'lost': self.lost, 'checked': self.checked,
+            'refreshed': self.refreshed}
+
+    async def claim(self):
+        """
+        Renews the leases the worker holds and claims free or expired partitions up to max_partitions
+        Args:
+            None
+        Returns:
+            set: partitions held
+        """
+        async with self._claiming:
+            return await self._claim()
+
+    async def _claim(self):
+        now = datetime.datetime.utcnow()
+        for partition in sorted(self.held):
+            if not await self.repository.renew_lease(partition, self.owner, now, self.lease_ttl):
+                app.logger.warning('Lost the lease of partition %s', partition)
+                self.held.discard(partition)
+                self.lost += 1
+        if len(self.held) < self.max_partitions:
+            for lease in await self.repository.get_leases():
+                if len(self.held) >= self.max_partitions:
+                    break
+                if lease.partition >= self.partitions or lease.partition in self.held:
+                    continue
+                if lease.owner is not None and lease.expires is not None and lease.expires >= now:
+                    continue
+                if await self.repository.claim_lease(lease.partition, self.owner, now, self.lease_ttl):
+                    if lease.owner is not None and lease.owner != self.owner:
+                        app.logger.info('Took partition %s over from %s', lease.partition, lease.owner)
+                        self.takeovers += 1
+                    else:
+                        app.logger.info('Claimed partition %s', lease.partition)
+                    self.held.add(lease.partition)
+                    #Start from the beginning, the previous owner's cursor is unknown
+                    self.cursors[lease.partition] = 0
+        SWEEP_LEASES.set(len(self.held))
+        return self.held
+
+    async def heartbeat(self):
+        """
+        Renews the leases until cancelled, also while a sweep waits on ESI
+        Args:
+            None
+        Returns:
+            None
+        """
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            try:
+                await self.claim()
+            except Exception as e:
+                app.logger.error('Exception in SweepWorker.heartbeat(): ' + str(e))
+
+    async def sweep(self, partition):
+        """
+        Checks the characters of a partition whose affiliation snapshot expired.
+        One tick's share of the partition is checked, and more batches as long
+        as there is a backlog and the tick has time left.
+        Args:
+            partition (int) - partition to sweep
+        Returns:
+            int: number of characters checked
+        """
+        start = time.monotonic()
+        total = await self.repository.count_on_server_users(partition, self.partitions)
+        batch = max(self.min_batch, int(math.ceil(total * self.tick / self.interval)))
+        checked = 0
+        while partition in self.held and not self.esi.retry_after():
+            now = datetime.datetime.utcnow()
+            rows = await self.repository.get_due_users(now, self.cursors.get(partition, 0), batch, partition, self.partitions)
+            if not rows:
+                break
+            self.cursors[partition] = rows[-1].character_id
+            if not await self.check(partition, rows, now):
+                break
+            checked += len(rows)
+            if len(rows) < batch or time.monotonic() - start >= self.tick:
+                break
+        return checked
+
+    async def check(self, partition, rows, now):
+        """
+        Looks up the affiliations of a batch and stores them
+        Args:
+            partition (int) - partition the rows belong to
+            rows (list) - DiscordUser rows to check
+            now (datetime.datetime) - current UTC time
+        Returns:
+            bool: False if the lease was lost and the results were thrown away
+        """
+        requested = {row.character_id for row in rows}
+        affiliations = await self.invalid.lookup(requested)
+
+        updates = {}
+        refreshes = []
+        for row in rows:
+            affiliation = affiliations.get(row.character_id)
+            if row.character_id in self.invalid:
+                #Purging links needs the bot, the character is only checked again much later
+                updates[row.id] = {'affiliation_checked': now,
+                    'affiliation_expires': now + datetime.timedelta(seconds=self.invalid_recheck)}
+                SWEEP_MEMBERS.inc(('invalid',))
+                continue
+            if affiliation is None:
+                updates[row.id] = {'affiliation_checked': now, 'affiliation_expires': now + datetime.timedelta(seconds=self.interval)}
+                SWEEP_MEMBERS.inc(('skipped',))
+                continue
+            updates[row.id] = {'affiliation_checked': now,
+                'affiliation_expires': affiliation.expires or now + datetime.timedelta(seconds=self.interval)}
+            if row.corporation_id != affiliation.corporation_id or row.alliance_id != affiliation.alliance_id:
+                updates[row.id].update(corporation_id=affiliation.corporation_id, alliance_id=affiliation.alliance_id)
+                refreshes.append(row.discord_id)
+                SWEEP_MEMBERS.inc(('changed',))
+            else:
+                SWEEP_MEMBERS.inc(('unchanged',))
+
+        if not await self.repository.apply_sweep(partition, self.owner, datetime.datetime.utcnow(), self.lease_ttl, updates, refreshes):
+            app.logger.warning('Lost the lease of partition %s, discarding %s results', partition, len(rows))
+            self.held.discard(partition)
+            self.lost += 1
+            return False
+        self.checked += len(rows)
+        self.refreshed += len(refreshes)
+        if refreshes:
+            send_notification(self.notify_socket, REFRESH)
+        return True
+
+    async def run(self):
+        """
+        Sweeps the held partitions every tick until cancelled
+        Args:
+            None
+        Returns:
+            None
+        """
+        await self.repository.ensure_leases(self.partitions)
+        app.logger.info('Loaded {} invalid characters'.format(self.invalid.load()))
+        while True:
+            try:
+                await self.claim()
+                if self.esi.retry_after():
+                    app.logger.info('Sweep deferred, ESI is unavailable for another {:.0f} seconds'.format(self.esi.retry_after()))
+                for partition in sorted(self.held):
+                    start = time.perf_counter()
+                    checked = await self.sweep(partition)
+                    if checked:
+                        app.logger.info('Partition {}: checked {} characters in {:.3f} seconds'.format(partition, checked,
+                            time.perf_counter() - start))
+            except Exception as e:
+                app.logger.error('Exception in SweepWorker.run(): ' + str(e))
+            await asyncio.sleep(self.tick)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sweeps the affiliations of a share of the roster')
+    parser.add_argument('--owner', default='{}:{}'.format(socket.gethostname(), os.getpid()), help='unique name of this worker')
+    parser.add_argument('--metrics-port', type=int, default=None, help='serve metrics on this port')
+    args = parser.parse_args()
+
+    with open('config.json') as f:
+        config = json.load(f)
+    loop = asyncio.get_event_loop()
+    esi = EsiClient.from_config(config, loop=loop)
+    repository = BotRepository.from_config(config, loop=loop)
+    worker = SweepWorker.from_config(esi, repository, config, args.owner)
+    app.logger.info('Sweep worker %s starting, %s partitions', args.owner, worker.partitions)
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = loop.run_until_complete(serve_metrics(REGISTRY, config.get('METRICS', {}).get('HOST', '127.0.0.1'), args.metrics_port))
+    tasks = [loop.create_task(worker.run()), loop.create_task(worker.heartbeat())]
+    try:
+        loop.run_until_complete(asyncio.gather(*tasks))
+    except KeyboardInterrupt:
+        app.logger.warning('Stopping ...')
+    finally:
+        for task in tasks:
+            task.cancel()
+        loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+        #Hand the partitions over right away instead of after LEASE_TTL
+        loop.run_until_complete(repository.release_leases(args.owner))
+        repository.close()
+        esi.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        loop.close()
+        app.logger.info('Done')
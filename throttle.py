@@ -0,0 +1,188 @@
+import asyncio
+from collections import deque
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+class AdaptiveLimiter:
+    """
+    Concurrency limit that adapts to how well the remote side copes.
+    Works like a semaphore whose size grows by about one slot for every
+    limit successful requests and is halved when the remote side struggles
+    (additive increase, multiplicative decrease). All requests can also be
+    held back until a moment in time, e.g. until an error limit resets.
+    Args:
+        loop (asyncio.AbstractEventLoop) - loop the limiter runs on
+        min_limit (int) - lowest number of requests in flight
+        max_limit (int) - highest number of requests in flight
+        decrease (float) - factor the limit is multiplied with on a backoff
+        cooldown (float) - seconds after a backoff during which further backoffs are ignored
+    """
+    def __init__(self, loop=None, min_limit=1, max_limit=10, decrease=0.5, cooldown=1.0):
+        self.loop = loop or asyncio.get_event_loop()
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.decrease = decrease
+        self.cooldown = cooldown
+        self.limit = float(self.max_limit)
+        self.in_flight = 0
+        self.backoffs = 0
+        self.held_until = 0.0
+        self._last_backoff = None
+        self._waiters = deque()
+
+    def _can_enter(self):
+        return self.in_flight < int(self.limit) and self.loop.time() >= self.held_until
+
+    def _wake(self):
+        free = int(self.limit) - self.in_flight
+        for waiter in self._waiters:
+            if free <= 0:
+                break
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+    async def acquire(self):
+        while not self._can_enter():
+            delay = self.held_until - self.loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            waiter = self.loop.create_future()
+            self._waiters.append(waiter)
+            try:
+                await waiter
+            finally:
+                self._waiters.remove(waiter)
+        self.in_flight += 1
+
+    def release(self):
+        self.in_flight -= 1
+        self._wake()
+
+    async def __aenter__(self):
+        await self.acquire()
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+    def success(self):
+        """
+        Grows the limit after a successful request
+        Args:
+            None
+        Returns:
+            None
+        """
+        self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+        self._wake()
+
+    def backoff(self):
+        """
+        Shrinks the limit after the remote side signalled trouble
+        Args:
+            None
+        Returns:
+            bool: True if the limit was lowered, False during the cooldown
+        """
+        now = self.loop.time()
+        if self._last_backoff is not None and now - self._last_backoff < self.cooldown:
+            return False
+        self._last_backoff = now
+        self.limit = max(self.min_limit, self.limit * self.decrease)
+        self.backoffs += 1
+        return True
+
+    def hold(self, seconds):
+        """
+        Lets no new request through for a while
+        Args:
+            seconds (float) - how long to hold
+        Returns:
+            None
+        """
+        self.held_until = max(self.held_until, self.loop.time() + seconds)
+
+class CircuitBreaker:
+    """
+    Stops requests to a failing service.
+    After threshold consecutive failures the circuit opens and every request
+    is refused for reset_timeout seconds. A single trial request is then let
+    through: if it succeeds the circuit closes, otherwise it opens again.
+    Args:
+        loop (asyncio.AbstractEventLoop) - loop the breaker runs on
+        threshold (int) - consecutive failures that open the circuit
+        reset_timeout (float) - seconds the circuit stays open
+    """
+    def __init__(self, loop=None, threshold=5, reset_timeout=30.0):
+        self.loop = loop or asyncio.get_event_loop()
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._trial_at = None
+
+    def retry_after(self):
+        """
+        Returns how long the circuit stays open
+        Args:
+            None
+        Returns:
+            float: seconds until a trial request is allowed, 0 if requests are allowed
+        """
+        if self.state != OPEN:
+            return 0.0
+        return max(0.0, self._opened_at + self.reset_timeout - self.loop.time())
+
+    def allow(self):
+        """
+        Decides whether a request may be sent
+        Args:
+            None
+        Returns:
+            bool: False if the request must be refused
+        """
+        if self.state == OPEN and self.retry_after() == 0:
+            self.state = HALF_OPEN
+            self._trial_at = None
+        if self.state == CLOSED:
+            return True
+        now = self.loop.time()
+        #A trial that never reported back, e.g. because it was cancelled, is replaced
+        if self.state == HALF_OPEN and (self._trial_at is None or now - self._trial_at > self.reset_timeout):
+            self._trial_at = now
+            return True
+        self.rejected += 1
+        return False
+
+    def success(self):
+        """
+        Records a request that succeeded
+        Args:
+            None
+        Returns:
+            None
+        """
+        self.failures = 0
+        self.state = CLOSED
+
+    def failure(self):
+        """
+        Records a request that failed because of the service
+        Args:
+            None
+        Returns:
+            bool: True if this failure opened the circuit
+        """
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.threshold):
+            self.state = OPEN
+            self._opened_at = self.loop.time()
+            self.opened += 1
+            return True
+        return False
@@ -0,0 +1,183 @@
+import asyncio
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+
+from app import app
+from models import EntityTicker
+
+CORPORATION = 'corporation'
+ALLIANCE = 'alliance'
+
+TickerEntry = namedtuple('TickerEntry', ['ticker', 'etag', 'expires'])
+
+class TickerCache:
+    """
+    Bounded LRU cache of corporation and alliance tickers.
+    Entries stay fresh until the Expires header ESI sent with them. Stale
+    entries are revalidated with If-None-Match, so an unchanged ticker costs a
+    304 instead of a full response. Every entry is mirrored to the
+    entity_tickers table, which keeps the cache warm across restarts and
+    lets a changed ticker be detected even after the entry was evicted.
+    Args:
+        esi (esi.EsiClient) - client used for lookups
+        repository (repository.BotRepository) - database access for the stored tickers
+        max_size (int) - maximum number of entries kept in memory
+        on_change (callable) - called as on_change(entity_type, entity_id, old ticker, new ticker) when ESI returns a different ticker
+    """
+    def __init__(self, esi, repository, max_size=2048, on_change=None):
+        self.esi = esi
+        self.repository = repository
+        self.max_size = max_size
+        self.on_change = on_change
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.evictions = 0
+        self.changes = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+
+    @classmethod
+    def from_config(cls, esi, repository, config, on_change=None):
+        """
+        Builds a cache from the 'TICKER_CACHE' section of config.json
+        Args:
+            esi (esi.EsiClient) - client used for lookups
+            repository (repository.BotRepository) - database access for the stored tickers
+            config (dict) - parsed config.json
+            on_change (callable) - called when a ticker changed
+        Returns:
+            TickerCache
+        """
+        return cls(esi, repository, max_size=config.get('TICKER_CACHE', {}).get('MAX_SIZE', 2048), on_change=on_change)
+
+    def load(self):
+        """
+        Warms the cache with the most recently refreshed tickers in the database.
+        Meant to be called once at startup, before the event loop runs.
+        Args:
+            None
+        Returns:
+            int: number of entries loaded
+        """
+        rows = EntityTicker.query.order_by(EntityTicker.expires.desc()).limit(self.max_size).all()
+        for row in reversed(rows):
+            self._entries[(row.entity_type, row.entity_id)] = TickerEntry(row.ticker, row.etag, row.expires)
+        return len(rows)
+
+    def stats(self):
+        """
+        Returns the cache counters
+        Args:
+            None
+        Returns:
+            dict: hits, misses, revalidations, evictions, detected changes and current size
+        """
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidations': self.revalidations,
+            'evictions': self.evictions,
+            'changes': self.changes,
+            'size': len(self._entries)
+        }
+
+    async def get_ticker(self, corporation_id, alliance_id):
+        """
+        Retrieves the ticker shown in front of a member's nickname
+        Args:
+            corporation_id (int) - id of the corporation
+            alliance_id (int) - id of the alliance, None if the corporation is not in one
+        Returns:
+            str: alliance ticker if in an alliance, corporation ticker otherwise
+        Raises:
+            esi.EsiError: if the ticker is not cached and ESI fails
+        """
+        if alliance_id is not None:
+            return await self.get(ALLIANCE, alliance_id)
+        return await self.get(CORPORATION, corporation_id)
+
+    async def get(self, entity_type, entity_id):
+        """
+        Retrieves a single ticker, from the cache when it is still fresh
+        Args:
+            entity_type (str) - CORPORATION or ALLIANCE
+            entity_id (int) - id of the corporation or alliance
+        Returns:
+            str: the ticker
+        """
+        key = (entity_type, entity_id)
+        entry = self._entries.get(key)
+        if entry is not None and entry.expires > datetime.utcnow():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.ticker
+
+        #Share a single request between everyone waiting for the same ticker
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._refresh(key, entry), loop=self.esi.loop)
+            future.add_done_callback(lambda f: self._pending.pop(key, None))
+            self._pending[key] = future
+        return await asyncio.shield(future)
+
+    async def refresh_expired(self):
+        """
+        Revalidates the cached tickers that went stale, so a changed ticker is
+        noticed even when no member of the corporation or alliance is checked
+        Args:
+            None
+        Returns:
+            int: number of tickers revalidated
+        """
+        now = datetime.utcnow()
+        stale = [key for key, entry in self._entries.items() if entry.expires <= now]
+        for entity_type, entity_id in stale:
+            try:
+                await self.get(entity_type, entity_id)
+            except Exception as e:
+                app.logger.error('Exception in TickerCache.refresh_expired(): ' + str(e))
+        return len(stale)
+
+    async def _refresh(self, key, entry):
+        entity_type, entity_id = key
+        if entry is None:
+            row = await self.repository.get_ticker(entity_type, entity_id)
+            if row is not None:
+                entry = TickerEntry(row.ticker, row.etag, row.expires)
+                if entry.expires > datetime.utcnow():
+                    self.hits += 1
+                    self._remember(key, entry)
+                    return entry.ticker
+
+        etag = entry.etag if entry is not None else None
+        response = await self.esi.fetch('GET', '/{}s/{}/'.format(entity_type, entity_id), etag=etag)
+        if response.status == 304 and entry is not None:
+            self.revalidations += 1
+            ticker = entry.ticker
+        else:
+            self.misses += 1
+            ticker = response.data['ticker']
+        previous = entry.ticker if entry is not None else None
+        entry = TickerEntry(ticker, response.etag, response.expires)
+        self._remember(key, entry)
+        await self._persist(key, entry)
+        if previous is not None and previous != ticker:
+            self.changes += 1
+            app.logger.info('Ticker of %s %s changed from %s to %s', entity_type, entity_id, previous, ticker)
+            if self.on_change is not None:
+                self.on_change(entity_type, entity_id, previous, ticker)
+        return ticker
+
+    def _remember(self, key, entry):
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    async def _persist(self, key, entry):
+        try:
+            await self.repository.save_ticker(EntityTicker(key[0], key[1], entry.ticker, entry.etag, entry.expires))
+        except Exception as e:
+            app.logger.error('Exception in TickerCache._persist(): ' + str(e))
@@ -0,0 +1,198 @@
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from metrics import Histogram, endpoint_label
+
+ESI_BASE_URL = 'https://esi.tech.ccp.is/latest'
+ESI_DATASOURCE = 'tranquility'
+
+DEPENDENCY_SECONDS = Histogram('web_dependency_seconds', 'Time outbound calls of the web app took', ('dependency', 'operation'))
+
+class TTLCache:
+    """
+    Small in-process cache whose entries expire after a fixed time
+    Args:
+        ttl (float) - seconds an entry stays valid
+        max_size (int) - maximum number of entries, the oldest are dropped first
+    """
+    def __init__(self, ttl=300, max_size=1024):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        """
+        Returns a cached value
+        Args:
+            key (object) - key of the entry
+        Returns:
+            object: the value, None if it is missing or expired
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires = entry
+        if expires < time.monotonic():
+            del self._entries[key]
+            return None
+        return value
+
+    def put(self, key, value):
+        """
+        Stores a value
+        Args:
+            key (object) - key of the entry
+            value (object) - value to store
+        Returns:
+            None
+        """
+        self._entries.pop(key, None)
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+def make_adapter(pool_size=10, retries=2, backoff=0.3):
+    """
+    Builds a keep-alive connection pool that retries failed connections and server errors
+    Args:
+        pool_size (int) - connections kept open per host
+        retries (int) - retries of a failed request
+        backoff (float) - backoff factor between retries, in seconds
+    Returns:
+        requests.adapters.HTTPAdapter
+    """
+    retry = Retry(total=retries, backoff_factor=backoff, status_forcelist=(500, 502, 503, 504),
+        method_whitelist=frozenset(['GET', 'POST']), raise_on_status=False)
+    return HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+
+def timing_hook(logger, dependency):
+    """
+    Builds a requests response hook that logs how long a dependency took to answer
+    Args:
+        logger (logging.Logger) - logger to write to
+        dependency (str) - name of the dependency, e.g. 'ESI'
+    Returns:
+        callable: hook for requests.Session.hooks['response']
+    """
+    def hook(response, *args, **kwargs):
+        DEPENDENCY_SECONDS.observe(response.elapsed.total_seconds(),
+            (dependency, response.request.method + ' ' + endpoint_label(response.request.path_url.split('?')[0])))
+        logger.info('%s %s %s answered %s in %.3f seconds', dependency, response.request.method,
+            response.request.path_url, response.status_code, response.elapsed.total_seconds())
+    return hook
+
+@contextmanager
+def timed(logger, dependency, operation):
+    """
+    Logs how long a call to a dependency took, for clients that do not use a pooled session
+    Args:
+        logger (logging.Logger) - logger to write to
+        dependency (str) - name of the dependency
+        operation (str) - what was done
+    Returns:
+        None
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        DEPENDENCY_SECONDS.observe(elapsed, (dependency, operation))
+        logger.info('{} {} took {:.3f} seconds'.format(dependency, operation, elapsed))
+
+class EsiWebClient:
+    """
+    Synchronous ESI client for the web workers.
+    Requests go through one keep-alive connection pool per worker process
+    and affiliations are cached for a short while, so repeated lookups of
+    the same character cost nothing.
+    Args:
+        maintainer (str) - maintainer contact for the User-Agent header
+        logger (logging.Logger) - logger for the request timings
+        base_url (str) - ESI base URL, without trailing slash
+        datasource (str) - ESI datasource
+        timeout (float) - seconds before a request is abandoned
+        pool_size (int) - connections kept open
+        retries (int) - retries of a failed request
+        backoff (float) - backoff factor between retries, in seconds
+        cache_ttl (float) - seconds an affiliation stays cached
+        cache_size (int) - maximum number of cached affiliations
+    """
+    def __init__(self, maintainer, logger, base_url=ESI_BASE_URL, datasource=ESI_DATASOURCE, timeout=10,
+                 pool_size=10, retries=2, backoff=0.3, cache_ttl=300, cache_size=1024):
+        self.base_url = base_url.rstrip('/')
+        self.datasource = datasource
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers.update({'Accept': 'application/json', 'User-Agent': 'Maintainer: ' + maintainer})
+        self.session.mount('https://', make_adapter(pool_size, retries, backoff))
+        self.session.hooks['response'].append(timing_hook(logger, 'ESI'))
+        self.affiliations = TTLCache(cache_ttl, cache_size)
+
+    @classmethod
+    def from_config(cls, config, logger):
+        """
+        Builds a client from the 'ESI' and 'WEB_HTTP' sections of config.json
+        Args:
+            config (dict) - parsed config.json
+            logger (logging.Logger) - logger for the request timings
+        Returns:
+            EsiWebClient
+        """
+        esiConfig = config.get('ESI', {})
+        httpConfig = config.get('WEB_HTTP', {})
+        return cls(config['MAINTAINER'], logger,
+            base_url=esiConfig.get('BASE_URL', ESI_BASE_URL),
+            datasource=esiConfig.get('DATASOURCE', ESI_DATASOURCE),
+            timeout=httpConfig.get('TIMEOUT', 10),
+            pool_size=httpConfig.get('POOL_SIZE', 10),
+            retries=httpConfig.get('RETRIES', 2),
+            backoff=httpConfig.get('BACKOFF', 0.3),
+            cache_ttl=httpConfig.get('CACHE_TTL', 300),
+            cache_size=httpConfig.get('CACHE_SIZE', 1024))
+
+    def request(self, method, path, payload=None):
+        """
+        Makes a request to ESI
+        Args:
+            method (str) - HTTP method
+            path (str) - path relative to the base URL, e.g. '/characters/123/'
+            payload (object) - JSON body, if any
+        Returns:
+            object: decoded JSON response
+        Raises:
+            requests.RequestException: on a timeout or a connection failure
+            ValueError: if the response is not JSON
+        """
+        r = self.session.request(method, self.base_url + path, params={'datasource': self.datasource}, json=payload, timeout=self.timeout)
+        return r.json()
+
+    def get_affiliation(self, character_id):
+        """
+        Looks up the corporation and alliance of a character
+        Args:
+            character_id (int) - id of the character
+        Returns:
+            dict: with 'corporation_id' and, if in an alliance, 'alliance_id'. None if the character does not exist
+        """
+        data = self.affiliations.get(character_id)
+        if data is not None:
+            return data
+        result = self.request('POST', '/characters/affiliation/', [character_id])
+        if not result:
+            return None
+        if 'error' in result:
+            #Make different endpoint check
+            result = self.request('GET', '/characters/{}/'.format(character_id))
+            if not result or 'error' in result:
+                return None
+            data = result
+        else:
+            data = result[0]
+        self.affiliations.put(character_id, data)
+        return data
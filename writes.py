@@ -0,0 +1,168 @@
+import asyncio
+from collections import OrderedDict
+
+from sqlalchemy.exc import OperationalError
+
+from app import app
+
+class WriteBuffer:
+    """
+    Write-behind buffer for the bot's database changes.
+    Updates and deletes are collected in memory and applied as bulk
+    statements with a single commit, either when flush() is called, when
+    flush_interval seconds have passed or when max_pending changes are queued.
+    Later updates to the same row are merged into the queued one. Changes of
+    a failed flush are queued again. After max_retries failed flushes in a
+    row the changes are written one by one, and only a change that fails on
+    its own is dropped, so a bad row cannot hold the buffer up forever while
+    a locked or unreachable database loses nothing.
+    Args:
+        repository (repository.BotRepository) - database access the changes are written through
+        flush_interval (float) - maximum seconds a change waits before it is written
+        max_pending (int) - number of queued changes that triggers an early flush
+        max_retries (int) - failed flushes in a row after which the changes are written one by one
+    """
+    def __init__(self, repository, flush_interval=2.0, max_pending=500, max_retries=5):
+        self.repository = repository
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.max_retries = max_retries
+        self.flushes = 0
+        self.written = 0
+        self.dropped = 0
+        self._failures = 0
+        self._updates = OrderedDict()
+        self._deletes = OrderedDict()
+        self._full = asyncio.Event()
+
+    @classmethod
+    def from_config(cls, repository, config):
+        """
+        Builds a buffer from the 'WRITE_BUFFER' section of config.json
+        Args:
+            repository (repository.BotRepository) - database access the changes are written through
+            config (dict) - parsed config.json
+        Returns:
+            WriteBuffer
+        """
+        bufferConfig = config.get('WRITE_BUFFER', {})
+        return cls(repository, flush_interval=bufferConfig.get('FLUSH_INTERVAL', 2.0), max_pending=bufferConfig.get('MAX_PENDING', 500),
+            max_retries=bufferConfig.get('MAX_RETRIES', 5))
+
+    def __len__(self):
+        return sum(len(rows) for rows in self._updates.values()) + sum(len(keys) for keys in self._deletes.values())
+
+    def update(self, model, key, **fields):
+        """
+        Queues an update of a single row
+        Args:
+            model (db.Model) - model of the row
+            key (object) - primary key of the row
+            fields (dict) - columns to set
+        Returns:
+            None
+        """
+        rows = self._updates.setdefault(model, OrderedDict())
+        rows.setdefault(key, {}).update(fields)
+        self._check_size()
+
+    def delete(self, model, key):
+        """
+        Queues the deletion of a single row
+        Args:
+            model (db.Model) - model of the row
+            key (object) - primary key of the row
+        Returns:
+            None
+        """
+        self._updates.get(model, {}).pop(key, None)
+        self._deletes.setdefault(model, OrderedDict())[key] = True
+        self._check_size()
+
+    def _check_size(self):
+        if len(self) >= self.max_pending:
+            self._full.set()
+
+    async def flush(self):
+        """
+        Writes every queued change with one commit
+        Args:
+            None
+        Returns:
+            int: number of rows written
+        """
+        updates, self._updates = self._updates, OrderedDict()
+        deletes, self._deletes = self._deletes, OrderedDict()
+        if not updates and not deletes:
+            return 0
+        try:
+            count = await self.repository.apply_writes(updates, deletes)
+        except Exception:
+            self._failures += 1
+            if self._failures < self.max_retries:
+                self._requeue(updates, deletes)
+                raise
+            count = await self._flush_each(updates, deletes)
+        self._failures = 0
+        self.flushes += 1
+        self.written += count
+        return count
+
+    async def _flush_each(self, updates, deletes):
+        #The batch keeps failing, find the changes that fail on their own
+        changes = [(model, key, fields) for model, rows in updates.items() for key, fields in rows.items()]
+        changes += [(model, key, None) for model, keys in deletes.items() for key in keys]
+        count = 0
+        for index, (model, key, fields) in enumerate(changes):
+            try:
+                if fields is None:
+                    count += await self.repository.apply_writes({}, {model: {key: True}})
+                else:
+                    count += await self.repository.apply_writes({model: {key: fields}}, {})
+            except OperationalError:
+                #The database itself is failing, e.g. locked, so nothing is dropped
+                restUpdates = OrderedDict()
+                restDeletes = OrderedDict()
+                for restModel, restKey, restFields in changes[index:]:
+                    if restFields is None:
+                        restDeletes.setdefault(restModel, OrderedDict())[restKey] = True
+                    else:
+                        restUpdates.setdefault(restModel, OrderedDict())[restKey] = restFields
+                self._requeue(restUpdates, restDeletes)
+                raise
+            except Exception as e:
+                self.dropped += 1
+                app.logger.error('Dropping the change of %s %s, it fails on its own: %s', model.__name__, key, e)
+        return count
+
+    def _requeue(self, updates, deletes):
+        #Changes queued while flushing are newer than the ones that failed
+        for model, rows in updates.items():
+            current = self._updates.setdefault(model, OrderedDict())
+            for key, fields in rows.items():
+                if key in self._deletes.get(model, {}):
+                    continue
+                merged = dict(fields)
+                merged.update(current.get(key, {}))
+                current[key] = merged
+        for model, keys in deletes.items():
+            self._deletes.setdefault(model, OrderedDict()).update(keys)
+
+    async def run(self):
+        """
+        Flushes the buffer every flush_interval seconds, or sooner when it fills up
+        Args:
+            None
+        Returns:
+            None
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                app.logger.error('Exception in WriteBuffer.flush(): ' + str(e))